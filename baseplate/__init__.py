@@ -60,6 +60,10 @@ def tracing_client_from_config(
         (Deprecated in favor of the sidecar model.) Destination to record span data.
     ``tracing.queue_name`` (optional)
         Name of POSIX queue where spans are recorded
+    ``tracing.queue_type`` (optional)
+        The kind of queue spans are recorded to: ``posix`` (the default) or
+        ``shm`` for a shared memory ring buffer. Must match the trace
+        publisher's configuration.
     ``tracing.max_span_queue_size`` (optional)
         Span processing queue limit.
     ``tracing.num_span_workers`` (optional)
@@ -86,6 +90,9 @@ def tracing_client_from_config(
                 "service_name": config.String,
                 "endpoint": config.Optional(config.Endpoint),
                 "queue_name": config.Optional(config.String),
+                "queue_type": config.Optional(
+                    config.OneOf(posix="posix", shm="shm"), default="posix"
+                ),
                 "max_span_queue_size": config.Optional(config.Integer, default=50000),
                 "num_span_workers": config.Optional(config.Integer, default=5),
                 "span_batch_interval": config.Optional(
@@ -104,6 +111,7 @@ def tracing_client_from_config(
         service_name=cfg.tracing.service_name,
         tracing_endpoint=cfg.tracing.endpoint,
         tracing_queue_name=cfg.tracing.queue_name,
+        tracing_queue_type=cfg.tracing.queue_type,
         max_span_queue_size=cfg.tracing.max_span_queue_size,
         num_span_workers=cfg.tracing.num_span_workers,
         span_batch_interval=cfg.tracing.span_batch_interval.total_seconds(),
@@ -1,5 +1,12 @@
+import time
+import weakref
+
+from amqp import spec
+from amqp.exceptions import MessageNacked
 from kombu import Connection
 from kombu import Exchange
+from kombu.pools import Connections
+from kombu.pools import ProducerPool
 from kombu.pools import Producers
 
 from baseplate import config
@@ -85,8 +92,8 @@ class KombuProducerContextFactory(ContextFactory):
 
     This factory will attach a proxy object which acts like a
     :py:class:`kombu.Producer` to an attribute on the :term:`context object`.
-    The :py:meth:`~baseplate.context.kombu.KombuProducer.publish` method will
-    automatically record diagnostic information.
+    The ``publish`` and ``publish_many`` methods will automatically record
+    diagnostic information.
 
     :param kombu.connection.Connection connection: A configured connection
         object.
@@ -99,18 +106,53 @@ class KombuProducerContextFactory(ContextFactory):
         self.connection = connection
         self.exchange = exchange
         self.producers = Producers(limit=max_connections)
+        self.confirm_producers = _ConfirmProducers(limit=max_connections)
+        # the number of messages published on each channel that has publisher
+        # confirms enabled. the broker numbers confirms by this count.
+        self.confirm_sequences = weakref.WeakKeyDictionary()
 
     def make_object_for_context(self, name, span):
-        return _KombuProducer(name, span, self.connection, self.exchange, self.producers)
+        return _KombuProducer(
+            name,
+            span,
+            self.connection,
+            self.exchange,
+            self.producers,
+            self.confirm_producers,
+            self.confirm_sequences,
+        )
+
+
+class _ConfirmProducers(Producers):
+    """Producer pools for publishing with publisher confirms.
+
+    A channel can't leave confirm mode, and the broker sends an ack on it for
+    every message published from then on. These pools have connections of
+    their own, so their channels are never handed out to producers that won't
+    read the acks.
+
+    """
+
+    def __init__(self, limit=None):
+        super().__init__(limit=limit)
+        self.connections = Connections(limit=limit)
+
+    def create(self, connection, limit):
+        return ProducerPool(self.connections[connection], limit=limit)
 
 
 class _KombuProducer:
-    def __init__(self, name, span, connection, exchange, producers):
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self, name, span, connection, exchange, producers, confirm_producers, confirm_sequences
+    ):
         self.name = name
         self.span = span
         self.connection = connection
         self.exchange = exchange
         self.producers = producers
+        self.confirm_producers = confirm_producers
+        self.confirm_sequences = confirm_sequences
 
     def publish(self, body, routing_key=None, **kwargs):
         trace_name = "{}.{}".format(self.name, "publish")
@@ -126,3 +168,95 @@ class _KombuProducer:
                 return producer.publish(
                     body=body, routing_key=routing_key, exchange=self.exchange, **kwargs
                 )
+
+    def publish_many(self, bodies, routing_key=None, confirm=False, confirm_timeout=None, **kwargs):
+        """Publish several messages with one producer from the pool.
+
+        All the messages are published on the same channel inside a single
+        span, which is tagged with the number of messages.
+
+        With ``confirm``, the producer comes from a separate pool whose
+        channels have publisher confirms enabled and aren't used by
+        :py:meth:`publish`.
+
+        :param bodies: An iterable of message bodies.
+        :param str routing_key: The routing key for all the messages.
+        :param bool confirm: Wait for the broker to confirm it has taken
+            responsibility for all the messages, raising an exception if any
+            are rejected. The messages are all sent before waiting, so this
+            costs one round trip rather than one per message. This requires
+            RabbitMQ (the ``pyamqp`` transport).
+        :param float confirm_timeout: The maximum time to wait, in seconds, for
+            the confirmations. Defaults to no limit.
+
+        Any other keyword arguments are passed on to
+        :py:meth:`kombu.Producer.publish` for each message.
+
+        :returns: The number of messages published.
+
+        """
+        trace_name = "{}.{}".format(self.name, "publish_many")
+        child_span = self.span.make_child(trace_name)
+
+        child_span.set_tag("kind", "producer")
+        if routing_key:
+            child_span.set_tag("message_bus.destination", routing_key)
+
+        with child_span:
+            producers = self.confirm_producers if confirm else self.producers
+            producer_pool = producers[self.connection]
+            with producer_pool.acquire(block=True) as producer:
+                channel = producer.channel
+                if confirm and channel not in self.confirm_sequences:
+                    channel.confirm_select()
+                    self.confirm_sequences[channel] = 0
+                first_tag = self.confirm_sequences.get(channel, 0) + 1
+
+                count = 0
+                try:
+                    for body in bodies:
+                        producer.publish(
+                            body=body, routing_key=routing_key, exchange=self.exchange, **kwargs
+                        )
+                        count += 1
+                finally:
+                    if confirm:
+                        self.confirm_sequences[channel] += count
+                child_span.set_tag("message_count", count)
+
+                if confirm and count:
+                    _wait_for_confirms(channel, first_tag, first_tag + count - 1, confirm_timeout)
+                return count
+
+
+def _wait_for_confirms(channel, first_tag, last_tag, timeout):
+    # the broker may confirm messages individually, in any order, or many at
+    # once up to a delivery tag.
+    unconfirmed = set(range(first_tag, last_tag + 1))
+    nacked = []
+
+    def on_ack(delivery_tag, multiple):
+        if multiple:
+            unconfirmed.difference_update(range(first_tag, min(delivery_tag, last_tag) + 1))
+        else:
+            unconfirmed.discard(delivery_tag)
+
+    def on_nack(delivery_tag, multiple):
+        if delivery_tag in unconfirmed or (multiple and delivery_tag >= first_tag):
+            nacked.append(delivery_tag)
+
+    channel.events["basic_ack"].add(on_ack)
+    channel.events["basic_nack"].add(on_nack)
+    try:
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while unconfirmed and not nacked:
+            remaining = None
+            if deadline is not None:
+                remaining = max(deadline - time.monotonic(), 0)
+            channel.wait([spec.Basic.Ack, spec.Basic.Nack], timeout=remaining)
+    finally:
+        channel.events["basic_ack"].discard(on_ack)
+        channel.events["basic_nack"].discard(on_nack)
+
+    if nacked:
+        raise MessageNacked()
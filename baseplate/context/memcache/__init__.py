@@ -1,7 +1,10 @@
+import copy
+
 from pymemcache.client.base import PooledClient
 
 from baseplate import config
 from baseplate.context import ContextFactory
+from baseplate.singleflight import SingleFlight
 
 
 def pool_from_config(app_config, prefix="memcache.", serializer=None, deserializer=None):
@@ -74,12 +77,15 @@ class MemcacheClient(config.Parser):
     :param callable deserializer: function to convert strings returned from
         memcached to arbitrary objects, must be compatible with ``serializer``.
         An example is :py:func:`~baseplate.context.memcache.lib.decompress_and_load`.
+    :param bool coalesce: Whether to coalesce concurrent identical reads. See
+        :py:class:`MemcacheContextFactory`.
 
     """
 
-    def __init__(self, serializer=None, deserializer=None):
+    def __init__(self, serializer=None, deserializer=None, coalesce=False):
         self.serializer = serializer
         self.deserializer = deserializer
+        self.coalesce = coalesce
 
     def parse(self, key_path: str, raw_config: config.RawConfig) -> ContextFactory:
         pool = pool_from_config(
@@ -88,7 +94,7 @@ class MemcacheClient(config.Parser):
             serializer=self.serializer,
             deserializer=self.deserializer,
         )
-        return MemcacheContextFactory(pool)
+        return MemcacheContextFactory(pool, coalesce=self.coalesce)
 
 
 class MemcacheContextFactory(ContextFactory):
@@ -102,16 +108,23 @@ class MemcacheContextFactory(ContextFactory):
     record diagnostic information.
 
     :param pymemcache.client.base.PooledClient pooled_client: A pooled client.
+    :param bool coalesce: If true, ``get`` and ``get_many`` calls made while
+        an identical one is in flight in this process share its result rather
+        than making another request. Their spans are tagged ``coalesced``.
+        Each caller gets its own copy of the deserialized result.
 
     :returns: :py:class:`~baseplate.context.memcache.MonitoredMemcacheConnection`
 
     """
 
-    def __init__(self, pooled_client):
+    def __init__(self, pooled_client, coalesce=False):
         self.pooled_client = pooled_client
+        self.singleflight = SingleFlight() if coalesce else None
 
     def make_object_for_context(self, name, span):
-        return MonitoredMemcacheConnection(name, span, self.pooled_client)
+        return MonitoredMemcacheConnection(
+            name, span, self.pooled_client, singleflight=self.singleflight
+        )
 
 
 class MonitoredMemcacheConnection:
@@ -125,10 +138,11 @@ class MonitoredMemcacheConnection:
 
     """
 
-    def __init__(self, context_name, server_span, pooled_client):
+    def __init__(self, context_name, server_span, pooled_client, singleflight=None):
         self.context_name = context_name
         self.server_span = server_span
         self.pooled_client = pooled_client
+        self.singleflight = singleflight
 
     def close(self):
         with self._make_span("close"):
@@ -181,13 +195,17 @@ class MonitoredMemcacheConnection:
     def get(self, key, **kwargs):
         with self._make_span("get") as span:
             span.set_tag("key", key)
-            return self.pooled_client.get(key, **kwargs)
+            if kwargs:
+                return self.pooled_client.get(key, **kwargs)
+            return self._coalesce(span, ("get", key), lambda: self.pooled_client.get(key))
 
     def get_many(self, keys):
         with self._make_span("get_many") as span:
             span.set_tag("key_count", len(keys))
             span.set_tag("keys", make_keys_str(keys))
-            return self.pooled_client.get_many(keys)
+            return self._coalesce(
+                span, ("get_many", tuple(keys)), lambda: self.pooled_client.get_many(keys)
+            )
 
     def gets(self, key, **kwargs):
         with self._make_span("gets") as span:
@@ -253,6 +271,15 @@ class MonitoredMemcacheConnection:
         with self._make_span("quit"):
             return self.pooled_client.quit()
 
+    def _coalesce(self, span, key, function):
+        if self.singleflight is None:
+            return function()
+        result, shared = self.singleflight.do(key, function)
+        span.set_tag("coalesced", shared)
+        # the result may be shared with other callers, so nobody gets the
+        # original and the copies can't see each other's modifications.
+        return copy.deepcopy(result)
+
     def _make_span(self, method_name):
         """Get a child span of the current server span.
 
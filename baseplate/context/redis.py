@@ -5,6 +5,30 @@ import redis.client
 
 from baseplate import config, message_queue
 from baseplate.context import ContextFactory
+from baseplate.singleflight import SingleFlight
+
+# read-only commands whose results can be shared by identical calls
+_COALESCABLE_COMMANDS = frozenset(
+    (
+        "EXISTS",
+        "GET",
+        "HGET",
+        "HGETALL",
+        "HMGET",
+        "LLEN",
+        "LRANGE",
+        "MGET",
+        "PTTL",
+        "SCARD",
+        "SISMEMBER",
+        "SMEMBERS",
+        "STRLEN",
+        "TTL",
+        "TYPE",
+        "ZCARD",
+        "ZSCORE",
+    )
+)
 
 
 def pool_from_config(app_config, prefix="redis.", **kwargs):
@@ -55,14 +79,18 @@ class RedisClient(config.Parser):
 
     See :py:func:`pool_from_config` for available configurables.
 
+    :param bool coalesce: Whether to coalesce concurrent identical reads. See
+        :py:class:`RedisContextFactory`.
+
     """
 
-    def __init__(self, **kwargs):
+    def __init__(self, coalesce=False, **kwargs):
+        self.coalesce = coalesce
         self.kwargs = kwargs
 
     def parse(self, key_path: str, raw_config: config.RawConfig) -> ContextFactory:
         connection_pool = pool_from_config(raw_config, f"{key_path}.", **self.kwargs)
-        return RedisContextFactory(connection_pool)
+        return RedisContextFactory(connection_pool, coalesce=self.coalesce)
 
 
 class RedisContextFactory(ContextFactory):
@@ -76,16 +104,23 @@ class RedisContextFactory(ContextFactory):
     information.
 
     :param redis.ConnectionPool connection_pool: A connection pool.
+    :param bool coalesce: If true, read-only commands like ``GET`` and
+        ``HGETALL`` that are sent while an identical one is in flight in this
+        process share its result rather than making another request. Their
+        spans are tagged ``coalesced``. Shared results must not be modified.
 
     :returns: :py:class:`~baseplate.context.redis.MonitoredRedisConnection`
 
     """
 
-    def __init__(self, connection_pool):
+    def __init__(self, connection_pool, coalesce=False):
         self.connection_pool = connection_pool
+        self.singleflight = SingleFlight() if coalesce else None
 
     def make_object_for_context(self, name, span):
-        return MonitoredRedisConnection(name, span, self.connection_pool)
+        return MonitoredRedisConnection(
+            name, span, self.connection_pool, singleflight=self.singleflight
+        )
 
 
 # pylint: disable=too-many-public-methods
@@ -103,9 +138,10 @@ class MonitoredRedisConnection(redis.StrictRedis):
 
     """
 
-    def __init__(self, context_name, server_span, connection_pool):
+    def __init__(self, context_name, server_span, connection_pool, singleflight=None):
         self.context_name = context_name
         self.server_span = server_span
+        self.singleflight = singleflight
 
         super(MonitoredRedisConnection, self).__init__(connection_pool=connection_pool)
 
@@ -113,8 +149,20 @@ class MonitoredRedisConnection(redis.StrictRedis):
     def execute_command(self, command, *args, **kwargs):
         trace_name = "{}.{}".format(self.context_name, command)
 
-        with self.server_span.make_child(trace_name):
-            return super(MonitoredRedisConnection, self).execute_command(command, *args, **kwargs)
+        with self.server_span.make_child(trace_name) as span:
+            execute_command = super(MonitoredRedisConnection, self).execute_command
+            if (
+                self.singleflight is not None
+                and command in _COALESCABLE_COMMANDS
+                and not kwargs
+                and _is_hashable(args)
+            ):
+                result, shared = self.singleflight.do(
+                    (command,) + args, lambda: execute_command(command, *args)
+                )
+                span.set_tag("coalesced", shared)
+                return result
+            return execute_command(command, *args, **kwargs)
 
     # pylint: disable=arguments-differ
     def pipeline(self, name, transaction=True, shard_hint=None):
@@ -149,6 +197,14 @@ class MonitoredRedisConnection(redis.StrictRedis):
         raise NotImplementedError
 
 
+def _is_hashable(value):
+    try:
+        hash(value)
+    except TypeError:
+        return False
+    return True
+
+
 class MonitoredRedisPipeline(redis.client.StrictPipeline):
     def __init__(self, trace_name, server_span, connection_pool, response_callbacks, **kwargs):
         self.trace_name = trace_name
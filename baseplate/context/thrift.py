@@ -1,7 +1,15 @@
+import collections
 import contextlib
+import hashlib
 import inspect
+import queue
+import socket
 import sys
+import threading
+import time
 
+from thrift import TSerialization
+from thrift.protocol.TBinaryProtocol import TBinaryProtocolAcceleratedFactory
 from thrift.protocol.TProtocol import TProtocolException
 from thrift.Thrift import TApplicationException, TException
 from thrift.transport.TTransport import TTransportException
@@ -9,7 +17,12 @@ from thrift.transport.TTransport import TTransportException
 from baseplate import config
 from baseplate.context import ContextFactory
 from baseplate.retry import RetryPolicy
-from baseplate.thrift_pool import thrift_pool_from_config
+from baseplate.singleflight import SingleFlight
+from baseplate.thrift_pool import (
+    CircuitBreakerOpenError,
+    ConcurrencyLimitExceededError,
+    thrift_pool_from_config,
+)
 
 
 class ThriftClient(config.Parser):
@@ -23,16 +36,22 @@ class ThriftClient(config.Parser):
 
     :param client_cls: The class object of a Thrift-generated client class,
         e.g. ``YourService.Client``.
+    :param ResponseCache cache: If given, the results of some methods are
+        cached. See :py:class:`ThriftContextFactory`.
+    :param coalesce: The names of methods to coalesce concurrent identical
+        calls to. See :py:class:`ThriftContextFactory`.
 
     """
 
-    def __init__(self, client_cls, **kwargs):
+    def __init__(self, client_cls, cache=None, coalesce=(), **kwargs):
         self.client_cls = client_cls
+        self.cache = cache
+        self.coalesce = coalesce
         self.kwargs = kwargs
 
     def parse(self, key_path: str, raw_config: config.RawConfig) -> ContextFactory:
         pool = thrift_pool_from_config(raw_config, prefix=f"{key_path}.", **self.kwargs)
-        return ThriftContextFactory(pool, self.client_cls)
+        return ThriftContextFactory(pool, self.client_cls, cache=self.cache, coalesce=self.coalesce)
 
 
 class ThriftContextFactory(ContextFactory):
@@ -49,6 +68,13 @@ class ThriftContextFactory(ContextFactory):
     :param client_cls: The class object of a Thrift-generated client class,
         e.g. ``YourService.Client``.
 
+    :param HedgeBudget hedge_budget: The budget for hedged requests. Defaults
+        to one shared by all clients.
+    :param ResponseCache cache: If given, the results of the methods it lists
+        are cached.
+    :param coalesce: The names of methods whose concurrent calls with the
+        same arguments should be coalesced into one.
+
     The proxy object has a ``retrying`` method which takes the same parameters
     as :py:meth:`RetryPolicy.new <baseplate.retry.RetryPolicy.new>` and acts as
     a context manager. The context manager returns another proxy object where
@@ -58,24 +84,69 @@ class ThriftContextFactory(ContextFactory):
         with context.my_service.retrying(attempts=3) as svc:
             svc.some_method()
 
+    Similarly, the ``hedged`` method returns a proxy object where each call
+    sends a second request on another connection if the first hasn't returned
+    within ``delay`` seconds. With a
+    :py:class:`~baseplate.thrift_pool.BalancedThriftConnectionPool` the
+    connection is picked like any other, so it's usually to another backend
+    but may be to the same one. Whichever returns first is used and the other
+    is cancelled by closing its connection. If ``percentile`` is given, the
+    delay is that percentile of the latencies of the method's recent hedged
+    calls, once enough have been seen. Only use this for idempotent
+    methods::
+
+        with context.my_service.hedged(delay=0.05, percentile=95) as svc:
+            svc.some_read_method()
+
+    Hedged requests are limited by a :py:class:`HedgeBudget` so they can't add
+    more than a fraction of extra load.
+
+    Methods that always return the same result for the same arguments, like
+    ones that look up configuration, can have their results cached by passing
+    a :py:class:`ResponseCache`. Calls to them check the cache first, in a
+    span named ``{name}.{method}.cache`` tagged with whether it was a hit.
+
+    Calls to methods listed in ``coalesce`` that are made while an identical
+    call is already in flight in this process wait for its result rather
+    than making another request, using a
+    :py:class:`~baseplate.singleflight.SingleFlight`. The waiting call gets a
+    span tagged ``coalesced``. With a cache, this means only one call fills
+    each expired entry.
+
     """
 
-    def __init__(self, pool, client_cls):
+    # pylint: disable=too-many-arguments
+    def __init__(self, pool, client_cls, hedge_budget=None, cache=None, coalesce=()):
         self.pool = pool
         self.client_cls = client_cls
+        self.cache = cache
+        if cache is not None:
+            cache.bind(client_cls)
+        coalesced_args = {name: _find_call_structs(client_cls, name)[0] for name in coalesce}
+        methods = {
+            fn_name: _build_thrift_proxy_method(fn_name)
+            for fn_name in _enumerate_service_methods(client_cls)
+            if not (fn_name.startswith("__") and fn_name.endswith("__"))
+        }
         self.proxy_cls = type(
             "PooledClientProxy",
             (_PooledClientProxy,),
-            {
-                fn_name: _build_thrift_proxy_method(fn_name)
-                for fn_name in _enumerate_service_methods(client_cls)
-                if not (fn_name.startswith("__") and fn_name.endswith("__"))
-            },
+            dict(
+                methods,
+                hedge_budget=hedge_budget or _default_hedge_budget,
+                latencies=_LatencyTracker(),
+                cache=cache,
+                coalesced_args=coalesced_args,
+                singleflight=SingleFlight(),
+            ),
         )
 
     def report_runtime_metrics(self, batch):
         batch.gauge("pool.size").replace(self.pool.size)
         batch.gauge("pool.in_use").replace(self.pool.checkedout)
+        self.pool.report_runtime_metrics(batch)
+        if self.cache is not None:
+            self.cache.report_runtime_metrics(batch)
         # it's hard to report "open_and_available" currently because we can't
         # distinguish easily between available connection slots that aren't
         # instantiated and ones that have actual open connections.
@@ -103,16 +174,250 @@ def _enumerate_service_methods(client):
     assert ifaces_found > 0, "class is not a thrift client; it has no Iface"
 
 
+class HedgeBudget:
+    """A limit on how many hedged requests are sent.
+
+    Each hedged call adds ``ratio`` tokens to the budget, up to ``burst``, and
+    each extra request sent costs one token. This caps the extra load from
+    hedging at about ``ratio`` of hedged calls.
+
+    :param float ratio: The fraction of calls that may be hedged.
+    :param int burst: The most hedges that can be saved up.
+
+    """
+
+    def __init__(self, ratio=0.1, burst=10):
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = float(burst)
+        self.lock = threading.Lock()
+
+    def deposit(self):
+        """Add tokens for a hedged call."""
+        with self.lock:
+            self.tokens = min(self.tokens + self.ratio, self.burst)
+
+    def withdraw(self):
+        """Return if a hedged request may be sent, spending a token if so."""
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+_default_hedge_budget = HedgeBudget()
+
+
+_CALL_PROTOCOL_FACTORY = TBinaryProtocolAcceleratedFactory()
+
+
+def _find_call_structs(client_cls, name):
+    """Return the generated argument and result structs of a method."""
+    for base_cls in inspect.getmro(client_cls):
+        module = sys.modules[base_cls.__module__]
+        args_cls = getattr(module, name + "_args", None)
+        result_cls = getattr(module, name + "_result", None)
+        if args_cls is not None and result_cls is not None:
+            return args_cls, result_cls
+    raise ValueError("{!r} is not a method of {!r}".format(name, client_cls))
+
+
+def _make_call_key(args_cls, name, args, kwargs):
+    """Return a key that's the same for calls with the same arguments."""
+    struct = args_cls(*args, **kwargs)
+    return name.encode() + b":" + TSerialization.serialize(struct, _CALL_PROTOCOL_FACTORY)
+
+
+class ResponseCache:
+    """A cache of the results of Thrift methods.
+
+    Only successful results are cached, keyed on the method and its
+    arguments. Results are kept in a bounded, least-recently-used cache in
+    memory and, if ``memcache`` is given, in memcached where they can be
+    shared by other processes. Cached results are shared by all callers so
+    they must not be modified.
+
+    Keys in memcached are namespaced with the name of the Thrift service's
+    module so different services sharing a memcached don't collide. Results
+    are stored with the memcache client's serializer, which must be able to
+    handle the cached methods' return types, e.g.
+    :py:func:`~baseplate.context.memcache.lib.make_pickle_and_compress_fn`.
+
+    :param dict ttls: A mapping of the names of the methods to cache to how
+        many seconds to cache their results for.
+    :param int max_size: The most results to keep in memory.
+    :param pymemcache.client.base.PooledClient memcache: If given, results
+        are also stored in memcached.
+    :param str key_prefix: A further prefix for keys in memcached, e.g. to
+        keep services calling the same method with different backends apart.
+
+    """
+
+    def __init__(self, ttls, max_size=1000, memcache=None, key_prefix=""):
+        self.ttls = ttls
+        self.max_size = max_size
+        self.memcache = memcache
+        self.key_prefix = key_prefix
+        self.namespace = None
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.counts = collections.Counter()
+        self.structs = {}
+
+    def bind(self, client_cls):
+        """Find the argument and result types of the cached methods."""
+        self.namespace = client_cls.__module__
+        for name in self.ttls:
+            args_cls, result_cls = _find_call_structs(client_cls, name)
+            # structs only have __slots__ if generated with py:slots, but
+            # they always have a thrift_spec.
+            fields = [field for field in result_cls.thrift_spec if field is not None]
+            if not any(field[2] == "success" for field in fields):
+                raise ValueError("{!r} doesn't return anything to cache".format(name))
+            self.structs[name] = args_cls
+
+    def make_key(self, name, args, kwargs):
+        args_cls = self.structs[name]
+        return _make_call_key(args_cls, name, args, kwargs)
+
+    def _memcache_key(self, key):
+        return "{}{}:{}".format(self.key_prefix, self.namespace, hashlib.sha1(key).hexdigest())
+
+    def _memcache_connection(self, span):
+        # pymemcache is only needed if memcache is used
+        from baseplate.context.memcache import MonitoredMemcacheConnection
+
+        return MonitoredMemcacheConnection("cache.memcache", span, self.memcache)
+
+    def get(self, name, key, span):
+        """Return if the result was found and the result."""
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                expires_at, result = entry
+                if expires_at > now:
+                    self.entries.move_to_end(key)
+                    self.counts[name, "hit"] += 1
+                    return True, result
+                del self.entries[key]
+
+        if self.memcache is not None:
+            memcache = self._memcache_connection(span)
+            try:
+                result = memcache.get(self._memcache_key(key))
+            except Exception:  # pylint: disable=broad-except
+                # the backend can still answer
+                result = None
+
+            if result is not None:
+                self._store(name, key, result)
+                self.counts[name, "memcache_hit"] += 1
+                return True, result
+
+        self.counts[name, "miss"] += 1
+        return False, None
+
+    def set(self, name, key, result, span):
+        """Store the result of a call."""
+        self._store(name, key, result)
+
+        if self.memcache is not None:
+            memcache = self._memcache_connection(span)
+            # an expiry of 0 would be forever
+            expire = max(int(self.ttls[name]), 1)
+            try:
+                memcache.set(self._memcache_key(key), result, expire=expire, noreply=True)
+            except Exception:  # pylint: disable=broad-except
+                pass
+
+    def _store(self, name, key, result):
+        expires_at = time.monotonic() + self.ttls[name]
+        with self.lock:
+            self.entries[key] = (expires_at, result)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def report_runtime_metrics(self, batch):
+        """Report hits and misses for each method.
+
+        * ``cache.{method}.hit``: results found in memory.
+        * ``cache.{method}.memcache_hit``: results found in memcached.
+        * ``cache.{method}.miss``: calls made to the service.
+
+        """
+        counts, self.counts = self.counts, collections.Counter()
+        for (name, outcome), count in counts.items():
+            batch.counter("cache.{}.{}".format(name, outcome)).increment(count)
+
+
+class _LatencyTracker:
+    """Recent latencies of each method's calls, to pick hedging delays from."""
+
+    SAMPLES = 1000
+    # sorting the samples is expensive so percentiles are only recalculated
+    # after this many new ones.
+    RECALCULATE_EVERY = 100
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = collections.defaultdict(lambda: collections.deque(maxlen=self.SAMPLES))
+        self.added = collections.Counter()
+        self.sorted_samples = {}
+
+    def add(self, name, latency):
+        with self.lock:
+            self.samples[name].append(latency)
+            self.added[name] += 1
+
+    def percentile(self, name, percentile):
+        """Return the percentile of the method's recent latencies, if known."""
+        with self.lock:
+            sorted_samples = self.sorted_samples.get(name)
+            if sorted_samples is None or self.added[name] >= self.RECALCULATE_EVERY:
+                samples = self.samples.get(name)
+                if not samples or len(samples) < self.RECALCULATE_EVERY:
+                    return None
+                sorted_samples = sorted(samples)
+                self.sorted_samples[name] = sorted_samples
+                self.added[name] = 0
+
+        index = min(int(len(sorted_samples) * percentile / 100), len(sorted_samples) - 1)
+        return sorted_samples[index]
+
+
+class _HedgePolicy:
+    def __init__(self, delay, percentile):
+        self.delay = delay
+        self.percentile = percentile
+
+
+# policies don't hold any state between uses so this can be shared
+_DEFAULT_RETRY_POLICY = RetryPolicy.new(attempts=1)
+
+
 class _PooledClientProxy:
     """A proxy which acts like a thrift client but uses a connection pool."""
 
+    # set per service by ThriftContextFactory
+    hedge_budget = None
+    latencies = None
+    cache = None
+    coalesced_args = {}
+    singleflight = None
+
     # pylint: disable=too-many-arguments
-    def __init__(self, client_cls, pool, server_span, namespace, retry_policy=None):
+    def __init__(
+        self, client_cls, pool, server_span, namespace, retry_policy=None, hedge_policy=None
+    ):
         self.client_cls = client_cls
         self.pool = pool
         self.server_span = server_span
         self.namespace = namespace
-        self.retry_policy = retry_policy or RetryPolicy.new(attempts=1)
+        self.retry_policy = retry_policy or _DEFAULT_RETRY_POLICY
+        self.hedge_policy = hedge_policy
 
     @contextlib.contextmanager
     def retrying(self, **policy):
@@ -122,67 +427,264 @@ class _PooledClientProxy:
             self.server_span,
             self.namespace,
             retry_policy=RetryPolicy.new(**policy),
+            hedge_policy=self.hedge_policy,
         )
 
+    @contextlib.contextmanager
+    def hedged(self, delay, percentile=None):
+        yield self.__class__(
+            self.client_cls,
+            self.pool,
+            self.server_span,
+            self.namespace,
+            retry_policy=self.retry_policy,
+            hedge_policy=_HedgePolicy(delay, percentile),
+        )
 
-def _build_thrift_proxy_method(name):
-    def _call_thrift_method(self, *args, **kwargs):
-        trace_name = "{}.{}".format(self.namespace, name)
-        last_error = None
 
-        for _ in self.retry_policy:
-            span = self.server_span.make_child(trace_name)
-            span.start()
+def _call_once(proxy, name, trace_name, args, kwargs, attempt=None):
+    span = proxy.server_span.make_child(trace_name)
+    span.start()
+    if attempt is not None:
+        attempt.span = span
+        if attempt.is_hedge:
+            span.set_tag("hedge", True)
+
+    start_time = time.monotonic()
+    completed = False
+    try:
+        with proxy.pool.connection() as prot:
+            # how long the call waited for a connection, to tell a starved
+            # pool from a slow service.
+            acquire_time = getattr(prot, "baseplate_acquire_time", None)
+            if acquire_time is not None:
+                span.set_tag("pool.acquire_time", acquire_time)
+            if attempt is not None:
+                attempt.set_connection(prot)
 
             try:
-                with self.pool.connection() as prot:
-                    prot.trans.set_header(b"Trace", str(span.trace_id).encode())
-                    prot.trans.set_header(b"Parent", str(span.parent_id).encode())
-                    prot.trans.set_header(b"Span", str(span.id).encode())
-                    if span.sampled is not None:
-                        sampled = "1" if span.sampled else "0"
-                        prot.trans.set_header(b"Sampled", sampled.encode())
-                    if span.flags:
-                        prot.trans.set_header(b"Flags", str(span.flags).encode())
-
-                    try:
-                        edge_context = span.context.raw_request_context
-                    except AttributeError:
-                        edge_context = None
-
-                    if edge_context:
-                        prot.trans.set_header(b"Edge-Request", edge_context)
-
-                    client = self.client_cls(prot)
-                    method = getattr(client, name)
-                    result = method(*args, **kwargs)
-            except TTransportException as exc:
-                # the connection failed for some reason, retry if able
-                span.finish(exc_info=sys.exc_info())
-                last_error = exc
-                continue
-            except (TApplicationException, TProtocolException):
-                # these are subclasses of TException but aren't ones that
-                # should be expected in the protocol. this is an error!
-                span.finish(exc_info=sys.exc_info())
-                raise
-            except TException:
-                # this is an expected exception, as defined in the IDL
-                span.finish()
-                raise
-            except:  # noqa: E722
-                # something unexpected happened
-                span.finish(exc_info=sys.exc_info())
-                raise
-            else:
-                # a normal result
-                span.finish()
-                return result
-
-        raise TTransportException(
-            type=TTransportException.TIMED_OUT,
-            message="retry policy exhausted while attempting {}.{}, "
-            "last error was: {}".format(self.namespace, name, last_error),
+                set_header = prot.trans.set_header
+                set_header(b"Trace", b"%d" % span.trace_id)
+                set_header(b"Parent", b"%d" % span.parent_id)
+                set_header(b"Span", b"%d" % span.id)
+                if span.sampled is not None:
+                    set_header(b"Sampled", b"1" if span.sampled else b"0")
+                if span.flags:
+                    set_header(b"Flags", b"%d" % span.flags)
+
+                edge_context = getattr(span.context, "raw_request_context", None)
+                if edge_context:
+                    set_header(b"Edge-Request", edge_context)
+
+                # clients only hold on to the protocol, so they can be reused
+                # for as long as the connection is.
+                client = getattr(prot, "baseplate_client", None)
+                if client is None or client.__class__ is not proxy.client_cls:
+                    client = proxy.client_cls(prot)
+                    prot.baseplate_client = client
+                result = getattr(client, name)(*args, **kwargs)
+            finally:
+                if attempt is not None:
+                    # the connection is about to go back to the pool, it must
+                    # not be cancelled after this.
+                    attempt.set_connection(None)
+    except TTransportException:
+        # the connection failed for some reason, retry if able
+        span.finish(exc_info=sys.exc_info())
+        raise
+    except (TApplicationException, TProtocolException):
+        # these are subclasses of TException but aren't ones that
+        # should be expected in the protocol. this is an error!
+        span.finish(exc_info=sys.exc_info())
+        raise
+    except TException:
+        # this is an expected exception, as defined in the IDL
+        completed = True
+        span.finish()
+        raise
+    except:  # noqa: E722
+        # something unexpected happened
+        span.finish(exc_info=sys.exc_info())
+        raise
+    else:
+        # a normal result
+        completed = True
+        span.finish()
+        return result
+    finally:
+        # latencies are only needed to pick hedging delays, so calls that
+        # can't be hedged don't take the tracker's lock. an attempt that lost
+        # a hedged call would have taken at least as long as it ran. leaving
+        # it out would drag the percentiles down.
+        if proxy.hedge_policy is not None and (
+            completed or (attempt is not None and attempt.cancelled)
+        ):
+            proxy.latencies.add(name, time.monotonic() - start_time)
+
+
+class _HedgeAttempt:
+    """One of the requests made for a hedged call, run in its own thread."""
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, proxy, name, trace_name, args, kwargs, results, is_hedge):
+        self.is_hedge = is_hedge
+        self.lock = threading.Lock()
+        self.span = None
+        self.prot = None
+        self.cancelled = False
+        self.thread = threading.Thread(
+            target=self._run, args=(proxy, name, trace_name, args, kwargs, results)
         )
+        self.thread.daemon = True
+        self.thread.start()
+
+    # pylint: disable=too-many-arguments
+    def _run(self, proxy, name, trace_name, args, kwargs, results):
+        try:
+            result = _call_once(proxy, name, trace_name, args, kwargs, attempt=self)
+        except Exception:  # pylint: disable=broad-except
+            results.put((self, False, sys.exc_info()))
+        else:
+            results.put((self, True, result))
+
+    def set_connection(self, prot):
+        with self.lock:
+            self.prot = prot
+            if prot is not None and self.cancelled:
+                _abort_connection(prot)
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            if self.prot is not None:
+                self.span.set_tag("hedge.cancelled", True)
+                _abort_connection(self.prot)
+
+
+def _abort_connection(prot):
+    # the pool won't count this against the backend and will throw the
+    # connection away when the request fails.
+    prot.baseplate_cancelled = True
+    trans = getattr(prot.trans, "_transport", prot.trans)
+    handle = getattr(trans, "handle", None)
+    if handle is not None:
+        # closing the socket doesn't interrupt a blocked read in another
+        # (real) thread, shutting it down does.
+        try:
+            handle.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    prot.trans.close()
+
+
+def _call_hedged(proxy, name, trace_name, args, kwargs):
+    hedge_policy = proxy.hedge_policy
+    delay = hedge_policy.delay
+    if hedge_policy.percentile is not None:
+        delay = proxy.latencies.percentile(name, hedge_policy.percentile) or delay
+    proxy.hedge_budget.deposit()
+
+    results = queue.Queue()
+    attempts = [_HedgeAttempt(proxy, name, trace_name, args, kwargs, results, is_hedge=False)]
+    try:
+        try:
+            _, succeeded, value = results.get(timeout=delay)
+        except queue.Empty:
+            if proxy.hedge_budget.withdraw():
+                attempts.append(
+                    _HedgeAttempt(proxy, name, trace_name, args, kwargs, results, is_hedge=True)
+                )
+            _, succeeded, value = results.get()
+
+        # if the first to finish failed, give the other a chance
+        if not succeeded and len(attempts) > 1:
+            _, succeeded, value = results.get()
+    finally:
+        # cancelling attempts that already finished does nothing
+        for attempt in attempts:
+            attempt.cancel()
+
+    if succeeded:
+        return value
+
+    _, exc, traceback = value
+    raise exc.with_traceback(traceback)
+
+
+def _build_thrift_proxy_method(name):
+    # the proxy's namespace is the same for every call in practice, so the
+    # trace name only needs to be made once.
+    trace_names = {}
+
+    def _call_thrift_method(self, *args, **kwargs):
+        trace_name = trace_names.get(self.namespace)
+        if trace_name is None:
+            trace_name = trace_names[self.namespace] = "{}.{}".format(self.namespace, name)
+
+        if self.cache is not None and name in self.cache.ttls:
+            return _call_cached(self, name, trace_name, args, kwargs)
+
+        args_cls = self.coalesced_args.get(name)
+        if args_cls is not None:
+            key = _make_call_key(args_cls, name, args, kwargs)
+            return _coalesce(
+                self, trace_name, key, lambda: _call_uncached(self, name, trace_name, args, kwargs)
+            )
+
+        return _call_uncached(self, name, trace_name, args, kwargs)
 
     return _call_thrift_method
+
+
+def _coalesce(proxy, trace_name, key, function):
+    @contextlib.contextmanager
+    def wait_context():
+        with proxy.server_span.make_child(trace_name) as span:
+            span.set_tag("coalesced", True)
+            yield
+
+    result, _ = proxy.singleflight.do(key, function, wait_context)
+    return result
+
+
+def _call_cached(proxy, name, trace_name, args, kwargs):
+    cache = proxy.cache
+    key = cache.make_key(name, args, kwargs)
+
+    span = proxy.server_span.make_child(trace_name + ".cache")
+    with span:
+        found, result = cache.get(name, key, span)
+        span.set_tag("hit", found)
+    if found:
+        return result
+
+    def fill():
+        result = _call_uncached(proxy, name, trace_name, args, kwargs)
+        cache.set(name, key, result, proxy.server_span)
+        return result
+
+    if name in proxy.coalesced_args:
+        return _coalesce(proxy, trace_name, key, fill)
+    return fill()
+
+
+def _call_uncached(proxy, name, trace_name, args, kwargs):
+    last_error = None
+
+    for _ in proxy.retry_policy:
+        try:
+            if proxy.hedge_policy is not None:
+                return _call_hedged(proxy, name, trace_name, args, kwargs)
+            return _call_once(proxy, name, trace_name, args, kwargs)
+        except (CircuitBreakerOpenError, ConcurrencyLimitExceededError):
+            # the pool would refuse a retry too, fail fast instead.
+            raise
+        except TTransportException as exc:
+            last_error = exc
+            continue
+
+    raise TTransportException(
+        type=TTransportException.TIMED_OUT,
+        message="retry policy exhausted while attempting {}.{}, "
+        "last error was: {}".format(proxy.namespace, name, last_error),
+    )
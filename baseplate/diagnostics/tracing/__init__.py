@@ -13,7 +13,7 @@ from datetime import datetime
 import requests
 from requests.exceptions import RequestException
 
-from baseplate.message_queue import MessageQueue, TimedOutError
+from baseplate.message_queue import make_queue, TimedOutError
 from baseplate.core import BaseplateObserver, LocalSpan, SpanObserver
 from baseplate._utils import warn_deprecated
 
@@ -59,6 +59,7 @@ def make_client(
     service_name,
     tracing_endpoint=None,
     tracing_queue_name=None,
+    tracing_queue_type="posix",
     max_span_queue_size=50000,
     num_span_workers=5,
     span_batch_interval=0.5,
@@ -75,6 +76,8 @@ def make_client(
     :param baseplate.config.EndpointConfiguration tracing_endpoint: destination
         to record span data.
     :param str tracing_queue_name: POSIX queue name for reporting spans.
+    :param str tracing_queue_type: The kind of message queue to report spans
+        to, see :py:func:`~baseplate.message_queue.make_queue`.
     :param int num_conns: pool size for remote recorder connection pool.
     :param int max_span_queue_size: span processing queue limit.
     :param int num_span_workers: number of worker threads for span processing.
@@ -83,7 +86,7 @@ def make_client(
         for.
     """
     if tracing_queue_name:
-        recorder = SidecarRecorder(tracing_queue_name)
+        recorder = SidecarRecorder(tracing_queue_name, queue_type=tracing_queue_type)
     elif tracing_endpoint:
         warn_deprecated("In-app trace publishing is deprecated in favor of the sidecar model.")
         remote_addr = "%s:%s" % tracing_endpoint.address
@@ -463,11 +466,13 @@ class SidecarRecorder:
     adding them to the queue.
     """
 
-    def __init__(self, queue_name):
-        self.queue = MessageQueue(
-            "/traces-" + queue_name,
+    def __init__(self, queue_name, queue_type="posix"):
+        self.queue_name = "/traces-" + queue_name
+        self.queue = make_queue(
+            self.queue_name,
             max_messages=MAX_SIDECAR_QUEUE_SIZE,
             max_message_size=MAX_SIDECAR_MESSAGE_SIZE,
+            queue_type=queue_type,
         )
 
     def send(self, span):
@@ -479,11 +484,11 @@ class SidecarRecorder:
                 "Trace too big. Traces published to %s are not allowed to be larger "
                 "than %d bytes. Received trace is %d bytes. This can be caused by "
                 "an excess amount of tags or a large amount of child spans.",
-                self.queue.queue.name,
+                self.queue_name,
                 MAX_SIDECAR_MESSAGE_SIZE,
                 len(serialized_str),
             )
         try:
             self.queue.put(serialized_str, timeout=0)
         except TimedOutError:
-            logger.error("Trace queue %s is full. Is trace sidecar healthy?", self.queue.queue.name)
+            logger.error("Trace queue %s is full. Is trace sidecar healthy?", self.queue_name)
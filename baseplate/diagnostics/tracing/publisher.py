@@ -7,7 +7,7 @@ import requests
 
 from baseplate import config, metrics_client_from_config
 from baseplate.diagnostics.tracing import MAX_SPAN_SIZE, MAX_QUEUE_SIZE
-from baseplate.message_queue import MessageQueue, TimedOutError
+from baseplate.message_queue import make_queue, TimedOutError
 from baseplate.retry import RetryPolicy
 from baseplate._utils import BatchFull, RawJSONBatch, TimeLimitedBatch
 
@@ -22,6 +22,8 @@ MAX_BATCH_SIZE_DEFAULT = 500 * 1024
 # maximum time (seconds) a traces can sit around while we wait for more
 # messages to batch
 MAX_BATCH_AGE = 1
+# maximum number of messages to drain from the queue per wakeup
+MAX_MESSAGES_PER_READ = 100
 
 # maximum number of retries when publishing traces
 RETRY_LIMIT_DEFAULT = 10
@@ -142,14 +144,18 @@ def publish_traces():
             "post_timeout": config.Optional(config.Integer, POST_TIMEOUT_DEFAULT),
             "max_batch_size": config.Optional(config.Integer, MAX_BATCH_SIZE_DEFAULT),
             "retry_limit": config.Optional(config.Integer, RETRY_LIMIT_DEFAULT),
+            "queue_type": config.Optional(config.OneOf(posix="posix", shm="shm"), "posix"),
         },
     )
 
-    trace_queue = MessageQueue(
-        "/traces-" + args.queue_name, max_messages=MAX_QUEUE_SIZE, max_message_size=MAX_SPAN_SIZE
+    # pylint: disable=maybe-no-member
+    trace_queue = make_queue(
+        "/traces-" + args.queue_name,
+        max_messages=MAX_QUEUE_SIZE,
+        max_message_size=MAX_SPAN_SIZE,
+        queue_type=publisher_cfg.queue_type,
     )
 
-    # pylint: disable=maybe-no-member
     inner_batch = TraceBatch(max_size=publisher_cfg.max_batch_size)
     batcher = TimeLimitedBatch(inner_batch, MAX_BATCH_AGE)
     metrics_client = metrics_client_from_config(publisher_raw_cfg)
@@ -161,17 +167,18 @@ def publish_traces():
 
     while True:
         try:
-            message = trace_queue.get(timeout=0.2)
+            messages = trace_queue.get_many(MAX_MESSAGES_PER_READ, timeout=0.2)
         except TimedOutError:
-            message = None
+            messages = [None]
 
-        try:
-            batcher.add(message)
-        except BatchFull:
-            serialized = batcher.serialize()
-            publisher.publish(serialized)
-            batcher.reset()
-            batcher.add(message)
+        for message in messages:
+            try:
+                batcher.add(message)
+            except BatchFull:
+                serialized = batcher.serialize()
+                publisher.publish(serialized)
+                batcher.reset()
+                batcher.add(message)
 
 
 if __name__ == "__main__":
@@ -7,8 +7,12 @@ from baseplate.events.queue import (
     EventTooLargeError,
     EventLogger,
     FieldKind,
+    json_dumps_orjson,
+    json_dumps_stdlib,
     serialize_v1_event,
     serialize_v2_event,
+    serialize_v2_event_binary,
+    serialize_v2_event_compact,
 )
 
 __all__ = [
@@ -20,6 +24,10 @@ __all__ = [
     "EventTooLargeError",
     "EventLogger",
     "FieldKind",
+    "json_dumps_orjson",
+    "json_dumps_stdlib",
     "serialize_v1_event",
     "serialize_v2_event",
+    "serialize_v2_event_binary",
+    "serialize_v2_event_compact",
 ]
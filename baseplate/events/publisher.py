@@ -1,21 +1,39 @@
 import argparse
 import configparser
 import email.utils
-import gzip
 import hashlib
 import hmac
+import itertools
 import logging
-
-from io import BytesIO
+import queue
+import signal
+import struct
+import threading
+import time
+import urllib.parse
+import zlib
 
 import requests
 
+from thrift.protocol.TCompactProtocol import CompactType
+from thrift.Thrift import TType
+
 from baseplate import config, metrics_client_from_config
-from baseplate.events.queue import MAX_EVENT_SIZE, MAX_QUEUE_SIZE
-from baseplate.message_queue import MessageQueue, TimedOutError
+from baseplate.events.queue import MAX_EVENT_SIZE, MAX_QUEUE_SIZE, unpack_events
+from baseplate.message_queue import make_queue, TimedOutError
 from baseplate.retry import RetryPolicy
 from baseplate._utils import Batch, BatchFull, RawJSONBatch, SerializedBatch, TimeLimitedBatch
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 
 logger = logging.getLogger(__name__)
 
@@ -31,6 +49,12 @@ MAX_RETRY_TIME = 5 * 60
 MAX_BATCH_AGE = 1
 # maximum size (in bytes) of a batch of events
 MAX_BATCH_SIZE = 500 * 1024
+# maximum number of messages to drain from the queue per wakeup
+MAX_MESSAGES_PER_READ = 100
+# how often (seconds) to check on the workers while waiting for one to free up
+WORKER_CHECK_INTERVAL = 1
+# handed to a worker to tell it to stop once the batches before it are sent
+_STOP_WORKER = object()
 
 
 class MaxRetriesError(Exception):
@@ -38,63 +62,281 @@ class MaxRetriesError(Exception):
 
 
 class V1Batch(RawJSONBatch):
+    # items may hold several comma-joined events packed by EventQueue.put_many
+    # so we have to count events separately from items.
+    content_type = "application/json"
+
     def __init__(self, max_size=MAX_BATCH_SIZE):
         super(V1Batch, self).__init__(max_size)
 
+    def add(self, item):
+        if not item:
+            return
+
+        count, item = unpack_events(item)
+        super(V1Batch, self).add(item)
+        self._count += count
+
+    def serialize(self):
+        return SerializedBatch(count=self._count, bytes=super(V1Batch, self).serialize().bytes)
+
+    def reset(self):
+        super(V1Batch, self).reset()
+        self._count = 0
+
+
+class V2Framing:
+    """How a V2 batch's list of events is framed for a Thrift protocol.
+
+    V2 batches are a struct with a single field of list<Event> type. because
+    we don't have the individual event schemas here, but pre-serialized
+    individual events instead, we write the struct and list headers manually.
+
+    """
+
+    # the content type of batches in this protocol
+    content_type = None
+    # the most bytes the struct and list header can take up
+    max_header_size = 0
+    # what goes between events in the list
+    separator = b""
+    # what closes the list and struct
+    end = b""
+
+    def header(self, count):
+        raise NotImplementedError
+
+
+class JSONFraming(V2Framing):
+    # mimics TJSONProtocol's container format
+    content_type = "application/json"
+    max_header_size = len('{"1":{"lst":["rec",') + 10 + 1
+    separator = b","
+    end = b"]}}"
+
+    def header(self, count):
+        return b'{"1":{"lst":["rec",%d,' % count
+
+
+class BinaryFraming(V2Framing):
+    content_type = "application/vnd.apache.thrift.binary"
+    max_header_size = 8
+    end = b"\x00"  # STOP
+
+    _header = struct.Struct("!bhbi")
+
+    def header(self, count):
+        return self._header.pack(TType.LIST, 1, TType.STRUCT, count)
+
+
+class CompactFraming(V2Framing):
+    content_type = "application/vnd.apache.thrift.compact"
+    max_header_size = 7  # field header, list header and 5 byte varint
+    end = b"\x00"  # STOP
+
+    # field 1 (as a delta from 0) of list type
+    _field_header = bytes([1 << 4 | CompactType.LIST])
+
+    def header(self, count):
+        if count < 15:
+            return self._field_header + bytes([count << 4 | CompactType.STRUCT])
+
+        header = bytearray(self._field_header)
+        header.append(0xF0 | CompactType.STRUCT)
+        while count > 0x7F:
+            header.append(count & 0x7F | 0x80)
+            count >>= 7
+        header.append(count)
+        return bytes(header)
+
+
+V2_FRAMINGS = {"json": JSONFraming(), "binary": BinaryFraming(), "compact": CompactFraming()}
+
+
+def _has_exports(buffer):
+    # a bytearray can't be resized while there are memoryviews of it alive,
+    # which tells us if a serialized batch is still using the buffer.
+    try:
+        buffer.append(0)
+    except BufferError:
+        return True
+    buffer.pop()
+    return False
+
 
 class V2Batch(Batch):
-    # V2 batches are a struct with a single field of list<Event> type. because
-    # we don't have the individual event schemas here, but pre-serialized
-    # individual events instead, we mimic TJSONProtocol's container format
-    # manually here.
+    # events are written straight into a preallocated buffer, leaving room in
+    # front of them for the header, which is written in once the number of
+    # events is known. the batch is serialized to a memoryview of the buffer
+    # so it can be signed and compressed without copying it.
     #
-    # the format string in this header is for the length field. it should be
-    # kept a similar number of bytes to the output of the formatting so the
-    # initial size estimate is OK. 4 digits should be plenty.
-    _header = '{"1":{"lst":["rec",%01d,'
-    _end = b"]}}"
-
-    def __init__(self, max_size=MAX_BATCH_SIZE):
+    # the serialized batch is only valid until the buffer is reused, so
+    # buffers still referenced by serialized batches (e.g. ones in flight in
+    # other threads) are set aside and a free one is used instead.
+    def __init__(self, max_size=MAX_BATCH_SIZE, protocol="json"):
         self.max_size = max_size
+        self.framing = V2_FRAMINGS[protocol]
+        self.content_type = self.framing.content_type
+        self._buffers = []
+        self._buffer = None
         self.reset()
 
     def add(self, item):
         if not item:
             return
 
-        serialized_size = len(item) + 1  # the comma at the end
+        count, item = unpack_events(item)
+        separator = self.framing.separator if self._count else b""
+        start = self._position + len(separator)
+        end = start + len(item)
 
-        if self._size + serialized_size > self.max_size:
+        # the space reserved for the header counts against the size limit
+        if end + len(self.framing.end) > self.max_size:
             raise BatchFull
 
-        self._items.append(item)
-        self._size += serialized_size
+        self._buffer[self._position : start] = separator
+        self._buffer[start:end] = item
+        self._position = end
+        self._count += count
 
     def serialize(self):
-        header = (self._header % len(self._items)).encode()
-        return SerializedBatch(
-            count=len(self._items), bytes=header + b",".join(self._items) + self._end
-        )
+        header = self.framing.header(self._count)
+        start = self.framing.max_header_size - len(header)
+        self._buffer[start : self.framing.max_header_size] = header
+
+        end = self._position + len(self.framing.end)
+        self._buffer[self._position : end] = self.framing.end
+        return SerializedBatch(count=self._count, bytes=memoryview(self._buffer)[start:end])
 
     def reset(self):
-        self._items = []
-        self._size = len(self._header) + len(self._end)
+        if self._buffer is None or _has_exports(self._buffer):
+            if self._buffer is not None:
+                self._buffers.append(self._buffer)
+            self._buffer = self._take_free_buffer()
+        self._position = self.framing.max_header_size
+        self._count = 0
+
+    def _take_free_buffer(self):
+        for i, buffer in enumerate(self._buffers):
+            if not _has_exports(buffer):
+                return self._buffers.pop(i)
+        return bytearray(self.max_size)
+
+
+class Compressor:
+    """Compresses batches before they're sent to the collector."""
+
+    # the Content-Encoding of payloads produced by this compressor
+    content_encoding = None
+    # if true, only use this compressor once the collector has advertised
+    # support for it with an Accept-Encoding response header (RFC 7694)
+    requires_negotiation = False
+
+    def compress(self, content):
+        raise NotImplementedError
+
+
+class ZlibCompressor(Compressor):
+    # compression objects are expensive to set up, so we set one up once and
+    # copy it for each batch instead.
+    def __init__(self, level, wbits, content_encoding):
+        if not 1 <= level <= 9:
+            raise ValueError("compression level must be between 1 and 9")
+        self._template = zlib.compressobj(level, zlib.DEFLATED, wbits)
+        self.content_encoding = content_encoding
+
+    def compress(self, content):
+        compressor = self._template.copy()
+        return compressor.compress(content) + compressor.flush()
+
+
+class GzipCompressor(ZlibCompressor):
+    def __init__(self, level=9):
+        super(GzipCompressor, self).__init__(
+            level, wbits=16 + zlib.MAX_WBITS, content_encoding="gzip"
+        )
+
+
+class DeflateCompressor(ZlibCompressor):
+    def __init__(self, level=6):
+        super(DeflateCompressor, self).__init__(
+            level, wbits=zlib.MAX_WBITS, content_encoding="deflate"
+        )
+
+
+class ZstdCompressor(Compressor):
+    content_encoding = "zstd"
+    requires_negotiation = True
+
+    def __init__(self, level=3):
+        if zstandard is None:
+            raise ValueError("the zstandard package is required for zstd compression")
+        self._compressor = zstandard.ZstdCompressor(level=level)
+
+    def compress(self, content):
+        return self._compressor.compress(content)
+
+
+class BrotliCompressor(Compressor):
+    content_encoding = "br"
+    requires_negotiation = True
+
+    def __init__(self, level=5):
+        if brotli is None:
+            raise ValueError("the brotli package is required for br compression")
+        self.level = level
+
+    def compress(self, content):
+        return brotli.compress(content, quality=self.level)
+
+
+COMPRESSORS = {
+    "gzip": GzipCompressor,
+    "deflate": DeflateCompressor,
+    "zstd": ZstdCompressor,
+    "br": BrotliCompressor,
+}
+
+
+def make_compressor(codec, level=None):
+    """Make a compressor for the named codec and compression level.
+
+    If the level is not specified, the codec's default is used.
+
+    """
+    compressor_cls = COMPRESSORS[codec]
+    if level is None:
+        return compressor_cls()
+    return compressor_cls(level)
+
+
+# gzip is understood by every collector so it's what we fall back to
+_DEFAULT_COMPRESSOR = GzipCompressor(level=9)
 
 
 def gzip_compress(content):
-    buf = BytesIO()
-    with gzip.GzipFile(fileobj=buf, mode="wb", compresslevel=9) as gzip_file:
-        gzip_file.write(content)
-    return buf.getvalue()
+    return _DEFAULT_COMPRESSOR.compress(content)
 
 
 class BatchPublisher:
-    def __init__(self, metrics_client, cfg):
+    def __init__(
+        self,
+        metrics_client,
+        cfg,
+        compressor=_DEFAULT_COMPRESSOR,
+        num_conns=1,
+        content_type="application/json",
+    ):
         self.metrics = metrics_client
         self.url = "https://%s/v%d" % (cfg.collector.hostname, cfg.collector.version)
         self.key_name = cfg.key.name
         self.key_secret = cfg.key.secret
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=num_conns)
         self.session = requests.Session()
+        self.session.mount("{}://".format(urllib.parse.urlparse(self.url).scheme), adapter)
+        self.compressor = compressor
+        self.content_type = content_type
+        self.collector_accepts_compressor = not compressor.requires_negotiation
 
     def _sign_payload(self, payload):
         digest = hmac.new(self.key_secret, payload, hashlib.sha256).hexdigest()
@@ -105,16 +347,22 @@ class BatchPublisher:
             return
 
         logger.info("sending batch of %d events", payload.count)
-        compressed_payload = gzip_compress(payload.bytes)
         headers = {
             "Date": email.utils.formatdate(usegmt=True),
             "User-Agent": "baseplate-event-publisher/1.0",
-            "Content-Type": "application/json",
+            "Content-Type": self.content_type,
             "X-Signature": self._sign_payload(payload.bytes),
-            "Content-Encoding": "gzip",
         }
+        compressor = None
 
         for _ in RetryPolicy.new(budget=MAX_RETRY_TIME, backoff=RETRY_BACKOFF):
+            wanted_compressor = self._choose_compressor()
+            if compressor is not wanted_compressor:
+                compressor = wanted_compressor
+                with self.metrics.timer("compress"):
+                    compressed_payload = compressor.compress(payload.bytes)
+                headers["Content-Encoding"] = compressor.content_encoding
+
             try:
                 with self.metrics.timer("post"):
                     response = self.session.post(
@@ -125,12 +373,24 @@ class BatchPublisher:
                         # http://docs.python-requests.org/en/latest/user/advanced/#keep-alive
                         stream=False,
                     )
+                self._check_accepted_encodings(response)
                 response.raise_for_status()
             except requests.HTTPError as exc:
                 self.metrics.counter("error.http").increment()
 
-                # we should crash if it's our fault
                 response = getattr(exc, "response", None)
+                if (
+                    response is not None
+                    and response.status_code == 415
+                    and compressor is not _DEFAULT_COMPRESSOR
+                ):
+                    # the collector stopped accepting our encoding, go back
+                    # to the one every collector understands.
+                    logger.warning("Collector rejected %s encoding.", compressor.content_encoding)
+                    self.collector_accepts_compressor = False
+                    continue
+
+                # we should crash if it's our fault
                 if response is not None and response.status_code < 500:
                     logger.exception("HTTP Request failed. Error: %s", response.text)
                     raise
@@ -144,6 +404,152 @@ class BatchPublisher:
 
         raise MaxRetriesError("could not sent batch")
 
+    def _choose_compressor(self):
+        if self.collector_accepts_compressor:
+            return self.compressor
+        return _DEFAULT_COMPRESSOR
+
+    def _check_accepted_encodings(self, response):
+        if not self.compressor.requires_negotiation:
+            return
+
+        accepted = response.headers.get("Accept-Encoding")
+        if accepted is None:
+            return
+
+        encodings = {encoding.split(";")[0].strip().lower() for encoding in accepted.split(",")}
+        self.collector_accepts_compressor = self.compressor.content_encoding in encodings
+
+
+class ConcurrentBatchPublisher:
+    """Keep several batches in flight to the collector at once.
+
+    Batches are handed off to a pool of worker threads which share the
+    publisher's connection pool. At most ``max_in_flight`` batches are being
+    sent and ``max_in_flight`` more are waiting for a worker at any time;
+    beyond that :py:meth:`submit` blocks, which stops the publisher reading
+    from the event queue and lets it fill up until producers see
+    :py:exc:`~baseplate.events.EventQueueFullError`.
+
+    Batches may be delivered out of order when ``max_in_flight`` is more than
+    one, but their ``batch.lag`` and ``batch.latency`` timers are reported in
+    the order the batches were submitted. Call :py:meth:`close` to wait for
+    the submitted batches to be sent and stop the workers.
+
+    """
+
+    def __init__(self, publisher, metrics_client, max_in_flight=1):
+        if max_in_flight < 1:
+            raise ValueError("max_in_flight must be at least 1")
+
+        self.publisher = publisher
+        self.metrics = metrics_client
+        self.pending = queue.Queue(maxsize=max_in_flight)
+        self.in_flight = 0
+        self.in_flight_lock = threading.Lock()
+        self.error = None
+
+        # timings of batches that finished before an earlier batch did, held
+        # until they can be reported in order.
+        self.sequence = itertools.count()
+        self.next_to_report = 0
+        self.finished = {}
+
+        self.workers = []
+        for i in range(max_in_flight):
+            worker = threading.Thread(target=self._run_worker, name="publisher-%d" % i)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, payload, batch_start=None):
+        """Hand a batch off to be published.
+
+        This blocks while all workers are busy and the hand-off queue is full.
+        If a worker has failed to publish a batch, its exception is re-raised
+        here.
+
+        :param baseplate._utils.SerializedBatch payload: The batch to publish.
+        :param float batch_start: When the first event was added to the batch,
+            used to report how long events waited locally before being sent.
+
+        """
+        self._raise_worker_error()
+
+        if not payload.count:
+            return
+
+        with self.metrics.timer("batch.wait"):
+            self._hand_off((next(self.sequence), payload, batch_start))
+
+    def close(self):
+        """Wait for all submitted batches to be sent and stop the workers.
+
+        If a worker has failed to publish a batch, its exception is re-raised
+        here.
+
+        """
+        self._raise_worker_error()
+
+        # the queue is first in first out, so each worker only gets to a stop
+        # once all the batches submitted before it have been taken.
+        for _ in self.workers:
+            self._hand_off(_STOP_WORKER)
+        for worker in self.workers:
+            worker.join()
+
+        self._raise_worker_error()
+
+    def _hand_off(self, item):
+        while True:
+            try:
+                self.pending.put(item, timeout=WORKER_CHECK_INTERVAL)
+            except queue.Full:
+                self._raise_worker_error()
+            else:
+                return
+
+    def _raise_worker_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def _set_in_flight(self, delta):
+        with self.in_flight_lock:
+            self.in_flight += delta
+            self.metrics.gauge("batch.in_flight").replace(self.in_flight)
+
+    def _report_finished(self, sequence, lag, latency):
+        with self.in_flight_lock:
+            self.finished[sequence] = (lag, latency)
+            while self.next_to_report in self.finished:
+                lag, latency = self.finished.pop(self.next_to_report)
+                if lag is not None:
+                    self.metrics.timer("batch.lag").send(lag)
+                self.metrics.timer("batch.latency").send(latency)
+                self.next_to_report += 1
+
+    def _run_worker(self):
+        while self.error is None:
+            item = self.pending.get()
+            if item is _STOP_WORKER:
+                self.pending.task_done()
+                return
+
+            sequence, payload, batch_start = item
+            start_time = time.time()
+            lag = start_time - batch_start if batch_start is not None else None
+
+            self._set_in_flight(1)
+            try:
+                self.publisher.publish(payload)
+            except Exception as exc:  # pylint: disable=broad-except
+                self.error = exc
+            else:
+                self._report_finished(sequence, lag, time.time() - start_time)
+            finally:
+                self._set_in_flight(-1)
+                self.pending.task_done()
+
 
 SERIALIZER_BY_VERSION = {1: V1Batch, 2: V2Batch}
 
@@ -178,35 +584,75 @@ def publish_events():
             "collector": {
                 "hostname": config.String,
                 "version": config.Optional(config.Integer, default=1),
+                "protocol": config.Optional(
+                    config.OneOf(json="json", binary="binary", compact="compact"),
+                    default="json",
+                ),
             },
             "key": {"name": config.String, "secret": config.Base64},
+            "queue_type": config.Optional(config.OneOf(posix="posix", shm="shm"), "posix"),
+            "compression": {
+                "codec": config.Optional(
+                    config.OneOf(gzip="gzip", deflate="deflate", zstd="zstd", br="br"),
+                    default="gzip",
+                ),
+                "level": config.Optional(config.Integer),
+            },
+            "max_in_flight": config.Optional(config.Integer, default=1),
         },
     )
 
     metrics_client = metrics_client_from_config(raw_config)
 
-    event_queue = MessageQueue(
-        "/events-" + args.queue_name, max_messages=MAX_QUEUE_SIZE, max_message_size=MAX_EVENT_SIZE
+    # pylint: disable=maybe-no-member
+    event_queue = make_queue(
+        "/events-" + args.queue_name,
+        max_messages=MAX_QUEUE_SIZE,
+        max_message_size=MAX_EVENT_SIZE,
+        queue_type=cfg.queue_type,
     )
 
-    # pylint: disable=maybe-no-member
-    serializer = SERIALIZER_BY_VERSION[cfg.collector.version]()
+    if cfg.collector.version == 1:
+        if cfg.collector.protocol != "json":
+            raise ValueError("collector.protocol must be json for version 1 collectors")
+        serializer = V1Batch()
+    else:
+        serializer = SERIALIZER_BY_VERSION[cfg.collector.version](protocol=cfg.collector.protocol)
     batcher = TimeLimitedBatch(serializer, MAX_BATCH_AGE)
-    publisher = BatchPublisher(metrics_client, cfg)
-
-    while True:
-        try:
-            message = event_queue.get(timeout=0.2)
-        except TimedOutError:
-            message = None
-
-        try:
-            batcher.add(message)
-        except BatchFull:
-            serialized = batcher.serialize()
-            publisher.publish(serialized)
-            batcher.reset()
-            batcher.add(message)
+    compressor = make_compressor(cfg.compression.codec, cfg.compression.level)
+    publisher = BatchPublisher(
+        metrics_client,
+        cfg,
+        compressor,
+        num_conns=cfg.max_in_flight,
+        content_type=serializer.content_type,
+    )
+    concurrent_publisher = ConcurrentBatchPublisher(
+        publisher, metrics_client, max_in_flight=cfg.max_in_flight
+    )
+
+    # stop on SIGTERM the same way as on ^C, sending what's in flight first
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    try:
+        while True:
+            try:
+                messages = event_queue.get_many(MAX_MESSAGES_PER_READ, timeout=0.2)
+            except TimedOutError:
+                messages = [None]
+
+            for message in messages:
+                try:
+                    batcher.add(message)
+                except BatchFull:
+                    serialized = batcher.serialize()
+                    concurrent_publisher.submit(serialized, batcher.batch_start)
+                    batcher.reset()
+                    batcher.add(message)
+    except KeyboardInterrupt:
+        # send what we've already taken off the queue before exiting
+        concurrent_publisher.submit(batcher.serialize(), batcher.batch_start)
+        concurrent_publisher.close()
 
 
 if __name__ == "__main__":
@@ -15,21 +15,41 @@ See also: https://github.com/reddit/event-collector
 import calendar
 import json
 import logging
+import operator
+import struct
 import time
 import uuid
 
 from enum import Enum
 from thrift import TSerialization
+from thrift.protocol.TBinaryProtocol import TBinaryProtocolAcceleratedFactory
+from thrift.protocol.TCompactProtocol import TCompactProtocolAcceleratedFactory
 from thrift.protocol.TJSONProtocol import TJSONProtocolFactory
 
 from baseplate.context import ContextFactory
-from baseplate.message_queue import MessageQueue, TimedOutError
+from baseplate.core import SpanObserver
+from baseplate.message_queue import make_queue, TimedOutError
 from baseplate._utils import warn_deprecated
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 MAX_EVENT_SIZE = 102400
 MAX_QUEUE_SIZE = 10000
 
+logger = logging.getLogger(__name__)
+
+# multiple serialized events can be packed into a single queue message. these
+# messages start with a marker byte that can't start a serialized event and
+# the number of events packed in, followed by the events joined the way they
+# are in a batch (with commas for JSON, nothing for binary thrift protocols) so
+# the publisher can splice them straight into a batch.
+PACKED_EVENTS_HEADER = struct.Struct("!cI")
+PACKED_EVENTS_MARKER = b"\x1e"
+
 
 # pylint: disable=pointless-string-statement,no-init
 class FieldKind(Enum):
@@ -53,9 +73,85 @@ class FieldKind(Enum):
     """
 
 
+# looking up an enum member's value is slow, so the payload section for each
+# kind of field is looked up here instead. enums hash slowly too, so normal
+# fields are picked out by identity first.
+_FIELD_KIND_SECTIONS = {kind: kind.value for kind in FieldKind}
+
+
+_STDLIB_JSON_ENCODER = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+_STDLIB_ASCII_JSON_ENCODER = json.JSONEncoder(separators=(",", ":"))
+
+
+def json_dumps_stdlib(obj):
+    """Serialize an object to compact UTF-8 encoded JSON with the stdlib.
+
+    Strings with lone surrogates can't be encoded as UTF-8, so objects
+    containing them are encoded with non-ASCII characters escaped instead.
+
+    :param obj: A JSON serializable object.
+    :rtype: bytes
+
+    """
+    try:
+        return _STDLIB_JSON_ENCODER.encode(obj).encode()
+    except UnicodeEncodeError:
+        return _STDLIB_ASCII_JSON_ENCODER.encode(obj).encode()
+
+
+def _encodes_identically(value):
+    """Return if orjson serializes the value exactly as json_dumps_stdlib."""
+    # pylint: disable=unidiomatic-typecheck
+    value_type = type(value)
+    if value_type is str or value_type is bool or value is None:
+        return True
+    if value_type is int:
+        return -(2 ** 63) <= value < 2 ** 64
+    if value_type is float:
+        # outside this range python switches to exponent notation and orjson
+        # formats the exponent (or the whole number) differently. this also
+        # excludes nan and infinity.
+        return value == 0 or 1e-4 <= abs(value) < 1e16
+    if value_type is dict:
+        for key, item in value.items():
+            if type(key) is not str:
+                return False
+            if type(item) is not str and not _encodes_identically(item):
+                return False
+        return True
+    if value_type is list or value_type is tuple:
+        for item in value:
+            if type(item) is not str and not _encodes_identically(item):
+                return False
+        return True
+    return False
+
+
+def json_dumps_orjson(obj):
+    """Serialize an object to compact UTF-8 encoded JSON with orjson.
+
+    The output is byte-for-byte the same as :py:func:`json_dumps_stdlib`.
+    Objects that orjson would encode differently (some floats, non-string
+    keys, custom types) or can't encode (strings with lone surrogates) are
+    passed to :py:func:`json_dumps_stdlib` instead.
+
+    :param obj: A JSON serializable object.
+    :rtype: bytes
+
+    """
+    if _encodes_identically(obj):
+        try:
+            return orjson.dumps(obj)
+        except orjson.JSONEncodeError:
+            pass
+    return json_dumps_stdlib(obj)
+
+
 class Event:
     """An event."""
 
+    __slots__ = ("topic", "event_type", "timestamp", "id", "payload", "payload_types")
+
     # pylint: disable=invalid-name,redefined-builtin
     def __init__(self, topic, event_type, timestamp=None, id=None):
         self.topic = topic
@@ -107,19 +203,30 @@ class Event:
         self.payload[key] = value
         self.payload_types[key] = kind
 
-    def serialize(self):
-        payload = {}
-
-        for key, value in self.payload.items():
-            kind = self.payload_types[key]
+    def serialize(self, dumps=None):
+        """Serialize the event for the V1 event protocol.
 
-            if kind.value is None:
-                payload[key] = value
-            else:
-                section = payload.setdefault(kind.value, {})
-                section[key] = value
+        :param callable dumps: The function to encode JSON with, e.g.
+            :py:func:`json_dumps_orjson`. Defaults to :py:func:`json.dumps`,
+            whose output is a :py:class:`str`.
 
-        return json.dumps(
+        """
+        payload_types = self.payload_types
+        normal = FieldKind.NORMAL
+        if operator.countOf(payload_types.values(), normal) == len(payload_types):
+            # the common case, the payload can be sent without a copy.
+            payload = self.payload
+        else:
+            payload = {}
+            for key, value in self.payload.items():
+                kind = payload_types.get(key, normal)
+                if kind is normal:
+                    payload[key] = value
+                else:
+                    section = payload.setdefault(_FIELD_KIND_SECTIONS[kind], {})
+                    section[key] = value
+
+        return (dumps or json.dumps)(
             {
                 "event_topic": self.topic,
                 "event_type": self.event_type,
@@ -153,16 +260,71 @@ class EventQueueFullError(EventError):
         super(EventQueueFullError, self).__init__("The event queue is full.")
 
 
-def serialize_v1_event(event):
+def pack_events(serialized_events, separator=b","):
+    """Pack serialized events into as few queue messages as possible.
+
+    Messages holding a single event are left as-is.
+
+    :param list serialized_events: The serialized events, as bytes.
+    :param bytes separator: What to join the events with.
+    :returns: A list of queue messages.
+
+    """
+    messages = []
+    pending = []
+    pending_size = PACKED_EVENTS_HEADER.size
+
+    def flush():
+        if len(pending) == 1:
+            messages.append(pending[0])
+        else:
+            header = PACKED_EVENTS_HEADER.pack(PACKED_EVENTS_MARKER, len(pending))
+            messages.append(header + separator.join(pending))
+
+    for serialized in serialized_events:
+        item_size = len(serialized) + len(separator)
+        if pending and pending_size + item_size > MAX_EVENT_SIZE:
+            flush()
+            pending = []
+            pending_size = PACKED_EVENTS_HEADER.size
+        pending.append(serialized)
+        pending_size += item_size
+
+    if pending:
+        flush()
+    return messages
+
+
+def unpack_events(message):
+    """Return the number of events in a queue message and the events.
+
+    The events are returned still joined together as they were packed.
+
+    :param bytes message: A message read from the event queue.
+
+    """
+    if message[:1] != PACKED_EVENTS_MARKER:
+        return 1, message
+    _, count = PACKED_EVENTS_HEADER.unpack_from(message)
+    return count, message[PACKED_EVENTS_HEADER.size :]
+
+
+def serialize_v1_event(event, dumps=None):
     """Serialize an Event object for the V1 event protocol.
 
     :param baseplate.events.Event event: An event object.
+    :param callable dumps: The function to encode JSON with, e.g.
+        :py:func:`json_dumps_orjson`. Defaults to :py:func:`json.dumps`. Use
+        :py:func:`functools.partial` to pass this through
+        :py:class:`EventQueue`.
 
     """
-    return event.serialize()
+    return event.serialize(dumps)
 
 
 _V2_PROTOCOL_FACTORY = TJSONProtocolFactory()
+_V2_BINARY_PROTOCOL_FACTORY = TBinaryProtocolAcceleratedFactory()
+_V2_COMPACT_PROTOCOL_FACTORY = TCompactProtocolAcceleratedFactory()
 
 
 def serialize_v2_event(event):
@@ -174,6 +336,37 @@ def serialize_v2_event(event):
     return TSerialization.serialize(event, _V2_PROTOCOL_FACTORY)
 
 
+def serialize_v2_event_binary(event):
+    """Serialize a Thrift struct with TBinaryProtocol for the V2 event protocol.
+
+    This is much smaller and faster than :py:func:`serialize_v2_event`, but
+    the :py:class:`EventQueue` must be made with ``protocol="binary"`` and the
+    publisher configured with ``collector.protocol = binary``.
+
+    :param event: A Thrift struct from the event schemas.
+
+    """
+    return TSerialization.serialize(event, _V2_BINARY_PROTOCOL_FACTORY)
+
+
+def serialize_v2_event_compact(event):
+    """Serialize a Thrift struct with TCompactProtocol for the V2 event protocol.
+
+    This is the smallest encoding, but the :py:class:`EventQueue` must be made
+    with ``protocol="compact"`` and the publisher configured with
+    ``collector.protocol = compact``.
+
+    :param event: A Thrift struct from the event schemas.
+
+    """
+    return TSerialization.serialize(event, _V2_COMPACT_PROTOCOL_FACTORY)
+
+
+# what packed events are joined with for each of the publisher's protocols.
+# binary thrift events are self-delimiting so they're packed back to back.
+_PACKED_EVENT_SEPARATORS = {"json": b",", "binary": b"", "compact": b""}
+
+
 class EventLogger:
     def log(self, **kwargs):
         raise NotImplementedError
@@ -196,14 +389,72 @@ class EventQueue(ContextFactory):
     :param callable event_serializer: A callable that takes an event object
         and returns serialized bytes ready to send on the wire. See below for
         options.
+    :param str queue_type: The kind of message queue to use, see
+        :py:func:`~baseplate.message_queue.make_queue`. This must match the
+        ``queue_type`` the publisher is configured with.
+    :param bool buffered: If true, events put onto the queue via the
+        :term:`context object` are held until the end of the request and then
+        sent together with :py:meth:`put_many`.
+    :param baseplate.events.sampling.EventSampler sampler: If given, events
+        are only sent if the sampler says they should be.
+    :param str protocol: The protocol the events are serialized with, one of
+        ``json``, ``binary``, or ``compact``. This must match the
+        ``collector.protocol`` the publisher is configured with, as it
+        decides how events packed together by :py:meth:`put_many` are
+        joined. V1 events are always ``json``.
 
     """
 
-    def __init__(self, name, event_serializer=serialize_v1_event):
-        self.queue = MessageQueue(
-            "/events-" + name, max_messages=MAX_QUEUE_SIZE, max_message_size=MAX_EVENT_SIZE
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self,
+        name,
+        event_serializer=serialize_v1_event,
+        queue_type="posix",
+        buffered=False,
+        sampler=None,
+        protocol="json",
+    ):
+        if protocol not in _PACKED_EVENT_SEPARATORS:
+            raise ValueError("unknown protocol: {!r}".format(protocol))
+
+        self.queue = make_queue(
+            "/events-" + name,
+            max_messages=MAX_QUEUE_SIZE,
+            max_message_size=MAX_EVENT_SIZE,
+            queue_type=queue_type,
         )
         self.serialize_event = event_serializer
+        self.packed_event_separator = _PACKED_EVENT_SEPARATORS[protocol]
+        self.buffered = buffered
+        self.sampler = sampler
+
+    def report_runtime_metrics(self, batch):
+        if self.sampler:
+            self.sampler.report_runtime_metrics(batch)
+
+    def _should_send(self, event):
+        return self.sampler is None or self.sampler.should_send(event)
+
+    def _serialize(self, event):
+        serialized = self.serialize_event(event)
+        if len(serialized) > MAX_EVENT_SIZE:
+            raise EventTooLargeError(len(serialized))
+        if isinstance(serialized, str):
+            serialized = serialized.encode()
+        return serialized
+
+    def _put_serialized(self, serialized_events):
+        if not serialized_events:
+            return
+
+        messages = pack_events(serialized_events, self.packed_event_separator)
+        try:
+            count = self.queue.put_many(messages, timeout=0)
+        except TimedOutError:
+            raise EventQueueFullError
+        if count < len(messages):
+            raise EventQueueFullError
 
     def put(self, event):
         """Add an event to the queue.
@@ -219,6 +470,9 @@ class EventQueue(ContextFactory):
             not being published fast enough.
 
         """
+        if not self._should_send(event):
+            return
+
         serialized = self.serialize_event(event)
         if len(serialized) > MAX_EVENT_SIZE:
             raise EventTooLargeError(len(serialized))
@@ -228,5 +482,74 @@ class EventQueue(ContextFactory):
         except TimedOutError:
             raise EventQueueFullError
 
+    def put_many(self, events):
+        """Add multiple events to the queue.
+
+        The events are serialized up front and packed into as few queue
+        messages as possible. This requires an event publisher that
+        understands packed messages (any from this version of baseplate on).
+
+        :param list events: The events to send.
+        :raises: :py:exc:`EventTooLargeError` A serialized event is too large.
+            No events will have been sent.
+        :raises: :py:exc:`EventQueueFullError` The queue is full. Some of the
+            events may not have been sent.
+
+        """
+        self._put_serialized(
+            [self._serialize(event) for event in events if self._should_send(event)]
+        )
+
     def make_object_for_context(self, name, span):
-        return self
+        if not self.buffered:
+            return self
+
+        buffered_queue = _BufferedEventQueue(
+            self._should_send, self._serialize, self._put_serialized
+        )
+        span.register(_EventBufferSpanObserver(buffered_queue))
+        return buffered_queue
+
+
+class _BufferedEventQueue:
+    """Hold events for the duration of a request and send them together."""
+
+    def __init__(self, should_send, serialize, put_serialized):
+        self.should_send = should_send
+        self.serialize = serialize
+        self.put_serialized = put_serialized
+        self.serialized_events = []
+
+    def put(self, event):
+        if not self.should_send(event):
+            return
+
+        # serialize now so size errors are raised at the call site and later
+        # changes to the event object don't leak into what's sent.
+        self.serialized_events.append(self.serialize(event))
+
+    def put_many(self, events):
+        for event in events:
+            self.put(event)
+
+    def flush(self):
+        serialized_events, self.serialized_events = self.serialized_events, []
+        if serialized_events:
+            self.put_serialized(serialized_events)
+
+
+class _EventBufferSpanObserver(SpanObserver):
+    """Flush buffered events at the end of each request."""
+
+    def __init__(self, buffered_queue):
+        self.buffered_queue = buffered_queue
+
+    def on_finish(self, exc_info):
+        # this runs as the request finishes, so failing to send events mustn't
+        # fail the request or stop the other observers from running.
+        try:
+            self.buffered_queue.flush()
+        except EventQueueFullError:
+            logger.warning("The event queue is full, dropped buffered events.")
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Failed to send buffered events.")
@@ -0,0 +1,162 @@
+"""Sample and deduplicate events before they are sent to the queue.
+
+High volume topics can be sampled down in the application rather than
+downstream, and events that are sent more than once (e.g. by retried requests)
+can be dropped. This happens before events are serialized so a dropped event
+costs very little.
+
+"""
+
+import collections
+import hashlib
+import time
+
+
+def _hash_to_int(value):
+    # the hash must be the same across processes and hosts so that sampling on
+    # a field keeps or drops the same values everywhere.
+    digest = hashlib.blake2b(str(value).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+
+def _get_field(event, name):
+    get_field = getattr(event, "get_field", None)
+    if get_field is not None:
+        return get_field(name)
+    return getattr(event, name, None)
+
+
+class SamplingRule:
+    """How to sample and deduplicate a kind of event.
+
+    :param float sample_rate: The fraction of events to keep, between 0 and 1.
+    :param str sample_key: The name of a field to sample on. All events with
+        the same value in this field are either kept or dropped, e.g. sampling
+        on ``user_id`` keeps all the events of a sample of users. If not
+        given, or an event doesn't have the field, events are sampled on their
+        ID.
+    :param bool deduplicate: Drop events with an ID that was seen recently.
+
+    """
+
+    def __init__(self, sample_rate=1.0, sample_key=None, deduplicate=False):
+        if not 0 <= sample_rate <= 1:
+            raise ValueError("sample_rate must be between 0 and 1")
+
+        self.sample_rate = sample_rate
+        self.sample_key = sample_key
+        self.deduplicate = deduplicate
+        # events are kept if their hash is under this
+        self.threshold = int(sample_rate * 2 ** 64)
+
+
+class _RecentIDs:
+    """A time-bounded set of IDs.
+
+    IDs are held in two generations that are rotated every ``window``
+    seconds, so an ID is remembered for between one and two windows. The
+    generations are also rotated early if they fill up, to bound memory use.
+
+    """
+
+    def __init__(self, window, max_size):
+        self.window = window
+        self.max_generation_size = max(max_size // 2, 1)
+        self.current = set()
+        self.previous = set()
+        self.rotated_at = time.monotonic()
+
+    def add(self, item):
+        """Add an item to the set and return if it was not already present."""
+        now = time.monotonic()
+        if now - self.rotated_at >= self.window or len(self.current) >= self.max_generation_size:
+            self.previous, self.current = self.current, set()
+            self.rotated_at = now
+
+        if item in self.current or item in self.previous:
+            return False
+        self.current.add(item)
+        return True
+
+
+class EventSampler:
+    """Decide which events to send based on per-topic rules.
+
+    Rules are looked up first by ``(topic, event_type)``, then by topic alone.
+    Events that don't match any rule use the ``default_rule``, or are all sent
+    if there isn't one. V2 Thrift events don't have a topic or event type so
+    only the ``default_rule`` applies to them.
+
+    Counts of kept, sampled out, and duplicate events are reported for each
+    rule with the runtime metrics of the :py:class:`~baseplate.events.EventQueue`
+    the sampler is used in.
+
+    :param dict rules: A mapping of topics or ``(topic, event_type)`` tuples to
+        :py:class:`SamplingRule` objects.
+    :param baseplate.events.sampling.SamplingRule default_rule: The rule for
+        events that don't match any in ``rules``.
+    :param float dedupe_window: The minimum number of seconds to remember
+        event IDs for when deduplicating.
+    :param int max_dedupe_ids: The maximum number of IDs to remember.
+    :param str id_field: The name of the field holding the event's ID.
+
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self, rules, default_rule=None, dedupe_window=60, max_dedupe_ids=100000, id_field="id"
+    ):
+        self.rules = {}
+        for key, rule in rules.items():
+            if isinstance(key, tuple):
+                self.rules[key] = (".".join(key), rule)
+            else:
+                self.rules[key] = (key, rule)
+        self.default_rule = ("default", default_rule) if default_rule else None
+        self.recent_ids = _RecentIDs(dedupe_window, max_dedupe_ids)
+        self.id_field = id_field
+        self.counts = collections.Counter()
+
+    def _find_rule(self, event):
+        topic = getattr(event, "topic", None)
+        if topic is not None:
+            named_rule = self.rules.get((topic, getattr(event, "event_type", None)))
+            if named_rule is not None:
+                return named_rule
+            named_rule = self.rules.get(topic)
+            if named_rule is not None:
+                return named_rule
+        return self.default_rule
+
+    def should_send(self, event):
+        """Return if the event should be sent."""
+        named_rule = self._find_rule(event)
+        if named_rule is None:
+            return True
+        name, rule = named_rule
+
+        event_id = getattr(event, self.id_field, None)
+
+        if rule.threshold < 2 ** 64:
+            sample_value = None
+            if rule.sample_key:
+                sample_value = _get_field(event, rule.sample_key)
+            if sample_value is None:
+                sample_value = event_id
+
+            if sample_value is not None and _hash_to_int(sample_value) >= rule.threshold:
+                self.counts[name, "sampled_out"] += 1
+                return False
+
+        if rule.deduplicate and event_id is not None:
+            if not self.recent_ids.add(hash(event_id)):
+                self.counts[name, "duplicate"] += 1
+                return False
+
+        self.counts[name, "kept"] += 1
+        return True
+
+    def report_runtime_metrics(self, batch):
+        counts, self.counts = self.counts, collections.Counter()
+        for (name, outcome), count in counts.items():
+            batch.counter("sampling.{}.{}".format(name, outcome)).increment(count)
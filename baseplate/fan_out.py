@@ -0,0 +1,181 @@
+"""Make independent calls concurrently from within a request.
+
+Calls made one after another take the sum of their latencies, while calls
+made concurrently take about as long as the slowest. :py:func:`fan_out` runs
+each call in its own thread (or greenlet, if gevent is monkeypatched in) under
+a local span of the current request, so the spans of the clients they use are
+still children of the request's span.
+
+"""
+
+import collections.abc
+import queue
+import sys
+import threading
+import time
+
+
+class FanOutError(Exception):
+    """Raised when some of the calls made by :py:func:`fan_out` failed.
+
+    .. py:attribute:: errors
+
+        A mapping of the names of the calls that failed (or didn't finish in
+        time) to their exceptions.
+
+    .. py:attribute:: results
+
+        A mapping of the names of the calls that succeeded to their results.
+
+    """
+
+    def __init__(self, errors, results):
+        self.errors = errors
+        self.results = results
+        super().__init__(
+            "{} of {} calls failed: {}".format(
+                len(errors),
+                len(errors) + len(results),
+                ", ".join("{}: {!r}".format(name, exc) for name, exc in errors.items()),
+            )
+        )
+
+
+class FanOutTimeoutError(Exception):
+    """The exception for calls that didn't finish before the deadline."""
+
+
+class FanOutCancelledError(Exception):
+    """The exception for calls that were cancelled because another failed."""
+
+
+def _gevent_is_patched():
+    monkey = sys.modules.get("gevent.monkey")
+    return monkey is not None and monkey.is_module_patched("threading")
+
+
+class _Call:
+    """A single call, run in the background under its own local span."""
+
+    def __init__(self, name, function, span, results):
+        self.name = name
+        self.span = span
+        self.greenlet = None
+        self.thread = None
+
+        args = (function, results)
+        if _gevent_is_patched():
+            import gevent  # pylint: disable=import-error
+
+            self.greenlet = gevent.spawn(self._run, *args)
+        else:
+            self.thread = threading.Thread(target=self._run, args=args)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _run(self, function, results):
+        try:
+            with self.span:
+                result = function(self.span.context)
+        except Exception as exc:  # pylint: disable=broad-except
+            results.put((self.name, False, exc))
+        else:
+            results.put((self.name, True, result))
+
+    def cancel(self):
+        self.span.set_tag("cancelled", True)
+        if self.greenlet is not None:
+            # this raises GreenletExit in the call, which finishes its span
+            # and makes clients throw away connections that were in use.
+            self.greenlet.kill(block=False)
+        # a thread can't be stopped so it's left to finish in the background
+        # and its result ignored.
+
+
+def fan_out(context, calls, timeout=None, fail_fast=False):
+    """Make calls concurrently and return their results.
+
+    Each call is a function that takes a :term:`context object` and uses it
+    to make its requests. The context is a copy of ``context`` belonging to a
+    local span named ``fan_out.<name>``, so clients attached to it make spans
+    under that. Any client can be used this way, including Thrift clients and
+    the memcache, redis, and Cassandra clients::
+
+        results = fan_out(
+            context,
+            {
+                "user": lambda ctx: ctx.accounts.get_user(user_id),
+                "prefs": lambda ctx: ctx.memcache.get("prefs:" + user_id),
+                "posts": lambda ctx: ctx.cassandra.execute(query, (user_id,)),
+            },
+            timeout=0.5,
+        )
+        user = results["user"]
+
+    If all the calls succeed, their results are returned in a dictionary with
+    the same keys as ``calls``, or a list in the same order if ``calls`` is a
+    sequence. Otherwise :py:exc:`FanOutError` is raised once all the calls
+    have finished or been cancelled, holding the errors and the results of
+    the calls that did succeed.
+
+    Calls still running when the deadline passes (or when another fails, with
+    ``fail_fast``) are cancelled: their spans are tagged ``cancelled`` and if
+    gevent is in use, they're killed. Threads can't be killed, so they finish
+    in the background and their results are thrown away.
+
+    :param context: The context object of the current request.
+    :param calls: A dictionary of names to functions, or a sequence of
+        functions named by their index.
+    :param float timeout: If given, the number of seconds to wait for all the
+        calls to finish.
+    :param bool fail_fast: Cancel the other calls as soon as one fails rather
+        than waiting for them all.
+
+    """
+    if isinstance(calls, collections.abc.Mapping):
+        named_calls = list(calls.items())
+    else:
+        named_calls = [(str(i), function) for i, function in enumerate(calls)]
+
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    results = queue.Queue()
+    pending = {}
+    for name, function in named_calls:
+        span = context.trace.make_child("fan_out." + name, local=True, component_name="fan_out")
+        pending[name] = _Call(name, function, span, results)
+
+    succeeded = {}
+    errors = {}
+    timed_out = False
+    while pending:
+        remaining = None
+        if deadline is not None:
+            remaining = max(deadline - time.monotonic(), 0)
+
+        try:
+            name, ok, value = results.get(timeout=remaining)
+        except queue.Empty:
+            timed_out = True
+            break
+
+        del pending[name]
+        if ok:
+            succeeded[name] = value
+        else:
+            errors[name] = value
+            if fail_fast:
+                break
+
+    for name, call in pending.items():
+        call.cancel()
+        if timed_out:
+            errors[name] = FanOutTimeoutError("did not finish in time")
+        else:
+            errors[name] = FanOutCancelledError("cancelled after another call failed")
+
+    if errors:
+        raise FanOutError(errors, succeeded)
+
+    if isinstance(calls, collections.abc.Mapping):
+        return {name: succeeded[name] for name, _ in named_calls}
+    return [succeeded[name] for name, _ in named_calls]
@@ -1,6 +1,14 @@
-"""A gevent-friendly POSIX message queue."""
+"""Gevent-friendly inter-process message queues."""
 
+import contextlib
+import errno
+import fcntl
+import mmap
+import os
 import select
+import struct
+import threading
+import time
 
 import posix_ipc
 
@@ -103,6 +111,75 @@ class MessageQueue:
 
         raise TimedOutError
 
+    def get_many(self, max_messages, timeout=None):
+        """Read up to ``max_messages`` messages from the queue.
+
+        This blocks like :py:meth:`get` until at least one message is
+        available and then drains as many more messages as are immediately
+        available (without blocking again) up to ``max_messages``.
+
+        :param int max_messages: The maximum number of messages to return.
+        :param float timeout: If the queue is empty, the call will block up to
+            ``timeout`` seconds or forever if ``None``.
+        :returns: A list of at least one and at most ``max_messages``
+            messages.
+        :raises: :py:exc:`TimedOutError` The queue was empty for the allowed
+            duration of the call.
+
+        """
+        assert max_messages > 0, "max_messages must be positive"
+
+        messages = []
+        receive = self.queue.receive
+        for time_remaining in RetryPolicy.new(budget=timeout):
+            try:
+                while len(messages) < max_messages:
+                    message, _ = receive()
+                    messages.append(message)
+                return messages
+            except posix_ipc.SignalError:  # pragma: nocover
+                continue  # interrupted, just try again
+            except posix_ipc.BusyError:
+                if messages:
+                    return messages
+                select.select([self.queue.mqd], [], [], time_remaining)
+
+        raise TimedOutError
+
+    def put_many(self, messages, timeout=None):
+        """Add multiple messages to the queue.
+
+        Messages are added in order for as long as there is space in the
+        queue. If the queue fills up, the call will wait for space to add the
+        remaining messages.
+
+        :param list messages: The messages to add.
+        :param float timeout: If the queue is full, the call will block up to
+            ``timeout`` seconds or forever if ``None``.
+        :returns: The number of messages that were added. This may be less
+            than ``len(messages)`` if the timeout expired before there was
+            space for all of them.
+        :raises: :py:exc:`TimedOutError` The queue was full for the allowed
+            duration of the call and no messages could be added.
+
+        """
+        count = 0
+        send = self.queue.send
+        for time_remaining in RetryPolicy.new(budget=timeout):
+            try:
+                for message in messages[count:]:
+                    send(message=message)
+                    count += 1
+                return count
+            except posix_ipc.SignalError:  # pragma: nocover
+                continue  # interrupted, just try again
+            except posix_ipc.BusyError:
+                select.select([], [self.queue.mqd], [], time_remaining)
+
+        if not count and messages:
+            raise TimedOutError
+        return count
+
     def unlink(self):
         """Remove the queue from the system.
 
@@ -122,6 +199,395 @@ class MessageQueue:
         self.queue.close()
 
 
+# layout of the shared memory segment backing a SharedMemoryMessageQueue. the
+# frequently written head and tail offsets live on their own cache lines so
+# that producers and the consumer don't contend on the same line.
+_SHM_MAGIC = b"BPRING01"
+_SHM_INFO = struct.Struct("=8sQQ")  # magic, capacity, max message size
+_SHM_COUNTER = struct.Struct("=Q")
+_SHM_HEAD_OFFSET = 64
+_SHM_TAIL_OFFSET = 128
+_SHM_WAITING_OFFSET = 192
+_SHM_DATA_OFFSET = 4096
+_SHM_RECORD_HEADER = struct.Struct("=I")
+_SHM_ALIGNMENT = 8
+
+# the largest ring buffer we'll create by default, no matter how big
+# max_messages * max_message_size is.
+MAX_DEFAULT_BUFFER_SIZE = 64 * 1024 * 1024
+# how often a producer re-checks a full buffer for free space
+_SHM_FULL_POLL_INTERVAL = 0.005
+# the longest a consumer will sleep before re-checking the buffer, as a safety
+# net against missed wake-ups.
+_SHM_MAX_SLEEP = 0.1
+
+
+def _shm_record_size(message_size):
+    size = _SHM_RECORD_HEADER.size + message_size
+    return size + (-size % _SHM_ALIGNMENT)
+
+
+@contextlib.contextmanager
+def _locked_file(path, flags=os.O_RDWR):
+    """Open a file and hold an exclusive lock on it.
+
+    The lock is released by the kernel if its holder dies. It's per open
+    file, so it also excludes other threads of this process.
+
+    """
+    fd = os.open(path, flags, 0o0644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            yield fd
+        finally:
+            # closing the file doesn't release the lock if it was mmapped,
+            # since the mapping holds on to the open file.
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
+
+class SharedMemoryMessageQueue:
+    """A message queue built on a ring buffer in shared memory.
+
+    This has the same interface as :py:class:`MessageQueue` but is not subject
+    to the kernel's POSIX message queue limits and does not make a system call
+    per message. Messages are stored as variable-length records in a
+    memory-mapped file (under ``/dev/shm`` by default) so the buffer is only
+    limited by available memory.
+
+    Any number of processes may :py:meth:`put` messages onto the queue but
+    only a single process may :py:meth:`get` messages from it. Producers are
+    serialized with flock(2) on the buffer file, which the kernel releases if
+    a producer dies while holding it, and the consumer sleeps on a named pipe
+    that producers write to only when it is waiting, so it is select(2)-able
+    and gevent-friendly.
+
+    :param str name: The name of the queue, with the same format as for
+        :py:class:`MessageQueue`.
+    :param int max_messages: Used with ``max_message_size`` to size the
+        buffer if ``buffer_size`` is not given. The buffer holds a variable
+        number of messages depending on their size.
+    :param int max_message_size: The maximum size of an individual message.
+    :param int buffer_size: The size of the ring buffer in bytes. Defaults to
+        enough space for ``max_messages`` messages of the maximum size, up to
+        :py:data:`MAX_DEFAULT_BUFFER_SIZE`.
+    :param str directory: The directory to put the shared memory files in.
+        This should be on a memory-backed filesystem.
+
+    If the queue already exists, its existing buffer size and maximum message
+    size are used.
+
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self, name, max_messages, max_message_size, buffer_size=None, directory="/dev/shm"
+    ):
+        assert name.startswith("/") and "/" not in name[1:], "invalid queue name"
+
+        if buffer_size is None:
+            buffer_size = min(
+                max_messages * _shm_record_size(max_message_size), MAX_DEFAULT_BUFFER_SIZE
+            )
+        buffer_size -= buffer_size % _SHM_ALIGNMENT
+
+        if buffer_size < _shm_record_size(max_message_size):
+            raise ValueError("buffer_size is too small to hold a message of max_message_size")
+
+        base_name = "baseplate-" + name[1:]
+        self.name = name
+        self.path = os.path.join(directory, base_name)
+        self.fifo_path = self.path + ".fifo"
+
+        try:
+            with _locked_file(self.path, os.O_RDWR | os.O_CREAT) as fd:
+                if os.fstat(fd).st_size == 0:
+                    os.ftruncate(fd, _SHM_DATA_OFFSET + buffer_size)
+                    with mmap.mmap(fd, _SHM_DATA_OFFSET) as header:
+                        _SHM_INFO.pack_into(header, 0, _SHM_MAGIC, buffer_size, max_message_size)
+
+                try:
+                    os.mkfifo(self.fifo_path, 0o0644)
+                except FileExistsError:
+                    pass
+
+                self.mmap = mmap.mmap(fd, 0)
+                self._lock_fd = os.dup(fd)
+        except OSError as exc:
+            raise MessageQueueOSError(exc)
+
+        magic, self.capacity, self.max_message_size = _SHM_INFO.unpack_from(self.mmap, 0)
+        if magic != _SHM_MAGIC:
+            raise InvalidParametersError("%s is not a baseplate message queue" % self.path)
+
+        self._reader_fd = None
+        self._writer_fd = None
+        self._lock_pid = os.getpid()
+        self._thread_lock = threading.Lock()
+
+    def _acquire_lock(self):
+        # the kernel releases a producer's flock if it dies holding it, so
+        # there's no owner to record or take over. the dead producer's partial
+        # record is harmless because it never got to advance the head.
+        if self._lock_pid != os.getpid():
+            # a forked child shares our open file and so our flock, it needs
+            # its own to exclude us. the thread lock may have been copied
+            # while held by a thread that didn't come along.
+            lock_fd = os.open(self.path, os.O_RDWR)
+            os.close(self._lock_fd)
+            self._lock_fd = lock_fd
+            self._thread_lock = threading.Lock()
+            self._lock_pid = os.getpid()
+
+        self._thread_lock.acquire()
+        try:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+        except BaseException:
+            self._thread_lock.release()
+            raise
+
+    def _release_lock(self):
+        fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+        self._thread_lock.release()
+
+    def _try_put_many(self, messages):
+        # returns how many of the messages fit into the buffer
+        buf = self.mmap
+        capacity = self.capacity
+        count = 0
+
+        self._acquire_lock()
+        try:
+            (head,) = _SHM_COUNTER.unpack_from(buf, _SHM_HEAD_OFFSET)
+            (tail,) = _SHM_COUNTER.unpack_from(buf, _SHM_TAIL_OFFSET)
+            free = capacity - (head - tail)
+            for message in messages:
+                size = len(message)
+                record_size = _shm_record_size(size)
+                if record_size > free:
+                    break
+
+                # records are aligned so the length prefix is never split by
+                # the end of the buffer, but the message itself may be.
+                start = head % capacity
+                _SHM_RECORD_HEADER.pack_into(buf, _SHM_DATA_OFFSET + start, size)
+                start += _SHM_DATA_OFFSET + _SHM_RECORD_HEADER.size
+                end = start + size
+                if end <= _SHM_DATA_OFFSET + capacity:
+                    buf[start:end] = message
+                else:
+                    split = _SHM_DATA_OFFSET + capacity - start
+                    buf[start:] = message[:split]
+                    buf[_SHM_DATA_OFFSET : _SHM_DATA_OFFSET + size - split] = message[split:]
+
+                head += record_size
+                free -= record_size
+                count += 1
+
+            # the head is only advanced after the records are fully written so
+            # the consumer never sees a partial record.
+            _SHM_COUNTER.pack_into(buf, _SHM_HEAD_OFFSET, head)
+        finally:
+            self._release_lock()
+
+        if count and _SHM_COUNTER.unpack_from(buf, _SHM_WAITING_OFFSET)[0]:
+            self._wake_consumer()
+        return count
+
+    def _wake_consumer(self):
+        try:
+            if self._writer_fd is None:
+                self._writer_fd = os.open(self.fifo_path, os.O_WRONLY | os.O_NONBLOCK)
+            os.write(self._writer_fd, b"\x00")
+        except BlockingIOError:
+            pass  # the pipe is full of wake-ups already
+        except OSError as exc:
+            # ENXIO: there's no consumer with the pipe open. EPIPE: the
+            # consumer we had went away. either way, nobody to wake.
+            if exc.errno not in (errno.ENXIO, errno.EPIPE):
+                raise
+            if self._writer_fd is not None:
+                os.close(self._writer_fd)
+                self._writer_fd = None
+
+    def _try_get_many(self, max_messages):
+        buf = self.mmap
+        capacity = self.capacity
+        (tail,) = _SHM_COUNTER.unpack_from(buf, _SHM_TAIL_OFFSET)
+        (head,) = _SHM_COUNTER.unpack_from(buf, _SHM_HEAD_OFFSET)
+
+        messages = []
+        while tail < head and len(messages) < max_messages:
+            start = tail % capacity
+            (size,) = _SHM_RECORD_HEADER.unpack_from(buf, _SHM_DATA_OFFSET + start)
+            start += _SHM_DATA_OFFSET + _SHM_RECORD_HEADER.size
+            end = start + size
+            if end <= _SHM_DATA_OFFSET + capacity:
+                messages.append(buf[start:end])
+            else:
+                split = _SHM_DATA_OFFSET + capacity - start
+                messages.append(
+                    buf[start:] + buf[_SHM_DATA_OFFSET : _SHM_DATA_OFFSET + size - split]
+                )
+            tail += _shm_record_size(size)
+
+        if messages:
+            _SHM_COUNTER.pack_into(buf, _SHM_TAIL_OFFSET, tail)
+        return messages
+
+    def _wait_for_messages(self, timeout):
+        if self._reader_fd is None:
+            # open read-write so the pipe doesn't look closed to us when there
+            # are no producers connected.
+            self._reader_fd = os.open(self.fifo_path, os.O_RDWR | os.O_NONBLOCK)
+
+        if timeout is None or timeout > _SHM_MAX_SLEEP:
+            timeout = _SHM_MAX_SLEEP
+
+        buf = self.mmap
+        _SHM_COUNTER.pack_into(buf, _SHM_WAITING_OFFSET, 1)
+        try:
+            # check again now that producers know to wake us up
+            (head,) = _SHM_COUNTER.unpack_from(buf, _SHM_HEAD_OFFSET)
+            (tail,) = _SHM_COUNTER.unpack_from(buf, _SHM_TAIL_OFFSET)
+            if head == tail:
+                select.select([self._reader_fd], [], [], timeout)
+        finally:
+            _SHM_COUNTER.pack_into(buf, _SHM_WAITING_OFFSET, 0)
+
+        try:
+            while os.read(self._reader_fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def get(self, timeout=None):
+        """Read a message from the queue.
+
+        :param float timeout: If the queue is empty, the call will block up to
+            ``timeout`` seconds or forever if ``None``.
+        :raises: :py:exc:`TimedOutError` The queue was empty for the allowed
+            duration of the call.
+
+        """
+        messages = self._try_get_many(1)
+        if not messages:
+            messages = self.get_many(1, timeout=timeout)
+        return messages[0]
+
+    def get_many(self, max_messages, timeout=None):
+        """Read up to ``max_messages`` messages from the queue.
+
+        See :py:meth:`MessageQueue.get_many`.
+
+        """
+        assert max_messages > 0, "max_messages must be positive"
+
+        for time_remaining in RetryPolicy.new(budget=timeout):
+            messages = self._try_get_many(max_messages)
+            if messages:
+                return messages
+            if time_remaining == 0:
+                break
+            self._wait_for_messages(time_remaining)
+
+        raise TimedOutError
+
+    def put(self, message, timeout=None):
+        """Add a message to the queue.
+
+        :param float timeout: If the queue is full, the call will block up to
+            ``timeout`` seconds or forever if ``None``.
+        :raises: :py:exc:`TimedOutError` The queue was full for the allowed
+            duration of the call.
+
+        """
+        if isinstance(message, str):
+            message = message.encode()
+        if len(message) > self.max_message_size:
+            raise ValueError("The message is too long")
+
+        if not self._try_put_many((message,)):
+            self.put_many((message,), timeout=timeout)
+
+    def put_many(self, messages, timeout=None):
+        """Add multiple messages to the queue.
+
+        See :py:meth:`MessageQueue.put_many`.
+
+        """
+        messages = [
+            message.encode() if isinstance(message, str) else message for message in messages
+        ]
+        for message in messages:
+            if len(message) > self.max_message_size:
+                raise ValueError("The message is too long")
+
+        count = 0
+        for time_remaining in RetryPolicy.new(budget=timeout):
+            count += self._try_put_many(messages[count:])
+            if count == len(messages):
+                return count
+            if time_remaining == 0:
+                break
+            time.sleep(min(time_remaining or _SHM_FULL_POLL_INTERVAL, _SHM_FULL_POLL_INTERVAL))
+
+        if not count and messages:
+            raise TimedOutError
+        return count
+
+    def unlink(self):
+        """Remove the queue from the system.
+
+        Processes that have the queue open can continue to use it until they
+        close it.
+
+        """
+        for path in (self.path, self.fifo_path):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def close(self):
+        """Close the queue, freeing related resources.
+
+        This must be called explicitly if queues are created/destroyed on the
+        fly. It is not automatically called when the object is reclaimed by
+        Python.
+
+        """
+        for fd in (self._reader_fd, self._writer_fd):
+            if fd is not None:
+                os.close(fd)
+        self._reader_fd = self._writer_fd = None
+        self.mmap.close()
+        os.close(self._lock_fd)
+
+
+QUEUE_TYPES = {"posix": MessageQueue, "shm": SharedMemoryMessageQueue}
+
+
+def make_queue(name, max_messages, max_message_size, queue_type="posix"):
+    """Create or open a message queue of the given type.
+
+    :param str name: The name of the queue.
+    :param int max_messages: The maximum number of messages in the queue.
+    :param int max_message_size: The maximum size of an individual message.
+    :param str queue_type: Which queue implementation to use. ``posix`` for
+        :py:class:`MessageQueue` or ``shm`` for
+        :py:class:`SharedMemoryMessageQueue`.
+
+    """
+    try:
+        queue_cls = QUEUE_TYPES[queue_type]
+    except KeyError:
+        raise ValueError("unknown queue type %r" % queue_type)
+    return queue_cls(name, max_messages=max_messages, max_message_size=max_message_size)
+
+
 def queue_tool():
     import argparse
     import sys
@@ -140,6 +606,12 @@ def queue_tool():
         default=8096,
         help="if creating the queue, what to set the maximum message size to",
     )
+    parser.add_argument(
+        "--queue-type",
+        choices=sorted(QUEUE_TYPES),
+        default="posix",
+        help="the kind of queue to use (default: posix)",
+    )
     parser.add_argument("queue_name", help="the name of the queue to consume")
 
     group = parser.add_mutually_exclusive_group(required=True)
@@ -167,7 +639,9 @@ def queue_tool():
 
     args = parser.parse_args()
 
-    queue = MessageQueue(args.queue_name, args.max_messages, args.max_message_size)
+    queue = make_queue(
+        args.queue_name, args.max_messages, args.max_message_size, queue_type=args.queue_type
+    )
 
     if args.mode == "read":
         while True:
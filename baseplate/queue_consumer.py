@@ -1,17 +1,49 @@
+import collections
 import logging
+import math
 import queue
+import threading
+import time
+
 from threading import Thread
 
 from kombu import Queue
 from kombu.mixins import ConsumerMixin
 
 from baseplate.retry import RetryPolicy
+from baseplate.server import runtime_monitor
 
 
 logger = logging.getLogger(__name__)
 
 
-def consume(baseplate, exchange, connection, queue_name, routing_keys, handler):
+# how often (seconds) handler threads check if they should stop
+_STOP_CHECK_INTERVAL = 1
+# how often (seconds) the prefetch count may be adjusted
+_PREFETCH_ADJUST_INTERVAL = 10
+# the largest prefetch count AMQP allows
+_MAX_PREFETCH_COUNT = 65535
+# the most timing samples to hold between runtime metrics reports
+_MAX_SAMPLES = 1000
+
+
+def _set_message_tags(span, message):
+    for name in ("routing_key", "consumer_tag", "delivery_tag", "exchange"):
+        span.set_tag(name, message.delivery_info.get(name, ""))
+
+
+# pylint: disable=too-many-arguments
+def consume(
+    baseplate,
+    exchange,
+    connection,
+    queue_name,
+    routing_keys,
+    handler,
+    concurrency=1,
+    prefetch_count=None,
+    prefetch_target_seconds=None,
+):
     """Create a long-running process to consume messages from a queue.
 
     A queue with name ``queue_name`` is created and bound to the
@@ -33,6 +65,13 @@ def consume(baseplate, exchange, connection, queue_name, routing_keys, handler):
     will prevent the ``ack`` and the message will be re-queued at the head of
     the queue.
 
+    If ``concurrency`` is more than one, that many messages are handled at
+    once, each in its own thread (or greenlet if gevent is monkeypatched in)
+    and server span. Messages are acked as their handlers finish, so they may
+    be acked out of order. When the process is asked to stop, or a handler
+    raises an exception, no new messages are taken and the process exits
+    once the messages already being handled are done.
+
     :param baseplate.core.Baseplate baseplate: A baseplate instance for the
         service.
     :param kombu.Exchange exchange:
@@ -40,41 +79,338 @@ def consume(baseplate, exchange, connection, queue_name, routing_keys, handler):
     :param str queue_name: The name of the queue.
     :param list routing_keys: List of routing keys.
     :param handler: The handler method.
+    :param int concurrency: The number of messages to handle at once.
+    :param int prefetch_count: The maximum number of unacknowledged messages
+        the broker will send this consumer. Defaults to unlimited if
+        ``concurrency`` is one, twice ``concurrency`` otherwise.
+    :param float prefetch_target_seconds: If set, adjust the prefetch count
+        to hold about this many seconds of work, see
+        :py:meth:`BaseKombuConsumer.new`.
 
     """
+    if concurrency < 1:
+        raise ValueError("concurrency must be at least 1")
+
+    if prefetch_count is None and concurrency > 1:
+        prefetch_count = concurrency * 2
+
     queues = []
     for routing_key in routing_keys:
         queues.append(Queue(name=queue_name, exchange=exchange, routing_key=routing_key))
 
     logger.info("registering %s as a handler for %r", handler.__name__, queues)
-    kombu_consumer = KombuConsumer.new(connection, queues)
+    kombu_consumer = KombuConsumer.new(
+        connection,
+        queues,
+        prefetch_count=prefetch_count,
+        prefetch_target_seconds=prefetch_target_seconds,
+    )
+
+    _start_runtime_metrics_reporter(baseplate, kombu_consumer, queue_name)
 
     logger.info("waiting for messages")
+    if concurrency > 1:
+        _consume_concurrently(baseplate, kombu_consumer, queue_name, handler, concurrency)
+        return
+
     while True:
         context = baseplate.make_context_object()
         with baseplate.make_server_span(context, queue_name) as span:
             message = kombu_consumer.get_message(span)
+            start_time = time.monotonic()
             handler(context, message.body, message)
             message.ack()
+            kombu_consumer.record_handled(time.monotonic() - start_time)
+
+
+# pylint: disable=too-many-arguments
+def consume_batch(
+    baseplate,
+    exchange,
+    connection,
+    queue_name,
+    routing_keys,
+    handler,
+    batch_size,
+    batch_timeout,
+    prefetch_count=None,
+    prefetch_target_seconds=None,
+):
+    """Create a long-running process to consume batches of messages.
+
+    This works like :py:func:`consume`, but the ``handler`` is called with up
+    to ``batch_size`` messages at a time, waiting up to ``batch_timeout``
+    seconds for the batch to fill up. This lets handlers batch up their work,
+    e.g. writes to a database.
+
+    The ``handler`` function must take 2 arguments:
+
+    * ``context``: a baseplate context
+    * ``messages``: a list of :py:class:`kombu.message.Message`
+
+    Each batch is handled in one server span, tagged with the number of
+    messages. No span is made when the timeout passes without any messages.
+    After the handler exits, all the messages in the batch are acked at once.
+    The handler can ``reject`` or ``requeue`` individual messages and they
+    will be left out. If the whole batch must be retried, the handler should
+    raise an exception to crash the process.
+
+    :param baseplate.core.Baseplate baseplate: A baseplate instance for the
+        service.
+    :param kombu.Exchange exchange:
+    :param kombu.connection.Connection connection:
+    :param str queue_name: The name of the queue.
+    :param list routing_keys: List of routing keys.
+    :param handler: The handler method.
+    :param int batch_size: The maximum number of messages in a batch.
+    :param float batch_timeout: The maximum time to wait, in seconds, for a
+        batch to fill up.
+    :param int prefetch_count: The maximum number of unacknowledged messages
+        the broker will send this consumer. Defaults to ``batch_size``.
+    :param float prefetch_target_seconds: If set, adjust the prefetch count
+        to hold about this many seconds of work, see
+        :py:meth:`BaseKombuConsumer.new`.
+
+    """
+    queues = []
+    for routing_key in routing_keys:
+        queues.append(Queue(name=queue_name, exchange=exchange, routing_key=routing_key))
+
+    logger.info("registering %s as a batch handler for %r", handler.__name__, queues)
+    kombu_consumer = KombuConsumer.new(
+        connection,
+        queues,
+        queue_size=max(batch_size, 100),
+        prefetch_count=prefetch_count or batch_size,
+        prefetch_target_seconds=prefetch_target_seconds,
+    )
+
+    _start_runtime_metrics_reporter(baseplate, kombu_consumer, queue_name)
+
+    logger.info("waiting for messages")
+    while True:
+        # the span isn't started until there are messages, so that an idle
+        # consumer doesn't report a stream of empty ones.
+        messages = BaseKombuConsumer.get_batch(kombu_consumer, batch_size, batch_timeout)
+        if not messages:
+            continue
+
+        context = baseplate.make_context_object()
+        with baseplate.make_server_span(context, queue_name) as span:
+            span.set_tag("message_count", len(messages))
+            start_time = time.monotonic()
+            handler(context, messages)
+            ack_batch(messages)
+            kombu_consumer.record_handled(time.monotonic() - start_time, len(messages))
+
+
+def ack_batch(messages):
+    """Ack all the messages in a batch that haven't been acked or rejected.
+
+    This sends a single ``ack`` for the message with the highest delivery tag
+    with ``multiple`` set. The messages must all have come from the same
+    channel and there must not be other unacknowledged messages with lower
+    delivery tags that should not be acked.
+
+    :param list messages: A list of :py:class:`kombu.message.Message`.
+
+    """
+    unacknowledged = [message for message in messages if not message.acknowledged]
+    if unacknowledged:
+        last_message = max(unacknowledged, key=lambda message: message.delivery_tag)
+        last_message.ack(multiple=True)
+
+
+class _ConsumerReporter:
+    def __init__(self, kombu_consumer, queue_name):
+        self.kombu_consumer = kombu_consumer
+        self.queue_name = queue_name
+
+    def report(self, batch):
+        original_namespace = batch.namespace
+        try:
+            batch.namespace = b".".join((batch.namespace, b"consumer", self.queue_name.encode()))
+            self.kombu_consumer.report_runtime_metrics(batch)
+        finally:
+            batch.namespace = original_namespace
+
+
+def _start_runtime_metrics_reporter(baseplate, kombu_consumer, queue_name):
+    # consumers don't run in baseplate-serve, so they have to start their own
+    # runtime metrics reporting.
+    metrics_client = baseplate._metrics_client  # pylint: disable=protected-access
+    if not metrics_client:
+        return
+
+    # pylint: disable=protected-access
+    reporters = [
+        runtime_monitor._BaseplateReporter(baseplate.get_runtime_metric_reporters()),
+        _ConsumerReporter(kombu_consumer, queue_name),
+    ]
+    thread = Thread(
+        name="Consumer Monitoring",
+        target=runtime_monitor._report_runtime_metrics_periodically,
+        args=(metrics_client, reporters),
+    )
+    thread.daemon = True
+    thread.start()
+
+
+class _ConcurrentHandlers:
+    """A fixed number of threads that each handle one message at a time."""
+
+    def __init__(self, baseplate, kombu_consumer, queue_name, handler):
+        self.baseplate = baseplate
+        self.kombu_consumer = kombu_consumer
+        self.queue_name = queue_name
+        self.handler = handler
+        self.stopping = threading.Event()
+        self.error = None
+
+    def run(self):
+        while not self.stopping.is_set():
+            messages = BaseKombuConsumer.get_batch(
+                self.kombu_consumer, max_items=1, timeout=_STOP_CHECK_INTERVAL
+            )
+            if not messages:
+                continue
+            message = messages[0]
+
+            try:
+                context = self.baseplate.make_context_object()
+                with self.baseplate.make_server_span(context, self.queue_name) as span:
+                    _set_message_tags(span, message)
+                    start_time = time.monotonic()
+                    self.handler(context, message.body, message)
+                message.ack()
+                self.kombu_consumer.record_handled(time.monotonic() - start_time)
+            except Exception as exc:  # pylint: disable=broad-except
+                logger.exception("Unhandled error while handling message, stopping.")
+                self.error = exc
+                self.stopping.set()
+
+
+def _consume_concurrently(baseplate, kombu_consumer, queue_name, handler, concurrency):
+    handlers = _ConcurrentHandlers(baseplate, kombu_consumer, queue_name, handler)
+    threads = []
+    for i in range(concurrency):
+        thread = Thread(target=handlers.run, name="message handler %d" % i)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    try:
+        while not handlers.stopping.is_set():
+            handlers.stopping.wait(_STOP_CHECK_INTERVAL)
+    finally:
+        # let the messages in progress finish, anything not yet handled will
+        # be redelivered by the broker once we disconnect.
+        logger.info("waiting for %d handlers to finish", concurrency)
+        handlers.stopping.set()
+        for thread in threads:
+            thread.join()
+        kombu_consumer.worker.should_stop = True
+
+    if handlers.error is not None:
+        raise handlers.error
+
+
+class _ConsumerStats:
+    """Measurements of a consumer to report with its runtime metrics."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # bounded so a consumer that's never reported doesn't grow forever
+        self.queue_waits = collections.deque(maxlen=_MAX_SAMPLES)
+        self.handler_times = collections.deque(maxlen=_MAX_SAMPLES)
+        # handled is a running total so the handling rate can be measured
+        self.handled = 0
+        self.handled_reported = 0
+        self.redelivered = 0
+        self.time_blocked = 0.0
+
+    def record_handled(self, elapsed, message_count):
+        self.handler_times.append(elapsed)
+        with self.lock:
+            self.handled += message_count
 
 
 class _ConsumerWorker(ConsumerMixin):
-    def __init__(self, connection, queues, work_queue):
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self,
+        connection,
+        queues,
+        work_queue,
+        prefetch_count=None,
+        prefetch_target_seconds=None,
+    ):
         self.connection = connection
         self.queues = queues
         self.work_queue = work_queue
+        self.prefetch_count = prefetch_count
+        self.stats = _ConsumerStats()
+        self.consumer = None
+
+        self.prefetch_target_seconds = prefetch_target_seconds
+        self.min_prefetch_count = prefetch_count or 1
+        self.max_prefetch_count = work_queue.maxsize or _MAX_PREFETCH_COUNT
+        self.rate_checked_at = time.monotonic()
+        self.handled_at_rate_check = 0
 
     def get_consumers(self, Consumer, channel):
-        return [Consumer(queues=self.queues, on_message=self.on_message)]
+        self.consumer = Consumer(
+            queues=self.queues, on_message=self.on_message, prefetch_count=self.prefetch_count
+        )
+        return [self.consumer]
 
     def on_message(self, message):
-        self.work_queue.put(message)
+        if message.delivery_info.get("redelivered"):
+            with self.stats.lock:
+                self.stats.redelivered += 1
+
+        item = (time.monotonic(), message)
+        try:
+            self.work_queue.put_nowait(item)
+        except queue.Full:
+            # this stalls the connection, including heartbeats, until the
+            # handlers catch up.
+            blocked_at = time.monotonic()
+            self.work_queue.put(item)
+            with self.stats.lock:
+                self.stats.time_blocked += time.monotonic() - blocked_at
 
     def get_message(self, block, timeout):
         try:
-            return self.work_queue.get(block=block, timeout=timeout)
+            enqueued_at, message = self.work_queue.get(block=block, timeout=timeout)
         except queue.Empty:
             return None
+        self.stats.queue_waits.append(time.monotonic() - enqueued_at)
+        return message
+
+    def on_iteration(self):
+        # this runs in the message pump's thread between reads from the
+        # connection, so it's safe to use the channel here.
+        if self.prefetch_target_seconds is None or self.consumer is None:
+            return
+
+        now = time.monotonic()
+        elapsed = now - self.rate_checked_at
+        if elapsed < _PREFETCH_ADJUST_INTERVAL:
+            return
+
+        handled = self.stats.handled
+        rate = (handled - self.handled_at_rate_check) / elapsed
+        self.rate_checked_at = now
+        self.handled_at_rate_check = handled
+
+        # enough messages to keep the handlers busy for the target time
+        prefetch_count = int(math.ceil(rate * self.prefetch_target_seconds))
+        prefetch_count = max(self.min_prefetch_count, min(prefetch_count, self.max_prefetch_count))
+        if prefetch_count != self.prefetch_count:
+            logger.debug("adjusting prefetch count to %d", prefetch_count)
+            self.consumer.qos(prefetch_count=prefetch_count)
+            self.prefetch_count = prefetch_count
 
 
 class BaseKombuConsumer:
@@ -95,7 +431,9 @@ class BaseKombuConsumer:
         self.worker_thread = worker_thread
 
     @classmethod
-    def new(cls, connection, queues, queue_size=100):
+    def new(
+        cls, connection, queues, queue_size=100, prefetch_count=None, prefetch_target_seconds=None
+    ):
         """Create and initialize a consumer.
 
         :param kombu.Exchange exchange:
@@ -103,10 +441,20 @@ class BaseKombuConsumer:
         :param int queue_size: (Optional) The maximum number of messages to cache
             in the internal `queue.Queue` worker queue.  Defaults to 100.  For
             an infinite size (not recommended), use `queue_size=0`.
+        :param int prefetch_count: (Optional) The maximum number of
+            unacknowledged messages the broker will send. Defaults to
+            unlimited.
+        :param float prefetch_target_seconds: (Optional) If set, the prefetch
+            count is periodically adjusted to roughly this many seconds worth
+            of messages at the rate they're being handled, as recorded with
+            :py:meth:`record_handled`. It won't go below ``prefetch_count``
+            or above ``queue_size``.
 
         """
         work_queue = queue.Queue(maxsize=queue_size)
-        worker = _ConsumerWorker(connection, queues, work_queue)
+        worker = _ConsumerWorker(
+            connection, queues, work_queue, prefetch_count, prefetch_target_seconds
+        )
         worker_thread = Thread(target=worker.run)
         worker_thread.name = "consumer message pump"
         worker_thread.daemon = True
@@ -119,6 +467,50 @@ class BaseKombuConsumer:
         batch = self.get_batch(max_items=1, timeout=None)
         return batch[0]
 
+    def record_handled(self, elapsed, message_count=1):
+        """Record that messages were handled.
+
+        This feeds the handler latency metrics and prefetch count adjustment.
+
+        :param float elapsed: How long, in seconds, handling took.
+        :param int message_count: How many messages were handled.
+
+        """
+        self.worker.stats.record_handled(elapsed, message_count)
+
+    def report_runtime_metrics(self, batch):
+        """Report the consumer's state to the stats system.
+
+        * ``work_queue.depth``: messages received but not yet handled.
+        * ``work_queue.wait``: time each message spent in the work queue.
+        * ``work_queue.blocked``: time receiving from the broker was stalled
+          because the work queue was full.
+        * ``handler.latency``: a histogram of handler times in milliseconds.
+        * ``messages.handled``, ``messages.redelivered``: message counts.
+        * ``prefetch_count``: the current prefetch count, if there is one.
+
+        """
+        worker = self.worker
+        stats = worker.stats
+        with stats.lock:
+            handled = stats.handled - stats.handled_reported
+            stats.handled_reported = stats.handled
+            redelivered, stats.redelivered = stats.redelivered, 0
+            time_blocked, stats.time_blocked = stats.time_blocked, 0.0
+
+        batch.gauge("work_queue.depth").replace(worker.work_queue.qsize())
+        if worker.prefetch_count:
+            batch.gauge("prefetch_count").replace(worker.prefetch_count)
+        batch.timer("work_queue.blocked").send(time_blocked)
+        batch.counter("messages.handled").increment(handled)
+        batch.counter("messages.redelivered").increment(redelivered)
+
+        for _ in range(len(stats.queue_waits)):
+            batch.timer("work_queue.wait").send(stats.queue_waits.popleft())
+        latency = batch.histogram("handler.latency")
+        for _ in range(len(stats.handler_times)):
+            latency.add_sample(stats.handler_times.popleft() * 1000)
+
     def get_batch(self, max_items, timeout):
         """Return a batch of messages.
 
@@ -165,19 +557,7 @@ class KombuConsumer(BaseKombuConsumer):
         with child_span:
             messages = BaseKombuConsumer.get_batch(self, max_items=1, timeout=None)
             message = messages[0]
-
-            routing_key = message.delivery_info.get("routing_key", "")
-            child_span.set_tag("routing_key", routing_key)
-
-            consumer_tag = message.delivery_info.get("consumer_tag", "")
-            child_span.set_tag("consumer_tag", consumer_tag)
-
-            delivery_tag = message.delivery_info.get("delivery_tag", "")
-            child_span.set_tag("delivery_tag", delivery_tag)
-
-            exchange = message.delivery_info.get("exchange", "")
-            child_span.set_tag("exchange", exchange)
-
+            _set_message_tags(child_span, message)
             return message
 
     def get_batch(self, server_span, max_items, timeout):  # pylint: disable=arguments-differ
@@ -107,9 +107,14 @@ class TimeBudgetRetryPolicy(RetryPolicy):
     def yield_attempts(self) -> Iterator[Optional[float]]:
         start_time = time.time()
 
-        yield self.budget
-
-        for _ in self.subpolicy:
+        attempts = iter(self.subpolicy)
+        # the first attempt gets the whole budget, but it still has to come
+        # out of the subpolicy so its limits (e.g. on attempts) are respected.
+        for _ in attempts:
+            yield self.budget
+            break
+
+        for _ in attempts:
             elapsed = time.time() - start_time
             time_remaining = self.budget - elapsed
             if time_remaining <= 0:
@@ -9,6 +9,15 @@ from thrift.transport.TTransport import TTransportException, TBufferedTransportF
 
 from baseplate import config
 from baseplate.server import runtime_monitor
+from baseplate.thrift_compression import THeaderCompressionProtocolFactory
+
+
+# allow non-headerprotocol clients to talk with us
+_ALLOWED_CLIENT_TYPES = [
+    THeaderClientType.HEADERS,
+    THeaderClientType.FRAMED_BINARY,
+    THeaderClientType.UNFRAMED_BINARY,
+]
 
 
 # pylint: disable=too-many-public-methods
@@ -16,14 +25,7 @@ class GeventServer(StreamServer):
     def __init__(self, processor, *args, **kwargs):
         self.processor = processor
         self.transport_factory = TBufferedTransportFactory()
-        self.protocol_factory = THeaderProtocolFactory(
-            # allow non-headerprotocol clients to talk with us
-            allowed_client_types=[
-                THeaderClientType.HEADERS,
-                THeaderClientType.FRAMED_BINARY,
-                THeaderClientType.UNFRAMED_BINARY,
-            ]
-        )
+        self.protocol_factory = THeaderProtocolFactory(allowed_client_types=_ALLOWED_CLIENT_TYPES)
         super(GeventServer, self).__init__(*args, **kwargs)
 
     def serve_forever(self, stop_timeout=None):
@@ -55,12 +57,21 @@ def make_server(server_config, listener, app):
         {
             "max_concurrency": config.Integer,
             "stop_timeout": config.Optional(config.Integer, default=0),
+            "compression": config.Optional(config.OneOf(zlib="zlib")),
+            "compression_threshold": config.Optional(config.Integer, default=1024),
         },
     )
 
     pool = Pool(size=cfg.max_concurrency)
     server = GeventServer(processor=app, listener=listener, spawn=pool)
     server.stop_timeout = cfg.stop_timeout
+    if cfg.compression is not None:
+        # only clients that say they can take compressed responses get them
+        server.protocol_factory = THeaderCompressionProtocolFactory(
+            compression=cfg.compression,
+            threshold=cfg.compression_threshold,
+            allowed_client_types=_ALLOWED_CLIENT_TYPES,
+        )
 
     runtime_monitor.start(server_config, app, pool)
     return server
@@ -0,0 +1,91 @@
+"""Share the result of identical calls made at the same time.
+
+When a popular cache entry expires, every request that wants it misses at
+once and they all go to the backend for the same thing. With
+:py:class:`SingleFlight`, the first of those requests (in the same process)
+makes the call and the others wait for its result instead.
+
+Clients can do this for you, see the ``coalesce`` parameter of
+:py:class:`~baseplate.context.thrift.ThriftContextFactory`,
+:py:class:`~baseplate.context.memcache.MemcacheContextFactory`, and
+:py:class:`~baseplate.context.redis.RedisContextFactory`.
+
+"""
+
+import threading
+
+
+class _Abandoned(Exception):
+    pass
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Coalesce concurrent calls with the same key into one call.
+
+    This works across threads, and across greenlets if gevent is
+    monkeypatched in. Calls are only shared while they're in flight, results
+    aren't remembered after that.
+
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+
+    def do(self, key, function, wait_context=None):
+        """Call ``function`` unless a call with the same key is in flight.
+
+        If one is, wait for it to finish and return (or raise) what it did.
+        Returns a tuple of the result and whether it was shared with another
+        call.
+
+        :param key: A hashable key identifying the call.
+        :param function: The call to make, with no arguments.
+        :param wait_context: If given, a function returning a context manager
+            to wait for another call in, e.g. to make a span for the wait.
+
+        """
+        while True:
+            with self.lock:
+                flight = self.flights.get(key)
+                if flight is None:
+                    flight = _Flight()
+                    self.flights[key] = flight
+                    break
+
+            try:
+                if wait_context is not None:
+                    with wait_context():
+                        return self._wait(flight), True
+                return self._wait(flight), True
+            except _Abandoned:
+                # the call was interrupted (e.g. its greenlet was killed),
+                # which is no reason for this one to fail. try again.
+                continue
+
+        try:
+            flight.result = function()
+        except BaseException as exc:
+            flight.error = exc
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+        return flight.result, False
+
+    @staticmethod
+    def _wait(flight):
+        flight.done.wait()
+        if flight.error is not None:
+            if not isinstance(flight.error, Exception):
+                raise _Abandoned
+            raise flight.error
+        return flight.result
@@ -0,0 +1,111 @@
+"""Compress large Thrift messages sent with THeaderProtocol.
+
+THeaderProtocol can apply transforms, like zlib compression, to the payload
+of each message. Every THeaderProtocol implementation can read zlib
+compressed messages, but compressing small messages costs more CPU than it
+saves in bandwidth, so :py:class:`THeaderCompressionProtocolFactory` only
+compresses messages over a size threshold.
+
+Both ends tell their peer that they can read compressed messages with an
+``Accept-Compression`` header on each message, and only compress messages to
+a peer once it has sent that header. Clients therefore send their first
+request on each connection uncompressed, and older clients and servers keep
+getting uncompressed messages.
+
+Compression is enabled with the ``compression`` configuration key of
+:py:func:`~baseplate.thrift_pool.thrift_pool_from_config` and of the
+``baseplate.server.thrift`` server.
+
+"""
+
+from thrift.protocol.THeaderProtocol import THeaderProtocol, THeaderProtocolFactory
+from thrift.transport.THeaderTransport import (
+    THeaderClientType,
+    THeaderSubprotocolID,
+    THeaderTransformID,
+    THeaderTransport,
+)
+
+
+ACCEPT_COMPRESSION_HEADER = b"Accept-Compression"
+
+# the transforms the thrift library can both write and read. it only knows
+# zlib and rejects messages with any other transform, so others (like zstd)
+# can't be used without breaking peers.
+_TRANSFORMS = {"zlib": THeaderTransformID.ZLIB}
+
+_TRANSFORM_NAMES = {transform_id: name.encode() for name, transform_id in _TRANSFORMS.items()}
+
+
+class _CompressingTransport(THeaderTransport):
+    def __init__(self, transport, allowed_client_types, default_protocol, factory):
+        super().__init__(transport, allowed_client_types, default_protocol)
+        self.transform_id = factory.transform_id
+        self.transform_name = _TRANSFORM_NAMES[factory.transform_id]
+        self.threshold = factory.threshold
+        self.message_size = 0
+
+    def write(self, buf):
+        super().write(buf)
+        self.message_size += len(buf)
+
+    def _peer_accepts_compression(self):
+        # the headers of the last message we read from the peer, clients that
+        # don't speak the header protocol never send any.
+        accepted = self.get_headers().get(ACCEPT_COMPRESSION_HEADER, b"")
+        return self.transform_name in accepted.split(b",")
+
+    def flush(self):
+        # headers only last for one message, so this goes on every one.
+        self.set_header(ACCEPT_COMPRESSION_HEADER, self.transform_name)
+
+        compress = self.message_size >= self.threshold and self._peer_accepts_compression()
+        self.message_size = 0
+        if not compress:
+            super().flush()
+            return
+
+        self.add_transform(self.transform_id)
+        try:
+            super().flush()
+        finally:
+            # transforms otherwise apply to every later message, and there's
+            # no public way to remove one.
+            self._write_transforms.remove(self.transform_id)
+
+
+class THeaderCompressionProtocolFactory(THeaderProtocolFactory):
+    """A THeaderProtocol factory that compresses large messages.
+
+    :param str compression: The compression to use. Only ``zlib`` is
+        supported.
+    :param int threshold: The size, in bytes, of the smallest message payload
+        to compress.
+
+    Messages are only compressed if the peer sent an ``Accept-Compression``
+    header for the same compression with the last message it sent. The same
+    factory is used by clients and servers.
+
+    The other parameters are the same as those of
+    :py:class:`~thrift.protocol.THeaderProtocol.THeaderProtocolFactory`.
+
+    """
+
+    def __init__(
+        self,
+        compression="zlib",
+        threshold=1024,
+        allowed_client_types=(THeaderClientType.HEADERS,),
+        default_protocol=THeaderSubprotocolID.BINARY,
+    ):
+        if compression not in _TRANSFORMS:
+            raise ValueError("unsupported compression: {!r}".format(compression))
+        super().__init__(allowed_client_types, default_protocol)
+        self.transform_id = _TRANSFORMS[compression]
+        self.threshold = threshold
+
+    def getProtocol(self, trans):
+        trans = _CompressingTransport(
+            trans, self.allowed_client_types, self.default_protocol, factory=self
+        )
+        return THeaderProtocol(trans, self.allowed_client_types, self.default_protocol)
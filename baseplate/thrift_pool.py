@@ -4,7 +4,20 @@
     a convenient way to integrate the pool with your application.
 
 The pool lazily creates connections and maintains them in a pool. Individual
-connections have a maximum lifetime, after which they will be recycled.
+connections have a maximum lifetime, after which they will be recycled. The
+lifetimes are jittered so that connections opened together aren't all
+recycled together. With ``min_idle`` set, a background thread also opens
+connections ahead of time and replaces ones that are about to expire, so
+requests rarely wait on connecting.
+
+A :py:class:`ConcurrencyLimit` can be used instead of relying on the pool's
+fixed ``size`` to bound how many requests are in flight. It adapts the limit
+to the backend's latency and refuses requests over it immediately rather than
+making them wait for a connection.
+
+To connect directly to the backends of a service, rather than through a local
+proxy, use :py:class:`BalancedThriftConnectionPool` which spreads requests
+over the backends listed in a service discovery inventory.
 
 A basic example of usage::
 
@@ -15,11 +28,16 @@ A basic example of usage::
 
 """
 
+import collections
 import contextlib
 import logging
+import math
 import queue
+import random
 import socket
+import threading
 import time
+import weakref
 
 from thrift.protocol import THeaderProtocol
 from thrift.protocol.TProtocol import TProtocolException
@@ -28,12 +46,23 @@ from thrift.transport import TSocket
 from thrift.transport.TTransport import TTransportException
 
 from baseplate import config
+from baseplate.random import WeightedLottery
 from baseplate.retry import RetryPolicy
+from baseplate.service_discovery import Backend, ServiceInventory
+from baseplate.thrift_compression import THeaderCompressionProtocolFactory
 
 
 logger = logging.getLogger(__name__)
 
 
+# how often (seconds) a balanced pool checks its inventory for changes
+_INVENTORY_REFRESH_INTERVAL = 1
+# how often (seconds) the maintainer opens and refreshes idle connections
+_MAINTENANCE_INTERVAL = 1
+# the most timing samples to hold between runtime metrics reports
+_MAX_SAMPLES = 1000
+
+
 def _make_transport(endpoint):
     if endpoint.family == socket.AF_INET:
         trans = TSocket.TSocket(*endpoint.address)
@@ -58,8 +87,12 @@ def thrift_pool_from_config(app_config, prefix, **kwargs):
 
     Supported keys:
 
-    * ``endpoint`` (required): A ``host:port`` pair, e.g. ``localhost:2014``,
-        where the Thrift server can be found.
+    * ``endpoint``: A ``host:port`` pair, e.g. ``localhost:2014``, where the
+        Thrift server can be found.
+    * ``inventory``: The path to a Synapse-generated inventory file listing
+        the service's backends. If given, a
+        :py:class:`BalancedThriftConnectionPool` is made instead and
+        ``endpoint`` is not needed.
     * ``size``: The size of the connection pool.
     * ``max_age``: The oldest a connection can be before it's recycled and
         replaced with a new one. Written as a time span e.g. ``1 minute``.
@@ -67,16 +100,56 @@ def thrift_pool_from_config(app_config, prefix, **kwargs):
         can take before a TimeoutError is raised.
     * ``max_retries``: The maximum number of times the pool will attempt to
         open a connection.
+    * ``max_age_jitter``: The fraction of ``max_age`` that each connection's
+        lifetime is randomly shortened by.
+    * ``min_idle``: The number of idle connections to keep open in the
+        background.
+    * ``circuit_breaker.failure_ratio``: If set, a :py:class:`CircuitBreaker`
+        that opens when this fraction of requests fail is used. Its other
+        parameters can be set with ``circuit_breaker.min_requests``,
+        ``circuit_breaker.window``, ``circuit_breaker.open_duration``, and
+        ``circuit_breaker.slow_call_duration``, the last three being time
+        spans.
+    * ``concurrency_limit.initial_limit``: If set, a
+        :py:class:`ConcurrencyLimit` starting at this limit is used. Its other
+        parameters can be set with ``concurrency_limit.min_limit``,
+        ``concurrency_limit.max_limit``, ``concurrency_limit.backoff_ratio``,
+        and ``concurrency_limit.tolerance``.
+    * ``compression``: If set to ``zlib``, the server is told it may
+        compress its responses, and once it says the same, requests larger
+        than ``compression_threshold`` bytes (default 1024) are compressed.
+        See :py:mod:`baseplate.thrift_compression`.
 
     """
     assert prefix.endswith(".")
     parser = config.SpecParser(
         {
-            "endpoint": config.Endpoint,
+            "endpoint": config.Optional(config.Endpoint),
+            "inventory": config.Optional(config.String),
             "size": config.Optional(config.Integer, default=10),
             "max_age": config.Optional(config.Timespan, default=config.Timespan("1 minute")),
             "timeout": config.Optional(config.Timespan, default=config.Timespan("1 second")),
             "max_retries": config.Optional(config.Integer, default=3),
+            "max_age_jitter": config.Optional(config.Float),
+            "min_idle": config.Optional(config.Integer),
+            "circuit_breaker": {
+                "failure_ratio": config.Optional(config.Float),
+                "min_requests": config.Optional(config.Integer, default=20),
+                "window": config.Optional(config.Timespan, default=config.Timespan("10 seconds")),
+                "open_duration": config.Optional(
+                    config.Timespan, default=config.Timespan("5 seconds")
+                ),
+                "slow_call_duration": config.Optional(config.Timespan),
+            },
+            "concurrency_limit": {
+                "initial_limit": config.Optional(config.Integer),
+                "min_limit": config.Optional(config.Integer, default=1),
+                "max_limit": config.Optional(config.Integer),
+                "backoff_ratio": config.Optional(config.Float, default=0.9),
+                "tolerance": config.Optional(config.Float, default=2.0),
+            },
+            "compression": config.Optional(config.OneOf(zlib="zlib")),
+            "compression_threshold": config.Optional(config.Integer, default=1024),
         }
     )
     options = parser.parse(prefix[:-1], app_config)
@@ -89,10 +162,394 @@ def thrift_pool_from_config(app_config, prefix, **kwargs):
         kwargs.setdefault("timeout", options.timeout.total_seconds())
     if options.max_retries is not None:
         kwargs.setdefault("max_retries", options.max_retries)
+    if options.max_age_jitter is not None:
+        kwargs.setdefault("max_age_jitter", options.max_age_jitter)
+    if options.min_idle is not None:
+        kwargs.setdefault("min_idle", options.min_idle)
+    if options.circuit_breaker.failure_ratio is not None:
+        breaker = options.circuit_breaker
+        slow_call_duration = None
+        if breaker.slow_call_duration is not None:
+            slow_call_duration = breaker.slow_call_duration.total_seconds()
+        kwargs.setdefault(
+            "circuit_breaker",
+            CircuitBreaker(
+                failure_ratio=breaker.failure_ratio,
+                min_requests=breaker.min_requests,
+                window=breaker.window.total_seconds(),
+                open_duration=breaker.open_duration.total_seconds(),
+                slow_call_duration=slow_call_duration,
+            ),
+        )
+
+    if options.concurrency_limit.initial_limit is not None:
+        limit = options.concurrency_limit
+        kwargs.setdefault(
+            "concurrency_limit",
+            ConcurrencyLimit(
+                initial_limit=limit.initial_limit,
+                min_limit=limit.min_limit,
+                max_limit=limit.max_limit,
+                backoff_ratio=limit.backoff_ratio,
+                tolerance=limit.tolerance,
+            ),
+        )
 
+    if options.compression is not None:
+        kwargs.setdefault(
+            "protocol_factory",
+            THeaderCompressionProtocolFactory(
+                compression=options.compression, threshold=options.compression_threshold
+            ),
+        )
+
+    if options.inventory:
+        return BalancedThriftConnectionPool(ServiceInventory(options.inventory), **kwargs)
+
+    if options.endpoint is None:
+        raise config.ConfigurationError(
+            prefix + "endpoint", "one of endpoint or inventory is required"
+        )
     return ThriftConnectionPool(endpoint=options.endpoint, **kwargs)
 
 
+class CircuitBreakerOpenError(TTransportException):
+    """Raised instead of connecting while a circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """Fail fast instead of waiting on a backend that's failing.
+
+    The outcomes of requests are counted over a rolling window. Once at least
+    ``min_requests`` were made in the window and ``failure_ratio`` of them
+    failed (or took longer than ``slow_call_duration``), the breaker opens and
+    requests are refused immediately for ``open_duration`` seconds. After
+    that, the breaker is half-open and lets one trial request through. If it
+    succeeds the breaker closes again, otherwise it re-opens.
+
+    :param float failure_ratio: The fraction of requests that must fail to
+        open the breaker.
+    :param int min_requests: The fewest requests in the window to act on.
+    :param float window: The number of seconds of requests to consider.
+    :param float open_duration: The number of seconds to refuse requests for.
+    :param float slow_call_duration: If set, requests that take at least this
+        many seconds count as failures.
+
+    """
+
+    CLOSED = "closed"
+    HALF_OPEN = "half_open"
+    OPEN = "open"
+
+    # the window is divided into this many buckets which expire one at a time
+    _BUCKETS = 10
+
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self,
+        failure_ratio=0.5,
+        min_requests=20,
+        window=10,
+        open_duration=5,
+        slow_call_duration=None,
+    ):
+        if not 0 < failure_ratio <= 1:
+            raise ValueError("failure_ratio must be greater than 0 and at most 1")
+
+        self.failure_ratio = failure_ratio
+        self.min_requests = min_requests
+        self.window = window
+        self.open_duration = open_duration
+        self.slow_call_duration = slow_call_duration
+
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        # [bucket number, requests, failures] for each bucket in the window
+        self.buckets = collections.deque()
+        self.requests = 0
+        self.failures = 0
+        self.trips = 0
+        self.rejected = 0
+
+    def copy(self):
+        """Return a new breaker with the same settings."""
+        return self.__class__(
+            failure_ratio=self.failure_ratio,
+            min_requests=self.min_requests,
+            window=self.window,
+            open_duration=self.open_duration,
+            slow_call_duration=self.slow_call_duration,
+        )
+
+    @property
+    def available(self):
+        """Whether a request would currently be allowed."""
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.OPEN:
+            return time.monotonic() >= self.opened_at + self.open_duration
+        return not self.trial_in_flight
+
+    def allow(self):
+        """Return if a request may be made.
+
+        The outcome of each allowed request must be passed to :py:meth:`record`.
+
+        """
+        if self.state == self.CLOSED:
+            return True
+
+        with self.lock:
+            if self.state == self.OPEN:
+                if time.monotonic() < self.opened_at + self.open_duration:
+                    self.rejected += 1
+                    return False
+                self.state = self.HALF_OPEN
+                self.trial_in_flight = False
+
+            if self.state == self.HALF_OPEN:
+                if self.trial_in_flight:
+                    self.rejected += 1
+                    return False
+                self.trial_in_flight = True
+            return True
+
+    def record(self, succeeded, elapsed):
+        """Record the outcome of an allowed request.
+
+        :param bool succeeded: If the request succeeded, or ``None`` if it
+            never reached the backend and shouldn't count either way.
+        :param float elapsed: How long the request took, in seconds.
+
+        """
+        failed = succeeded is False or (
+            succeeded
+            and self.slow_call_duration is not None
+            and elapsed >= self.slow_call_duration
+        )
+        now = time.monotonic()
+
+        with self.lock:
+            if self.state == self.OPEN:
+                # a straggler from before the breaker opened
+                return
+
+            if self.state == self.HALF_OPEN:
+                if succeeded is None:
+                    self.trial_in_flight = False
+                elif failed:
+                    self._open(now)
+                else:
+                    self.state = self.CLOSED
+                    self._reset()
+                return
+
+            if succeeded is None:
+                return
+
+            bucket = int(now * self._BUCKETS / self.window)
+            while self.buckets and self.buckets[0][0] <= bucket - self._BUCKETS:
+                _, requests, failures = self.buckets.popleft()
+                self.requests -= requests
+                self.failures -= failures
+            if not self.buckets or self.buckets[-1][0] != bucket:
+                self.buckets.append([bucket, 0, 0])
+
+            self.buckets[-1][1] += 1
+            self.requests += 1
+            if failed:
+                self.buckets[-1][2] += 1
+                self.failures += 1
+
+                if (
+                    self.requests >= self.min_requests
+                    and self.failures >= self.failure_ratio * self.requests
+                ):
+                    self._open(now)
+
+    def _open(self, now):
+        self.state = self.OPEN
+        self.opened_at = now
+        self.trial_in_flight = False
+        self.trips += 1
+        self._reset()
+
+    def _reset(self):
+        self.buckets.clear()
+        self.requests = 0
+        self.failures = 0
+
+    def take_counts(self):
+        """Return and reset the number of trips and rejected requests."""
+        with self.lock:
+            counts = (self.trips, self.rejected)
+            self.trips = 0
+            self.rejected = 0
+        return counts
+
+
+class ConcurrencyLimitExceededError(TTransportException):
+    """Raised instead of waiting when a concurrency limit is reached."""
+
+
+class ConcurrencyLimit:
+    """Adapt the number of requests in flight to a backend's latency.
+
+    The limit is adjusted with additive increase, multiplicative decrease
+    (AIMD). Each request that succeeds while at least half the limit is in use
+    raises the limit by ``1 / limit``, so by about one per round of requests.
+    The limit is multiplied by ``backoff_ratio`` when a request fails, or when
+    the backend's recent latency gets ``tolerance`` times longer than its
+    baseline. Requests over the limit are refused immediately.
+
+    Latency is compared as a moving average of the last few requests against
+    a slower moving average over about ``baseline_window`` seconds, rather
+    than request by request, so that the normal spread of a healthy backend's
+    latencies isn't taken for overload. Requests queueing somewhere push the
+    recent average up well before the baseline catches up. Only the time
+    spent on the call itself is counted, not waiting for or opening a
+    connection.
+
+    :param int initial_limit: The limit to start with.
+    :param int min_limit: The lowest the limit can go.
+    :param int max_limit: The highest the limit can go. Defaults to the size
+        of the pool it's used with.
+    :param float backoff_ratio: What to multiply the limit by when backing
+        off.
+    :param float tolerance: How many times longer than the baseline the
+        recent latency can get before it's considered a sign of overload.
+    :param float baseline_window: The number of seconds the baseline latency
+        is averaged over.
+
+    """
+
+    # how much each request moves the recent latency average, it follows
+    # about the last 1 / _SMOOTHING requests.
+    _SMOOTHING = 0.1
+
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self,
+        initial_limit=10,
+        min_limit=1,
+        max_limit=None,
+        backoff_ratio=0.9,
+        tolerance=2.0,
+        baseline_window=60,
+    ):
+        if not 0 < backoff_ratio < 1:
+            raise ValueError("backoff_ratio must be between 0 and 1")
+        if tolerance < 1:
+            raise ValueError("tolerance must be at least 1")
+
+        self.initial_limit = initial_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff_ratio = backoff_ratio
+        self.tolerance = tolerance
+        self.baseline_window = baseline_window
+
+        self.lock = threading.Lock()
+        self.limit = float(self._clamp(initial_limit))
+        self.in_flight = 0
+        self.backed_off_at = 0.0
+        self.recent_latency = None
+        self.baseline_latency = None
+        self.baseline_updated_at = 0.0
+        self.rejected = 0
+
+    def copy(self, max_limit=None):
+        """Return a new limit with the same settings."""
+        return self.__class__(
+            initial_limit=self.initial_limit,
+            min_limit=self.min_limit,
+            max_limit=self.max_limit if self.max_limit is not None else max_limit,
+            backoff_ratio=self.backoff_ratio,
+            tolerance=self.tolerance,
+            baseline_window=self.baseline_window,
+        )
+
+    def _clamp(self, limit):
+        if self.max_limit is not None:
+            limit = min(limit, self.max_limit)
+        return max(limit, self.min_limit)
+
+    @property
+    def available(self):
+        """Whether a request would currently be allowed."""
+        return self.in_flight < int(self.limit)
+
+    def acquire(self):
+        """Return if a request may be made.
+
+        Each acquired request must be passed to :py:meth:`release`.
+
+        """
+        with self.lock:
+            if self.in_flight >= int(self.limit):
+                self.rejected += 1
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self, succeeded, elapsed):
+        """Record the outcome of an acquired request.
+
+        :param bool succeeded: If the request succeeded, or ``None`` if it
+            never reached the backend and shouldn't count either way.
+        :param float elapsed: How long the call took, in seconds.
+
+        """
+        now = time.monotonic()
+
+        with self.lock:
+            in_flight = self.in_flight
+            self.in_flight -= 1
+
+            if succeeded is None:
+                return
+
+            if succeeded:
+                overloaded = self._record_latency(elapsed, now)
+            else:
+                overloaded = True
+
+            if overloaded:
+                # requests that started before the last back off were already
+                # accounted for by it, otherwise a burst of slow requests
+                # would cut the limit over and over.
+                if now - elapsed >= self.backed_off_at:
+                    self.limit = self._clamp(self.limit * self.backoff_ratio)
+                    self.backed_off_at = now
+            elif in_flight * 2 >= self.limit:
+                self.limit = self._clamp(self.limit + 1 / self.limit)
+
+    def _record_latency(self, elapsed, now):
+        if self.recent_latency is None:
+            self.recent_latency = self.baseline_latency = elapsed
+            self.baseline_updated_at = now
+            return False
+
+        self.recent_latency += self._SMOOTHING * (elapsed - self.recent_latency)
+        # weighted by time rather than by request, so the baseline moves at
+        # the same pace however busy the backend is.
+        weight = math.exp((self.baseline_updated_at - now) / self.baseline_window)
+        self.baseline_latency = self.recent_latency + weight * (
+            self.baseline_latency - self.recent_latency
+        )
+        self.baseline_updated_at = now
+        return self.recent_latency > self.tolerance * self.baseline_latency
+
+    def take_rejected(self):
+        """Return and reset the number of rejected requests."""
+        with self.lock:
+            rejected, self.rejected = self.rejected, 0
+        return rejected
+
+
 class ThriftConnectionPool:
     """A pool that maintains a queue of open Thrift connections.
 
@@ -102,6 +559,9 @@ class ThriftConnectionPool:
         before new attempts to open block.
     :param int max_age: The maximum number of seconds a connection should be
         kept alive. Connections older than this will be reaped.
+    :param float max_age_jitter: The fraction of ``max_age`` that each
+        connection's lifetime is randomly shortened by, to spread out
+        reconnects.
     :param int timeout: The maximum number of seconds a connection attempt or
         RPC call can take before a TimeoutError is raised.
     :param int max_retries: The maximum number of times the pool will attempt
@@ -109,6 +569,15 @@ class ThriftConnectionPool:
     :param protocol_factory: The factory to use for creating protocols from
         transports. This is useful for talking to services that don't support
         THeaderProtocol.
+    :param int min_idle: If set, a background thread opens connections until
+        at least this many are idle in the pool, and replaces idle connections
+        shortly before they reach their maximum age. Nothing is opened while
+        the circuit breaker is open.
+    :param CircuitBreaker circuit_breaker: If given, connections are refused
+        with :py:exc:`CircuitBreakerOpenError` while the breaker is open.
+    :param ConcurrencyLimit concurrency_limit: If given, connections over the
+        limit are refused with :py:exc:`ConcurrencyLimitExceededError`. A copy
+        is used, capped at ``size`` unless it has its own ``max_limit``.
 
     All exceptions raised by this class derive from
     :py:exc:`~thrift.transport.TTransport.TTransportException`.
@@ -124,48 +593,90 @@ class ThriftConnectionPool:
         timeout=1,
         max_retries=3,
         protocol_factory=THeaderProtocol.THeaderProtocolFactory(),
+        max_age_jitter=0.1,
+        min_idle=0,
+        circuit_breaker=None,
+        concurrency_limit=None,
     ):
         self.endpoint = endpoint
         self.max_age = max_age
+        self.max_age_jitter = max_age_jitter
         self.retry_policy = RetryPolicy.new(attempts=max_retries)
         self.timeout = timeout
         self.protocol_factory = protocol_factory
+        self.min_idle = min(min_idle, size)
+        self.circuit_breaker = circuit_breaker
+        self.concurrency_limit = None
+        if concurrency_limit is not None:
+            self.concurrency_limit = concurrency_limit.copy(max_limit=size)
+        self.closed = False
+
+        self.stats_lock = threading.Lock()
+        self.connects = 0
+        self.connect_failures = 0
+        self.connect_times = collections.deque(maxlen=_MAX_SAMPLES)
+        self.acquire_times = collections.deque(maxlen=_MAX_SAMPLES)
+        self.acquire_timeouts = 0
+        self.max_age_closes = 0
+        self.error_closes = 0
 
         self.size = size
         self.pool = queue.LifoQueue()
         for _ in range(size):
             self.pool.put(None)
 
-    def _acquire(self):
+        if self.min_idle:
+            _maintainer.add(self)
+
+    def _connect(self):
+        trans = _make_transport(self.endpoint)
+        trans.setTimeout(self.timeout * 1000.0)
+        prot = self.protocol_factory.getProtocol(trans)
+
+        start_time = time.monotonic()
+        try:
+            prot.trans.open()
+        except TTransportException:
+            with self.stats_lock:
+                self.connect_failures += 1
+            raise
+        elapsed = time.monotonic() - start_time
+
+        with self.stats_lock:
+            self.connects += 1
+        self.connect_times.append(elapsed)
+
+        prot.baseplate_birthdate = time.time()
+        prot.baseplate_cancelled = False
+        prot.baseplate_max_age = self.max_age * (1 - self.max_age_jitter * random.random())
+        return prot
+
+    def _get_slot(self):
         try:
-            prot = self.pool.get(block=True, timeout=self.timeout)
+            return self.pool.get(block=True, timeout=self.timeout)
         except queue.Empty:
+            with self.stats_lock:
+                self.acquire_timeouts += 1
             raise TTransportException(
                 type=TTransportException.NOT_OPEN, message="timed out waiting for a connection slot"
             )
 
+    def _open_slot(self, prot):
         for _ in self.retry_policy:
             if prot:
-                if time.time() - prot.baseplate_birthdate < self.max_age:
+                if time.time() - prot.baseplate_birthdate < prot.baseplate_max_age:
                     return prot
                 prot.trans.close()
                 prot = None
-
-            trans = _make_transport(self.endpoint)
-            trans.setTimeout(self.timeout * 1000.0)
-            prot = self.protocol_factory.getProtocol(trans)
+                with self.stats_lock:
+                    self.max_age_closes += 1
 
             try:
-                prot.trans.open()
+                return self._connect()
             except TTransportException as exc:
                 logger.info("Failed to connect to %r: %s", self.endpoint, exc)
-                prot = None
                 continue
 
-            prot.baseplate_birthdate = time.time()
-
-            return prot
-
         self.pool.put(None)
 
         raise TTransportException(
@@ -174,11 +685,151 @@ class ThriftConnectionPool:
         )
 
     def _release(self, prot):
-        if prot.trans.isOpen():
+        if self.closed:
+            prot.trans.close()
+            self.pool.put(None)
+        elif prot.trans.isOpen():
             self.pool.put(prot)
         else:
+            # closed because something went wrong with it, unless we gave up
+            # on the request ourselves.
+            if not getattr(prot, "baseplate_cancelled", False):
+                with self.stats_lock:
+                    self.error_closes += 1
+            self.pool.put(None)
+
+    def _take_idle(self):
+        idle = []
+        while True:
+            try:
+                idle.append(self.pool.get_nowait())
+            except queue.Empty:
+                return idle
+
+    def _take_slot_to_maintain(self):
+        # take all the idle connections out of the pool at once to find the
+        # one slot that needs work most. the rest are put right back.
+        idle = self._take_idle()
+
+        expiring_at = time.time() + 2 * _MAINTENANCE_INTERVAL
+        chosen = None
+        empty_slots = [i for i, prot in enumerate(idle) if prot is None]
+        for i, prot in enumerate(idle):
+            if prot and prot.baseplate_birthdate + prot.baseplate_max_age <= expiring_at:
+                chosen = i
+                break
+        else:
+            if empty_slots and len(idle) - len(empty_slots) < self.min_idle:
+                chosen = empty_slots[-1]
+
+        # the first one out was the most recently used so it goes back last
+        for i in reversed(range(len(idle))):
+            if i != chosen:
+                self.pool.put(idle[i])
+
+        if chosen is None:
+            return False, None
+        return True, idle[chosen]
+
+    def _maintain(self):
+        breaker = self.circuit_breaker
+        if breaker is not None and breaker.state != CircuitBreaker.CLOSED:
+            # the backend is failing, so don't add to its load. requests
+            # would be refused anyway.
+            return
+
+        # only one slot is held at a time, while its connection is made, so
+        # that requests aren't kept waiting for slots. each slot needs at
+        # most one new connection.
+        for _ in range(self.size):
+            if self.closed:
+                return
+
+            found, old_prot = self._take_slot_to_maintain()
+            if not found:
+                return
+
+            try:
+                prot = self._connect()
+            except TTransportException as exc:
+                logger.info("Failed to connect to %r: %s", self.endpoint, exc)
+                # an expiring connection is still good until it expires.
+                self.pool.put(old_prot)
+                return
+
+            if old_prot:
+                old_prot.trans.close()
+                with self.stats_lock:
+                    self.max_age_closes += 1
+            if self.closed:
+                prot.trans.close()
+                prot = None
+            self.pool.put(prot)
+
+    def close(self):
+        """Close the pool's idle connections.
+
+        Connections that are in use will be closed when they are released and
+        no more connections will be opened in the background.
+
+        """
+        self.closed = True
+        for prot in self._take_idle():
+            if prot:
+                prot.trans.close()
             self.pool.put(None)
 
+    def report_runtime_metrics(self, batch):
+        """Report connection statistics to the stats system.
+
+        * ``pool.connects``, ``pool.connect_failures``: connection attempts.
+        * ``pool.connect``: a timer of how long connecting took.
+        * ``pool.acquire``: a timer of how long it took to get a connection
+          from the pool, including waiting for a free slot and connecting.
+        * ``pool.acquire_timeouts``: requests that gave up waiting for a slot.
+        * ``pool.closed.max_age``, ``pool.closed.error``: connections closed
+          because they were too old or because of an error.
+        * ``pool.circuit_breaker.open``: 1 if the circuit breaker is open.
+        * ``pool.circuit_breaker.trips``: how many times it opened.
+        * ``pool.circuit_breaker.rejected``: requests refused while open.
+        * ``pool.concurrency_limit.limit``: the current concurrency limit.
+        * ``pool.concurrency_limit.rejected``: requests refused by the
+          concurrency limit.
+
+        """
+        self._report_counters(batch)
+        if self.circuit_breaker is not None:
+            is_open = self.circuit_breaker.state == CircuitBreaker.OPEN
+            batch.gauge("pool.circuit_breaker.open").replace(int(is_open))
+        if self.concurrency_limit is not None:
+            batch.gauge("pool.concurrency_limit.limit").replace(int(self.concurrency_limit.limit))
+
+    def _report_counters(self, batch):
+        if self.circuit_breaker is not None:
+            trips, rejected = self.circuit_breaker.take_counts()
+            batch.counter("pool.circuit_breaker.trips").increment(trips)
+            batch.counter("pool.circuit_breaker.rejected").increment(rejected)
+        if self.concurrency_limit is not None:
+            rejected = self.concurrency_limit.take_rejected()
+            batch.counter("pool.concurrency_limit.rejected").increment(rejected)
+
+        with self.stats_lock:
+            connects, self.connects = self.connects, 0
+            connect_failures, self.connect_failures = self.connect_failures, 0
+            acquire_timeouts, self.acquire_timeouts = self.acquire_timeouts, 0
+            max_age_closes, self.max_age_closes = self.max_age_closes, 0
+            error_closes, self.error_closes = self.error_closes, 0
+
+        batch.counter("pool.connects").increment(connects)
+        batch.counter("pool.connect_failures").increment(connect_failures)
+        batch.counter("pool.acquire_timeouts").increment(acquire_timeouts)
+        batch.counter("pool.closed.max_age").increment(max_age_closes)
+        batch.counter("pool.closed.error").increment(error_closes)
+        for _ in range(len(self.connect_times)):
+            batch.timer("pool.connect").send(self.connect_times.popleft())
+        for _ in range(len(self.acquire_times)):
+            batch.timer("pool.acquire").send(self.acquire_times.popleft())
+
     @contextlib.contextmanager
     def connection(self):
         """Acquire a connection from the pool.
@@ -193,38 +844,292 @@ class ThriftConnectionPool:
         unknown.
 
         """
-        prot = self._acquire()
+        limit = self.concurrency_limit
+        if limit is not None and not limit.acquire():
+            raise ConcurrencyLimitExceededError(
+                type=TTransportException.NOT_OPEN,
+                message="concurrency limit for {!r} reached".format(self.endpoint),
+            )
+
+        breaker = self.circuit_breaker
+        if breaker is not None and not breaker.allow():
+            if limit is not None:
+                limit.release(None, 0)
+            raise CircuitBreakerOpenError(
+                type=TTransportException.NOT_OPEN,
+                message="circuit breaker for {!r} is open".format(self.endpoint),
+            )
+
+        start_time = time.monotonic()
+        # None until we have a slot, running out of those isn't the backend's
+        # fault.
+        healthy = None
+        prot = None
+        # when the call itself started, after getting a connection. the
+        # concurrency limit only wants to know how long the backend took.
+        call_start_time = None
         try:
+            prot = self._get_slot()
+            healthy = False
+            prot = self._open_slot(prot)
+            call_start_time = time.monotonic()
+            prot.baseplate_acquire_time = call_start_time - start_time
+            self.acquire_times.append(prot.baseplate_acquire_time)
             try:
-                yield prot
-            except socket.timeout:
-                # thrift doesn't re-wrap socket timeout errors appropriately so
-                # we'll do it here for a saner exception hierarchy
-                raise TTransportException(
-                    type=TTransportException.TIMED_OUT, message="timed out interacting with socket"
-                )
-            except socket.error as exc:
-                raise TTransportException(type=TTransportException.UNKNOWN, message=str(exc))
-        except (TApplicationException, TProtocolException, TTransportException):
-            # these exceptions usually indicate something low-level went wrong,
-            # so it's safest to just close this connection because we don't
-            # know what state it's in.
-            prot.trans.close()
-            raise
-        except TException:
-            # the only other TException-derived errors are application level
-            # (expected) errors which should be safe for the connection.
-            # don't close the transport here!
-            raise
-        except:  # noqa: E722
-            # anything else coming out of thrift usually means parsing failed
-            # or something nastier. we'll just play it safe and close the
-            # connection.
-            prot.trans.close()
-            raise
+                try:
+                    yield prot
+                except socket.timeout:
+                    # thrift doesn't re-wrap socket timeout errors appropriately so
+                    # we'll do it here for a saner exception hierarchy
+                    raise TTransportException(
+                        type=TTransportException.TIMED_OUT,
+                        message="timed out interacting with socket",
+                    )
+                except socket.error as exc:
+                    raise TTransportException(type=TTransportException.UNKNOWN, message=str(exc))
+            except (TApplicationException, TProtocolException, TTransportException):
+                # these exceptions usually indicate something low-level went wrong,
+                # so it's safest to just close this connection because we don't
+                # know what state it's in.
+                prot.trans.close()
+                raise
+            except TException:
+                # the only other TException-derived errors are application level
+                # (expected) errors which should be safe for the connection.
+                # don't close the transport here!
+                healthy = True
+                raise
+            except:  # noqa: E722
+                # anything else coming out of thrift usually means parsing failed
+                # or something nastier. we'll just play it safe and close the
+                # connection.
+                prot.trans.close()
+                raise
+            else:
+                healthy = True
+            finally:
+                self._release(prot)
         finally:
-            self._release(prot)
+            if getattr(prot, "baseplate_cancelled", False):
+                # we gave up on the request (e.g. a hedged request lost), so
+                # its failure wasn't the backend's fault.
+                healthy = None
+            now = time.monotonic()
+            if breaker is not None:
+                breaker.record(healthy, now - start_time)
+            if limit is not None:
+                limit.release(healthy, now - (call_start_time or now))
+
+    @property
+    def available(self):
+        """Whether the pool's circuit breaker and concurrency limit allow a request."""
+        if self.circuit_breaker is not None and not self.circuit_breaker.available:
+            return False
+        return self.concurrency_limit is None or self.concurrency_limit.available
 
     @property
     def checkedout(self):
         return self.size - self.pool.qsize()
+
+
+class BalancedThriftConnectionPool:
+    """A pool of Thrift connections to the backends of a service.
+
+    Each backend gets its own :py:class:`ThriftConnectionPool`. For each
+    connection, two backends are picked at random (respecting their weights)
+    and the one with fewer connections in use relative to its weight is used.
+
+    The backends are re-read from a :py:class:`~baseplate.service_discovery.ServiceInventory`
+    as it changes. Idle connections to backends that are removed are closed,
+    while connections that are in use are closed once they're released.
+
+    :param backends: A :py:class:`~baseplate.service_discovery.ServiceInventory`
+        or a static list of :py:class:`~baseplate.config.EndpointConfiguration`
+        or :py:class:`~baseplate.service_discovery.Backend` objects.
+
+    :param CircuitBreaker circuit_breaker: If given, each backend gets a
+        copy of this breaker and backends with open breakers aren't used
+        until they've recovered.
+
+    Similarly, backends that are at their ``concurrency_limit`` aren't used
+    while others have room.
+
+    All other parameters are passed on to the :py:class:`ThriftConnectionPool`
+    for each backend, so ``size`` is the size of each backend's pool.
+
+    All exceptions raised by this class derive from
+    :py:exc:`~thrift.transport.TTransport.TTransportException`.
+
+    """
+
+    def __init__(self, backends, circuit_breaker=None, **pool_kwargs):
+        if isinstance(backends, ServiceInventory):
+            self.inventory = backends
+            self.static_backends = None
+        else:
+            self.inventory = None
+            self.static_backends = [
+                backend
+                if isinstance(backend, Backend)
+                else Backend(id=i, name=str(backend.address), endpoint=backend, weight=1)
+                for i, backend in enumerate(backends)
+            ]
+        self.circuit_breaker = circuit_breaker
+        self.pool_kwargs = pool_kwargs
+
+        self.lock = threading.Lock()
+        self.backends = None
+        self.pools = {}
+        # the current (backend, pool) pairs and a lottery over their indexes,
+        # replaced together whenever the backends change.
+        self.candidates = ([], None)
+        self.refreshed_at = time.monotonic()
+        self._refresh()
+
+    def _get_backends(self):
+        if self.inventory is not None:
+            return self.inventory.get_backends()
+        return self.static_backends
+
+    def _refresh(self):
+        backends = self._get_backends()
+        if backends is self.backends:
+            return
+
+        with self.lock:
+            pools = {}
+            for backend in backends:
+                pool = self.pools.get(backend.endpoint)
+                if pool is None:
+                    circuit_breaker = None
+                    if self.circuit_breaker is not None:
+                        circuit_breaker = self.circuit_breaker.copy()
+                    pool = ThriftConnectionPool(
+                        backend.endpoint, circuit_breaker=circuit_breaker, **self.pool_kwargs
+                    )
+                pools[backend.endpoint] = pool
+            retired_pools = [pool for key, pool in self.pools.items() if key not in pools]
+
+            candidates = [(backend, pools[backend.endpoint]) for backend in backends]
+            try:
+                lottery = WeightedLottery(range(len(candidates)), lambda i: candidates[i][0].weight)
+            except ValueError:
+                lottery = None
+
+            self.backends = backends
+            self.pools = pools
+            self.candidates = (candidates, lottery)
+
+        for pool in retired_pools:
+            pool.close()
+
+    def _pick_pool(self):
+        now = time.monotonic()
+        if now - self.refreshed_at >= _INVENTORY_REFRESH_INTERVAL:
+            self.refreshed_at = now
+            self._refresh()
+
+        candidates, lottery = self.candidates
+        if lottery is None:
+            raise TTransportException(
+                type=TTransportException.NOT_OPEN, message="no backends available"
+            )
+
+        picked = [candidates[lottery.pick()], candidates[lottery.pick()]]
+        available = [candidate for candidate in picked if candidate[1].available]
+        if not available:
+            # both picks are unavailable, use any backend that's ok
+            available = [candidate for candidate in candidates if candidate[1].available]
+            if not available:
+                # the pool will refuse the request with the appropriate error
+                return picked[0][1]
+            return random.choice(available)[1]
+        if len(available) == 1:
+            return available[0][1]
+
+        (first_backend, first_pool), (second_backend, second_pool) = available
+        # compare checkedout / weight without dividing by zero weights
+        first_load = first_pool.checkedout * second_backend.weight
+        second_load = second_pool.checkedout * first_backend.weight
+        if second_load < first_load:
+            return second_pool
+        return first_pool
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Acquire a connection to one of the backends.
+
+        This works like :py:meth:`ThriftConnectionPool.connection`.
+
+        """
+        pool = self._pick_pool()
+        with pool.connection() as prot:
+            yield prot
+
+    def report_runtime_metrics(self, batch):
+        """Report connection statistics for all backends to the stats system.
+
+        See :py:meth:`ThriftConnectionPool.report_runtime_metrics`.
+        ``pool.circuit_breaker.open`` is the number of backends with open
+        circuit breakers and ``pool.concurrency_limit.limit`` is the sum of
+        the backends' limits.
+
+        """
+        pools = list(self.pools.values())
+        for pool in pools:
+            pool._report_counters(batch)  # pylint: disable=protected-access
+
+        if self.pool_kwargs.get("concurrency_limit") is not None:
+            total_limit = sum(int(pool.concurrency_limit.limit) for pool in pools)
+            batch.gauge("pool.concurrency_limit.limit").replace(total_limit)
+
+        if self.circuit_breaker is not None:
+            open_count = sum(
+                1 for pool in pools if pool.circuit_breaker.state == CircuitBreaker.OPEN
+            )
+            batch.gauge("pool.circuit_breaker.open").replace(open_count)
+
+    @property
+    def size(self):
+        return sum(pool.size for pool in self.pools.values())
+
+    @property
+    def checkedout(self):
+        return sum(pool.checkedout for pool in self.pools.values())
+
+
+class _PoolMaintainer:
+    """A background thread that keeps pools' idle connections warm."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pools = weakref.WeakSet()
+        self.thread = None
+
+    def add(self, pool):
+        with self.lock:
+            self.pools.add(pool)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="Thrift Pool Maintainer")
+                self.thread.daemon = True
+                self.thread.start()
+
+    def _run(self):
+        while True:
+            with self.lock:
+                for pool in list(self.pools):
+                    if pool.closed:
+                        self.pools.discard(pool)
+                pools = list(self.pools)
+
+            for pool in pools:
+                try:
+                    pool._maintain()  # pylint: disable=protected-access
+                except Exception:  # pylint: disable=broad-except
+                    logger.exception("Error while maintaining thrift connection pool")
+            del pools
+
+            time.sleep(_MAINTENANCE_INTERVAL)
+
+
+_maintainer = _PoolMaintainer()
@@ -0,0 +1,24 @@
+"""Micro-benchmarks for performance sensitive code paths.
+
+These are not collected by the regular test run. Run them individually as
+modules, e.g.::
+
+    python -m tests.benchmarks.message_queue_benchmarks
+
+"""
+
+import time
+
+
+def run_benchmark(name, fn, count, unit="ops"):
+    """Time ``fn`` which performs ``count`` operations and print the rate.
+
+    :returns: The number of operations per second.
+
+    """
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    rate = count / elapsed
+    print("{:<40} {:>12.0f} {}/s  ({:.3f}s)".format(name, rate, unit, elapsed))
+    return rate
@@ -0,0 +1,68 @@
+"""Compare compression codecs and levels on representative event batches."""
+
+import random
+import uuid
+
+from baseplate._utils import BatchFull
+from baseplate.events import Event, FieldKind
+from baseplate.events.publisher import COMPRESSORS, make_compressor, V1Batch
+
+from . import run_benchmark
+
+
+ITERATIONS = 20
+CODEC_LEVELS = {"gzip": (1, 6, 9), "deflate": (1, 6, 9), "zstd": (1, 3, 9), "br": (1, 5, 9)}
+
+
+def make_event(rng):
+    event = Event("screenview_events", "cs.screenview")
+    event.set_field("user_id", "t2_%x" % rng.getrandbits(32))
+    event.set_field("session_id", str(uuid.uuid4()))
+    event.set_field("referrer_url", "https://www.reddit.com/r/%d/" % rng.randrange(10000))
+    event.set_field("target_url", "/r/pics/comments/%x/" % rng.getrandbits(24))
+    event.set_field("user_agent", "Mozilla/5.0 (X11; Linux x86_64) Gecko/20100101 Firefox/67.0")
+    event.set_field("logged_in", rng.random() < 0.5)
+    event.set_field("position", rng.randrange(25))
+    event.set_field(
+        "ip", "10.%d.%d.%d" % tuple(rng.randrange(256) for _ in range(3)), kind=FieldKind.OBFUSCATED
+    )
+    event.set_field("request_id", str(uuid.uuid4()), kind=FieldKind.HIGH_CARDINALITY)
+    return event
+
+
+def make_batch():
+    rng = random.Random(1)
+    batch = V1Batch()
+    try:
+        while True:
+            batch.add(make_event(rng).serialize().encode())
+    except BatchFull:
+        pass
+    return batch.serialize().bytes
+
+
+def main():
+    payload = make_batch()
+    megabytes = len(payload) * ITERATIONS / 1e6
+    print("{} byte batches".format(len(payload)))
+
+    for codec in COMPRESSORS:
+        for level in CODEC_LEVELS[codec]:
+            try:
+                compressor = make_compressor(codec, level)
+            except ValueError as exc:
+                print("skipping {}: {}".format(codec, exc))
+                break
+
+            def compress(compressor=compressor):
+                for _ in range(ITERATIONS):
+                    compressor.compress(payload)
+
+            name = "{} level {}".format(codec, level)
+            run_benchmark(name, compress, megabytes, "MB")
+            ratio = len(payload) / len(compressor.compress(payload))
+            print("{:<40} {:>12.2f}x compression ratio".format("", ratio))
+
+
+if __name__ == "__main__":
+    main()
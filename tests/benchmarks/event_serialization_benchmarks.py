@@ -0,0 +1,35 @@
+"""Compare the JSON encoders available for serializing V1 events."""
+
+import random
+
+from baseplate.events import json_dumps_orjson, json_dumps_stdlib
+from baseplate.events.queue import orjson
+
+from . import run_benchmark
+from .event_compression_benchmarks import make_event
+
+
+EVENT_COUNT = 10000
+
+
+def main():
+    rng = random.Random(1)
+    events = [make_event(rng) for _ in range(EVENT_COUNT)]
+
+    encoders = [("default (json.dumps)", None), ("stdlib", json_dumps_stdlib)]
+    if orjson is not None:
+        encoders.append(("orjson", json_dumps_orjson))
+    else:
+        print("skipping orjson: the orjson package is not installed")
+
+    for name, dumps in encoders:
+
+        def serialize(dumps=dumps):
+            for event in events:
+                event.serialize(dumps)
+
+        run_benchmark(name, serialize, EVENT_COUNT, "events")
+
+
+if __name__ == "__main__":
+    main()
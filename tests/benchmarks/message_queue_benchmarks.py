@@ -0,0 +1,72 @@
+"""Compare single and bulk operations on the message queue implementations."""
+
+import contextlib
+
+import posix_ipc
+
+from baseplate.message_queue import MessageQueue, SharedMemoryMessageQueue
+
+from . import run_benchmark
+
+
+QUEUE_NAME = "/baseplate-benchmark-queue"
+# the default fs.mqueue.msg_max on linux is 10, stay within it so this can run
+# on an untuned host.
+QUEUE_DEPTH = 10
+MESSAGE = b"x" * 1024
+MESSAGE_COUNT = 200000
+
+
+def _remove_queue():
+    try:
+        queue = posix_ipc.MessageQueue(QUEUE_NAME)
+    except posix_ipc.ExistentialError:
+        pass
+    else:
+        queue.unlink()
+        queue.close()
+
+
+def bench_single(mq):
+    for _ in range(MESSAGE_COUNT // QUEUE_DEPTH):
+        for _ in range(QUEUE_DEPTH):
+            mq.put(MESSAGE, timeout=0)
+        for _ in range(QUEUE_DEPTH):
+            mq.get(timeout=0)
+
+
+def bench_many(mq):
+    messages = [MESSAGE] * QUEUE_DEPTH
+    for _ in range(MESSAGE_COUNT // QUEUE_DEPTH):
+        mq.put_many(messages, timeout=0)
+        mq.get_many(QUEUE_DEPTH, timeout=0)
+
+
+def main():
+    _remove_queue()
+    message_queue = MessageQueue(
+        QUEUE_NAME, max_messages=QUEUE_DEPTH, max_message_size=len(MESSAGE)
+    )
+    try:
+        with contextlib.closing(message_queue) as mq:
+            print("{} byte messages, queue depth {}".format(len(MESSAGE), QUEUE_DEPTH))
+            run_benchmark("put/get", lambda: bench_single(mq), MESSAGE_COUNT, "messages")
+            run_benchmark("put_many/get_many", lambda: bench_many(mq), MESSAGE_COUNT, "messages")
+    finally:
+        _remove_queue()
+
+    shm_queue = SharedMemoryMessageQueue(
+        QUEUE_NAME, max_messages=QUEUE_DEPTH, max_message_size=len(MESSAGE)
+    )
+    try:
+        with contextlib.closing(shm_queue) as mq:
+            run_benchmark("shm put/get", lambda: bench_single(mq), MESSAGE_COUNT, "messages")
+            run_benchmark(
+                "shm put_many/get_many", lambda: bench_many(mq), MESSAGE_COUNT, "messages"
+            )
+    finally:
+        shm_queue.unlink()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""Measure the queue consumer's hot loop using kombu's in-memory transport.
+
+No broker is needed, so network time isn't included. What's left is the cost
+of baseplate and kombu themselves: moving messages through the worker
+thread's work queue, creating server spans, and acking.
+
+"""
+
+import time
+
+from kombu import Connection, Exchange, Queue
+
+from baseplate.context.kombu import KombuProducerContextFactory
+from baseplate.core import Baseplate
+from baseplate.queue_consumer import BaseKombuConsumer, consume, KombuConsumer
+
+from . import run_benchmark
+
+
+MESSAGE_COUNT = 20000
+BATCH_SIZE = 100
+BODY = {"link_id": "t3_abcdef", "action": "created"}
+
+
+class _Done(Exception):
+    pass
+
+
+def make_connection():
+    return Connection("memory://")
+
+
+def make_queue(exchange, name):
+    # each benchmark gets its own queue so that messages aren't taken by the
+    # worker threads of the ones before it, which never stop.
+    queue = Queue(name=name, exchange=exchange, routing_key=name)
+    with make_connection() as connection:
+        queue(connection.default_channel).declare()
+    return queue
+
+
+def publish(baseplate, routing_key):
+    context = baseplate.make_context_object()
+    with baseplate.make_server_span(context, "publish"):
+        for _ in range(MESSAGE_COUNT):
+            context.amqp.publish(BODY, routing_key=routing_key)
+
+
+def publish_many(baseplate, routing_key):
+    context = baseplate.make_context_object()
+    with baseplate.make_server_span(context, "publish"):
+        for _ in range(MESSAGE_COUNT // BATCH_SIZE):
+            context.amqp.publish_many([BODY] * BATCH_SIZE, routing_key=routing_key)
+
+
+def bench_get_message(exchange, name, ack):
+    """Return a benchmark of get_message and the time it spent acking.
+
+    The acks are timed in the same run, rather than by comparing with a run
+    that doesn't ack, as the difference between two runs is mostly noise.
+
+    """
+    queue = make_queue(exchange, name)
+    kombu_consumer = BaseKombuConsumer.new(make_connection(), [queue])
+    ack_times = []
+
+    def run():
+        for _ in range(MESSAGE_COUNT):
+            message = kombu_consumer.get_message()
+            if ack:
+                start = time.perf_counter()
+                message.ack()
+                ack_times.append(time.perf_counter() - start)
+
+    return queue, kombu_consumer, run, ack_times
+
+
+def main():
+    baseplate = Baseplate()
+    exchange = Exchange("baseplate-benchmark", "direct")
+    baseplate.add_to_context("amqp", KombuProducerContextFactory(make_connection(), exchange))
+
+    print("{} messages".format(MESSAGE_COUNT))
+
+    make_queue(exchange, "publish")
+    run_benchmark(
+        "KombuProducer.publish", lambda: publish(baseplate, "publish"), MESSAGE_COUNT, "messages"
+    )
+    run_benchmark(
+        "KombuProducer.publish_many",
+        lambda: publish_many(baseplate, "publish"),
+        MESSAGE_COUNT,
+        "messages",
+    )
+
+    for name, ack in (("get_message", False), ("get_message/ack", True)):
+        queue, kombu_consumer, run, ack_times = bench_get_message(exchange, name, ack)
+        publish(baseplate, queue.routing_key)
+        run_benchmark(name, run, MESSAGE_COUNT, "messages")
+        kombu_consumer.worker.should_stop = True
+
+    ack_cost = sum(ack_times) / len(ack_times)
+    print("{:<40} {:>12.1f} us/message".format("ack cost", ack_cost * 1e6))
+
+    queue = make_queue(exchange, "get_batch")
+    kombu_consumer = BaseKombuConsumer.new(make_connection(), [queue])
+    publish(baseplate, queue.routing_key)
+
+    def get_batches():
+        received = 0
+        while received < MESSAGE_COUNT:
+            messages = kombu_consumer.get_batch(max_items=BATCH_SIZE, timeout=1)
+            messages[-1].ack(multiple=True)
+            received += len(messages)
+
+    run_benchmark("get_batch/ack", get_batches, MESSAGE_COUNT, "messages")
+    kombu_consumer.worker.should_stop = True
+
+    queue = make_queue(exchange, "spans")
+    kombu_consumer = KombuConsumer.new(make_connection(), [queue])
+    publish(baseplate, queue.routing_key)
+
+    span_time = 0
+
+    def get_messages_in_spans():
+        nonlocal span_time
+        for _ in range(MESSAGE_COUNT):
+            start = time.perf_counter()
+            context = baseplate.make_context_object()
+            with baseplate.make_server_span(context, "spans") as span:
+                inner_start = time.perf_counter()
+                message = kombu_consumer.get_message(span)
+                message.ack()
+                inner_time = time.perf_counter() - inner_start
+            span_time += time.perf_counter() - start - inner_time
+
+    run_benchmark("get_message/ack in span", get_messages_in_spans, MESSAGE_COUNT, "messages")
+    kombu_consumer.worker.should_stop = True
+
+    span_cost = span_time / MESSAGE_COUNT
+    print("{:<40} {:>12.1f} us/message".format("span overhead", span_cost * 1e6))
+
+    queue = make_queue(exchange, "consume")
+    publish(baseplate, queue.routing_key)
+    handled = 0
+
+    def handler(context, body, message):
+        nonlocal handled
+        handled += 1
+        if handled == MESSAGE_COUNT:
+            raise _Done
+
+    def run_consume():
+        try:
+            consume(baseplate, exchange, make_connection(), "consume", ["consume"], handler)
+        except _Done:
+            pass
+
+    run_benchmark("consume", run_consume, MESSAGE_COUNT, "messages")
+
+
+if __name__ == "__main__":
+    main()
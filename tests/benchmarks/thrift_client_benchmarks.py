@@ -0,0 +1,131 @@
+"""Measure the client-side overhead of Thrift calls made through a context proxy.
+
+Calls through :py:class:`~baseplate.context.thrift.ThriftContextFactory`
+proxies are compared to calls on a bare Thrift client using the same pool,
+against a Baseplate Thrift server on loopback. The difference is what
+baseplate adds on the client side per call: spans, trace headers, and the
+proxy itself.
+
+The same proxy is also measured against a client that doesn't touch the
+network at all, which isolates that overhead from the noise of the server.
+
+"""
+
+import contextlib
+import logging
+
+from gevent import monkey
+
+monkey.patch_all()
+
+# pylint: disable=wrong-import-position
+import gevent  # noqa: E402
+
+from baseplate import config  # noqa: E402
+from baseplate.context.thrift import ThriftContextFactory  # noqa: E402
+from baseplate.core import Baseplate  # noqa: E402
+from baseplate.integration.thrift import baseplateify_processor  # noqa: E402
+from baseplate.server import make_listener  # noqa: E402
+from baseplate.server.thrift import make_server  # noqa: E402
+from baseplate.thrift import BaseplateService  # noqa: E402
+from baseplate.thrift_pool import ThriftConnectionPool  # noqa: E402
+
+from . import run_benchmark  # noqa: E402
+
+
+CALL_COUNT = 20000
+
+
+class _Handler(BaseplateService.Iface):
+    def is_healthy(self, context):
+        return True
+
+
+@contextlib.contextmanager
+def serve_baseplate_service(bind="127.0.0.1:0"):
+    """Run a Baseplate Thrift server on loopback and yield its endpoint.
+
+    The server is stopped, closing its listener and connections, on exit.
+
+    """
+    processor = BaseplateService.Processor(_Handler())
+    processor = baseplateify_processor(processor, logging.getLogger(__name__), Baseplate())
+
+    listener = make_listener(config.Endpoint(bind))
+    server = make_server({"max_concurrency": "100"}, listener, processor)
+    host, port = listener.getsockname()[:2]
+
+    server_greenlet = gevent.spawn(server.serve_forever)
+    try:
+        yield config.Endpoint("{}:{}".format(host, port))
+    finally:
+        server.stop()
+        server_greenlet.kill()
+
+
+class _NullTransport:
+    def set_header(self, key, value):
+        pass
+
+
+class _NullProtocol:
+    trans = _NullTransport()
+
+
+class _NullPool:
+    size = 1
+    checkedout = 0
+
+    def __init__(self):
+        self.prot = _NullProtocol()
+
+    @contextlib.contextmanager
+    def connection(self):
+        yield self.prot
+
+
+class _NullClient(BaseplateService.Client):
+    def __init__(self, iprot, oprot=None):  # pylint: disable=super-init-not-called
+        self._iprot = self._oprot = iprot
+
+    def is_healthy(self):
+        return True
+
+
+def call_raw(pool):
+    for _ in range(CALL_COUNT):
+        with pool.connection() as prot:
+            BaseplateService.Client(prot).is_healthy()
+
+
+def call_proxy(baseplate):
+    context = baseplate.make_context_object()
+    with baseplate.make_server_span(context, "benchmark"):
+        for _ in range(CALL_COUNT):
+            context.service.is_healthy()
+
+
+def main():
+    print("{} calls".format(CALL_COUNT))
+
+    with serve_baseplate_service() as endpoint:
+        pool = ThriftConnectionPool(endpoint)
+        baseplate = Baseplate()
+        baseplate.add_to_context("service", ThriftContextFactory(pool, BaseplateService.Client))
+
+        # warm up the connection and the server
+        call_raw(pool)
+
+        raw_rate = run_benchmark("raw client (loopback)", lambda: call_raw(pool), CALL_COUNT)
+        proxy_rate = run_benchmark("proxy (loopback)", lambda: call_proxy(baseplate), CALL_COUNT)
+        overhead = 1 / proxy_rate - 1 / raw_rate
+        print("{:<40} {:>12.1f} us/call".format("proxy overhead", overhead * 1e6))
+
+    baseplate = Baseplate()
+    baseplate.add_to_context("service", ThriftContextFactory(_NullPool(), _NullClient))
+    null_rate = run_benchmark("proxy (no network)", lambda: call_proxy(baseplate), CALL_COUNT)
+    print("{:<40} {:>12.1f} us/call".format("proxy cost", 1e6 / null_rate))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""Compare THeader responses with and without zlib compression.
+
+Responses are lists of records like those returned by list-fetching RPCs,
+written by a server protocol and read back by a client protocol in memory.
+For each size, the bytes sent and the time taken to write and read each
+response are printed, so the CPU cost of compressing can be weighed against
+the bandwidth it saves.
+
+"""
+
+import random
+
+from thrift.protocol.THeaderProtocol import THeaderProtocolFactory
+from thrift.Thrift import TMessageType, TType
+from thrift.transport.TTransport import TMemoryBuffer
+
+from baseplate.thrift_compression import THeaderCompressionProtocolFactory
+
+from . import run_benchmark
+
+
+ITERATIONS = 200
+RECORD_COUNTS = (1, 10, 100, 1000, 5000)
+
+
+def make_records(count):
+    rng = random.Random(1)
+    return [
+        (
+            "t3_%x" % rng.getrandbits(32),
+            "/r/subreddit%d/comments/%x/" % (rng.randrange(1000), rng.getrandbits(24)),
+            rng.randrange(100000),
+        )
+        for _ in range(count)
+    ]
+
+
+def write_response(prot, records):
+    prot.writeMessageBegin("get_links", TMessageType.REPLY, 1)
+    prot.writeListBegin(TType.STRUCT, len(records))
+    for fullname, permalink, score in records:
+        prot.writeString(fullname)
+        prot.writeString(permalink)
+        prot.writeI64(score)
+    prot.writeListEnd()
+    prot.writeMessageEnd()
+    prot.trans.flush()
+
+
+def read_response(prot):
+    prot.readMessageBegin()
+    _, count = prot.readListBegin()
+    for _ in range(count):
+        prot.readString()
+        prot.readString()
+        prot.readI64()
+    prot.readListEnd()
+    prot.readMessageEnd()
+
+
+def make_request(client_factory):
+    buf = TMemoryBuffer()
+    prot = client_factory.getProtocol(buf)
+    prot.writeMessageBegin("get_links", TMessageType.CALL, 1)
+    prot.writeMessageEnd()
+    prot.trans.flush()
+    return buf.getvalue()
+
+
+def round_trip(client_factory, server_factory, request, records):
+    """Send a response to ``request`` and read it, returning its size."""
+    server_buf = TMemoryBuffer(request)
+    server_prot = server_factory.getProtocol(server_buf)
+    server_prot.readMessageBegin()
+    server_prot.readMessageEnd()
+    write_response(server_prot, records)
+    response = server_buf.getvalue()[len(request) :]
+
+    read_response(client_factory.getProtocol(TMemoryBuffer(response)))
+    return len(response)
+
+
+def main():
+    configurations = {
+        "uncompressed": (THeaderProtocolFactory(), THeaderProtocolFactory()),
+        "zlib": (
+            THeaderCompressionProtocolFactory(threshold=0),
+            THeaderCompressionProtocolFactory(threshold=0),
+        ),
+    }
+
+    for count in RECORD_COUNTS:
+        records = make_records(count)
+        print("{} records".format(count))
+
+        for name, (client_factory, server_factory) in configurations.items():
+            request = make_request(client_factory)
+            size = round_trip(client_factory, server_factory, request, records)
+
+            def run(client_factory=client_factory, server_factory=server_factory):
+                for _ in range(ITERATIONS):
+                    round_trip(client_factory, server_factory, request, records)
+
+            rate = run_benchmark("  " + name, run, ITERATIONS, "responses")
+            print(
+                "{:<40} {:>12} bytes  {:>8.1f} us/response".format("", size, 1e6 / rate)
+            )
+
+
+if __name__ == "__main__":
+    main()
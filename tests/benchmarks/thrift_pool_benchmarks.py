@@ -0,0 +1,184 @@
+"""Load test the Thrift connection pool, client proxy, and server.
+
+A Baseplate Thrift server is run on loopback and ``BaseplateService``'s
+``is_healthy`` is called on it through a
+:py:class:`~baseplate.context.thrift.ThriftContextFactory` proxy by many
+greenlets at once. For each scenario the throughput, latency percentiles,
+time spent waiting for a connection from the pool, connections opened, and
+errors are printed. The server and the client share a process, so the
+throughput is that of both on one CPU.
+
+The scenarios are:
+
+``steady``
+    A pool big enough for every greenlet.
+``exhaustion``
+    A pool smaller than the number of greenlets, so they queue for
+    connections.
+``recycling``
+    A pool whose connections expire after ``--max-age`` seconds.
+``restart``
+    The server is stopped a third of the way through and started again on
+    the same port after ``--downtime`` seconds.
+
+Run all of them, or some, with e.g.::
+
+    python -m tests.benchmarks.thrift_pool_benchmarks --concurrency 100 --scenario exhaustion
+
+"""
+
+import argparse
+import collections
+import contextlib
+import logging
+import time
+
+from gevent import monkey
+
+monkey.patch_all()
+
+# pylint: disable=wrong-import-position
+import gevent  # noqa: E402
+
+from baseplate.context.thrift import ThriftContextFactory  # noqa: E402
+from baseplate.core import Baseplate  # noqa: E402
+from baseplate.thrift import BaseplateService  # noqa: E402
+from baseplate.thrift_pool import ThriftConnectionPool  # noqa: E402
+
+from .thrift_client_benchmarks import serve_baseplate_service  # noqa: E402
+
+
+SCENARIOS = ("steady", "exhaustion", "recycling", "restart")
+
+
+class _TimedPool(ThriftConnectionPool):
+    """A pool that records how long each wait for a connection slot took."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.waits = []
+
+    def _get_slot(self):
+        start = time.perf_counter()
+        try:
+            return super()._get_slot()
+        finally:
+            self.waits.append(time.perf_counter() - start)
+
+
+class _Results:
+    def __init__(self):
+        self.completed = 0
+        self.latencies = []
+        self.errors = collections.Counter()
+        self.restarted_at = None
+        self.recovered_at = None
+
+
+def percentiles(samples):
+    if not samples:
+        return "no samples"
+    samples = sorted(samples)
+    values = [samples[min(int(len(samples) * p), len(samples) - 1)] for p in (0.5, 0.9, 0.99)]
+    values.append(samples[-1])
+    return "p50 {:.2f}ms  p90 {:.2f}ms  p99 {:.2f}ms  max {:.2f}ms".format(
+        *(value * 1000 for value in values)
+    )
+
+
+def run_load(baseplate, concurrency, count, results):
+    requests = iter(range(count))
+
+    def worker():
+        for _ in requests:
+            context = baseplate.make_context_object()
+            start = time.perf_counter()
+            try:
+                with baseplate.make_server_span(context, "load_test"):
+                    context.service.is_healthy()
+            except Exception as exc:  # pylint: disable=broad-except
+                results.errors["{}: {}".format(type(exc).__name__, exc)] += 1
+            else:
+                now = time.perf_counter()
+                results.latencies.append(now - start)
+                if results.restarted_at is not None and results.recovered_at is None:
+                    results.recovered_at = now
+            results.completed += 1
+
+    start = time.perf_counter()
+    gevent.joinall([gevent.spawn(worker) for _ in range(concurrency)])
+    return time.perf_counter() - start
+
+
+def restart_server(servers, endpoint, count, downtime, results):
+    while results.completed < count // 3:
+        gevent.sleep(0.001)
+    servers.close()
+    gevent.sleep(downtime)
+    servers.enter_context(serve_baseplate_service(bind=str(endpoint)))
+    results.restarted_at = time.perf_counter()
+
+
+def run_scenario(scenario, args):
+    pool_size = args.pool_size if scenario == "exhaustion" else args.concurrency
+    max_age = args.max_age if scenario == "recycling" else 120
+
+    with contextlib.ExitStack() as servers:
+        endpoint = servers.enter_context(serve_baseplate_service())
+        pool = _TimedPool(endpoint, size=pool_size, max_age=max_age, timeout=args.timeout)
+        baseplate = Baseplate()
+        baseplate.add_to_context("service", ThriftContextFactory(pool, BaseplateService.Client))
+
+        results = _Results()
+        restarter = None
+        if scenario == "restart":
+            restarter = gevent.spawn(
+                restart_server, servers, endpoint, args.requests, args.downtime, results
+            )
+        elapsed = run_load(baseplate, args.concurrency, args.requests, results)
+        if restarter is not None:
+            restarter.join()
+        pool.close()
+
+    print(
+        "{} (concurrency {}, pool size {}, max age {}s)".format(
+            scenario, args.concurrency, pool_size, max_age
+        )
+    )
+    print("  {:<12} {:.0f} requests/s".format("throughput", args.requests / elapsed))
+    print("  {:<12} {}".format("latency", percentiles(results.latencies)))
+    print("  {:<12} {}".format("pool wait", percentiles(pool.waits)))
+    print("  {:<12} {}".format("connects", pool.connects))
+    if results.recovered_at is not None:
+        recovery = results.recovered_at - results.restarted_at
+        print("  {:<12} {:.2f}ms after restart".format("recovered", recovery * 1000))
+    for error, error_count in results.errors.most_common():
+        print("  {:<12} {} x {}".format("error", error_count, error))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--scenario",
+        action="append",
+        dest="scenarios",
+        choices=SCENARIOS,
+        help="a scenario to run, can be repeated (default: all of them)",
+    )
+    parser.add_argument("--concurrency", type=int, default=50, help="greenlets making requests")
+    parser.add_argument("--requests", type=int, default=20000, help="requests per scenario")
+    parser.add_argument("--pool-size", type=int, default=10, help="pool size for exhaustion")
+    parser.add_argument("--max-age", type=float, default=0.1, help="max age for recycling")
+    parser.add_argument("--downtime", type=float, default=0.5, help="seconds down for restart")
+    parser.add_argument("--timeout", type=float, default=1, help="pool timeout in seconds")
+    args = parser.parse_args()
+
+    # connection failures are counted in the results, not logged one by one
+    logging.getLogger("thrift.transport.TSocket").setLevel(logging.CRITICAL)
+
+    for scenario in args.scenarios or SCENARIOS:
+        run_scenario(scenario, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,19 @@
 import contextlib
+import multiprocessing
+import os
+import shutil
+import tempfile
 import time
 import unittest
 
 import posix_ipc
 
-from baseplate.message_queue import MessageQueue, TimedOutError
+from baseplate.message_queue import (
+    make_queue,
+    MessageQueue,
+    SharedMemoryMessageQueue,
+    TimedOutError,
+)
 
 
 class TestMessageQueueCreation(unittest.TestCase):
@@ -72,6 +81,52 @@ class TestMessageQueueCreation(unittest.TestCase):
             with self.assertRaises(TimedOutError):
                 mq.put(b"2", timeout=0)
 
+    def test_get_many(self):
+        message_queue = MessageQueue(self.qname, max_messages=3, max_message_size=1)
+
+        with contextlib.closing(message_queue) as mq:
+            mq.put(b"1")
+            mq.put(b"2")
+            mq.put(b"3")
+
+            self.assertEqual(mq.get_many(2), [b"1", b"2"])
+            self.assertEqual(mq.get_many(2), [b"3"])
+
+    def test_get_many_timeout(self):
+        message_queue = MessageQueue(self.qname, max_messages=1, max_message_size=1)
+
+        with contextlib.closing(message_queue) as mq:
+            start = time.time()
+            with self.assertRaises(TimedOutError):
+                mq.get_many(10, timeout=0.1)
+            elapsed = time.time() - start
+            self.assertAlmostEqual(elapsed, 0.1, places=2)
+
+    def test_put_many(self):
+        message_queue = MessageQueue(self.qname, max_messages=3, max_message_size=1)
+
+        with contextlib.closing(message_queue) as mq:
+            count = mq.put_many([b"1", b"2"])
+            self.assertEqual(count, 2)
+            self.assertEqual(mq.get_many(3, timeout=0), [b"1", b"2"])
+
+    def test_put_many_partial(self):
+        message_queue = MessageQueue(self.qname, max_messages=2, max_message_size=1)
+
+        with contextlib.closing(message_queue) as mq:
+            count = mq.put_many([b"1", b"2", b"3"], timeout=0)
+            self.assertEqual(count, 2)
+            self.assertEqual(mq.get_many(3, timeout=0), [b"1", b"2"])
+
+    def test_put_many_full_zero_timeout(self):
+        message_queue = MessageQueue(self.qname, max_messages=1, max_message_size=1)
+
+        with contextlib.closing(message_queue) as mq:
+            mq.put(b"1", timeout=0)
+
+            with self.assertRaises(TimedOutError):
+                mq.put_many([b"2", b"3"], timeout=0)
+
     def tearDown(self):
         try:
             queue = posix_ipc.MessageQueue(self.qname)
@@ -80,3 +135,154 @@ class TestMessageQueueCreation(unittest.TestCase):
         else:
             queue.unlink()
             queue.close()
+
+
+class TestSharedMemoryMessageQueue(unittest.TestCase):
+    qname = "/baseplate-test-shm-queue"
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.mq = self.make_queue()
+
+    def make_queue(self, **kwargs):
+        kwargs.setdefault("max_messages", 4)
+        kwargs.setdefault("max_message_size", 8)
+        return SharedMemoryMessageQueue(self.qname, directory=self.tmpdir, **kwargs)
+
+    def test_put_get(self):
+        self.mq.put(b"x")
+        self.mq.put("hello")
+        self.assertEqual(self.mq.get(), b"x")
+        self.assertEqual(self.mq.get(), b"hello")
+
+    def test_variable_length_and_wraparound(self):
+        messages = [b"a" * (i % 9) for i in range(100)]
+        received = []
+        for message in messages:
+            self.mq.put(message, timeout=0)
+            received.append(self.mq.get(timeout=0))
+        self.assertEqual(received, messages)
+
+    def test_get_many(self):
+        self.assertEqual(self.mq.put_many([b"1", b"2", b"3"]), 3)
+        self.assertEqual(self.mq.get_many(2), [b"1", b"2"])
+        self.assertEqual(self.mq.get_many(2), [b"3"])
+
+    def test_get_timeout(self):
+        start = time.time()
+        with self.assertRaises(TimedOutError):
+            self.mq.get(timeout=0.1)
+        elapsed = time.time() - start
+        self.assertAlmostEqual(elapsed, 0.1, places=1)
+
+    def test_put_full(self):
+        # 4 * (8 + 4) bytes fits exactly four maximum-sized messages
+        self.assertEqual(self.mq.put_many([b"x" * 8] * 5, timeout=0), 4)
+
+        with self.assertRaises(TimedOutError):
+            self.mq.put(b"x", timeout=0)
+
+        self.mq.get()
+        self.mq.put(b"x", timeout=0)
+
+    def test_message_too_large(self):
+        with self.assertRaises(ValueError):
+            self.mq.put(b"x" * 9)
+
+    def test_existing_queue_keeps_parameters(self):
+        other = self.make_queue(max_messages=100, max_message_size=100)
+        with contextlib.closing(other):
+            self.assertEqual(other.capacity, self.mq.capacity)
+            self.assertEqual(other.max_message_size, 8)
+
+            other.put(b"shared")
+            self.assertEqual(self.mq.get(timeout=0), b"shared")
+
+    def test_wakes_consumer_in_other_process(self):
+        def produce():
+            time.sleep(0.2)
+            producer = self.make_queue()
+            producer.put(b"wake")
+            producer.close()
+
+        child = multiprocessing.Process(target=produce)
+        child.start()
+        try:
+            self.assertEqual(self.mq.get(timeout=5), b"wake")
+        finally:
+            child.join()
+
+    def hold_lock_and_crash(self):
+        def crash():
+            producer = self.make_queue()
+            producer._acquire_lock()
+            os._exit(0)
+
+        child = multiprocessing.Process(target=crash)
+        child.start()
+        child.join()
+
+    def run_in_children(self, target, count):
+        children = [multiprocessing.Process(target=target, args=(i,)) for i in range(count)]
+        for child in children:
+            child.start()
+        try:
+            for child in children:
+                child.join(timeout=10)
+                # exitcode is None if the child is still stuck
+                self.assertEqual(child.exitcode, 0)
+        finally:
+            for child in children:
+                if child.is_alive():
+                    child.terminate()
+
+    def test_open_after_producer_crash(self):
+        self.hold_lock_and_crash()
+
+        def open_and_put(i):
+            producer = self.make_queue()
+            producer.put(b"after")
+            producer.close()
+
+        self.run_in_children(open_and_put, 1)
+
+        self.assertEqual(self.mq.get(timeout=0), b"after")
+
+    def test_producers_after_crash(self):
+        self.hold_lock_and_crash()
+
+        def produce(i):
+            producer = self.make_queue()
+            producer.put(str(i))
+            producer.close()
+
+        self.run_in_children(produce, 4)
+
+        self.assertEqual(sorted(self.mq.get_many(10, timeout=0)), [b"0", b"1", b"2", b"3"])
+
+    def test_lock_excludes_forked_producer(self):
+        def produce(i):
+            self.mq.put(b"child")
+
+        child = multiprocessing.Process(target=produce, args=(0,))
+        self.mq._acquire_lock()
+        try:
+            child.start()
+            child.join(timeout=0.5)
+            # the child inherited our open queue, but mustn't share our lock
+            self.assertTrue(child.is_alive())
+        finally:
+            self.mq._release_lock()
+
+        child.join(timeout=10)
+        self.assertEqual(child.exitcode, 0)
+        self.assertEqual(self.mq.get(timeout=0), b"child")
+
+    def test_make_queue(self):
+        with self.assertRaises(ValueError):
+            make_queue(self.qname, max_messages=1, max_message_size=1, queue_type="bogus")
+
+    def tearDown(self):
+        self.mq.unlink()
+        self.mq.close()
+        shutil.rmtree(self.tmpdir)
@@ -0,0 +1,127 @@
+import collections
+import unittest
+
+try:
+    import kombu
+except ImportError:
+    raise unittest.SkipTest("kombu is not installed")
+else:
+    del kombu
+
+from amqp.exceptions import MessageNacked
+from kombu import Connection, Exchange, Queue
+
+from baseplate.context.kombu import KombuProducerContextFactory
+
+from ... import mock
+
+
+class PublishManyTests(unittest.TestCase):
+    def setUp(self):
+        self.span = mock.MagicMock()
+        self.child_span = self.span.make_child.return_value
+
+    def test_publish_many(self):
+        connection = Connection("memory://")
+        exchange = Exchange("exchange", "direct")
+        queue = Queue("publish_many", exchange=exchange, routing_key="key")
+        queue(connection.default_channel).declare()
+        factory = KombuProducerContextFactory(connection, exchange)
+        producer = factory.make_object_for_context("amqp", self.span)
+
+        count = producer.publish_many(({"n": i} for i in range(3)), routing_key="key")
+
+        self.assertEqual(count, 3)
+        self.span.make_child.assert_called_once_with("amqp.publish_many")
+        self.child_span.set_tag.assert_any_call("message_count", 3)
+        received = []
+        for _ in range(3):
+            message = queue(connection.default_channel).get(no_ack=True)
+            received.append(message.payload)
+        self.assertEqual(received, [{"n": 0}, {"n": 1}, {"n": 2}])
+
+
+class PublishConfirmsTests(unittest.TestCase):
+    def setUp(self):
+        self.factory = KombuProducerContextFactory(mock.Mock(), mock.Mock())
+        self.factory.producers = mock.MagicMock()
+        self.factory.confirm_producers = mock.MagicMock()
+        pool = self.factory.confirm_producers[self.factory.connection]
+        self.producer = pool.acquire.return_value.__enter__.return_value
+        self.channel = mock.Mock()
+        self.channel.events = collections.defaultdict(set)
+        self.producer.channel = self.channel
+        self.kombu_producer = self.factory.make_object_for_context("amqp", mock.MagicMock())
+
+    def broker_sends(self, *frames):
+        def wait(methods, timeout):
+            event, delivery_tag, multiple = frames_iter.__next__()
+            for callback in list(self.channel.events[event]):
+                callback(delivery_tag, multiple)
+
+        frames_iter = iter(frames)
+        self.channel.wait.side_effect = wait
+
+    def test_waits_for_all_confirms(self):
+        self.broker_sends(("basic_ack", 2, False), ("basic_ack", 1, False), ("basic_ack", 3, False))
+
+        self.kombu_producer.publish_many(["a", "b", "c"], confirm=True)
+
+        self.channel.confirm_select.assert_called_once_with()
+        self.assertEqual(self.producer.publish.call_count, 3)
+        self.assertEqual(self.channel.wait.call_count, 3)
+        self.assertEqual(self.channel.events["basic_ack"], set())
+
+    def test_sequence_continues(self):
+        self.broker_sends(("basic_ack", 2, True))
+
+        self.kombu_producer.publish_many(["a", "b"], confirm=True)
+        # an ack for an earlier message doesn't count
+        self.broker_sends(("basic_ack", 1, False), ("basic_ack", 4, True))
+        self.kombu_producer.publish_many(["c", "d"], confirm=True)
+
+        self.channel.confirm_select.assert_called_once_with()
+        self.assertEqual(self.channel.wait.call_count, 3)
+        self.assertEqual(self.factory.confirm_sequences[self.channel], 4)
+
+    def test_publish_uses_other_channels(self):
+        self.broker_sends(("basic_ack", 1, False))
+        self.kombu_producer.publish_many(["a"], confirm=True)
+
+        self.kombu_producer.publish("b")
+        self.kombu_producer.publish_many(["c", "d"])
+
+        self.assertEqual(self.producer.publish.call_count, 1)
+        pool = self.factory.producers[self.factory.connection]
+        producer = pool.acquire.return_value.__enter__.return_value
+        self.assertEqual(producer.publish.call_count, 3)
+        self.assertFalse(producer.channel.confirm_select.called)
+        self.assertEqual(self.factory.confirm_sequences[self.channel], 1)
+
+    def test_nack(self):
+        self.broker_sends(("basic_ack", 1, False), ("basic_nack", 2, False))
+
+        with self.assertRaises(MessageNacked):
+            self.kombu_producer.publish_many(["a", "b", "c"], confirm=True)
+        self.assertEqual(self.factory.confirm_sequences[self.channel], 3)
+
+    def test_no_confirm(self):
+        self.kombu_producer.publish_many(["a", "b"])
+
+        self.assertFalse(self.producer.publish.called)
+        self.assertFalse(self.channel.confirm_select.called)
+        self.assertFalse(self.channel.wait.called)
+
+
+class ConfirmProducersTests(unittest.TestCase):
+    def test_connections_not_shared(self):
+        connection = Connection("memory://")
+        factory = KombuProducerContextFactory(connection, Exchange("exchange", "direct"))
+
+        with factory.producers[connection].acquire(block=True) as producer:
+            channel = producer.channel
+        with factory.confirm_producers[connection].acquire(block=True) as producer:
+            confirm_channel = producer.channel
+
+        self.assertIsNot(channel, confirm_channel)
+        self.assertIsNot(channel.connection, confirm_channel.connection)
@@ -1,4 +1,5 @@
 import builtins
+import threading
 import unittest
 
 from ... import mock
@@ -11,8 +12,10 @@ else:
     del pymemcache
 
 from baseplate.config import ConfigurationError
+from baseplate.context.memcache import MemcacheContextFactory, MonitoredMemcacheConnection
 from baseplate.context.memcache import pool_from_config
 from baseplate.context.memcache import lib as memcache_lib
+from baseplate.singleflight import SingleFlight
 
 
 class PoolFromConfigTests(unittest.TestCase):
@@ -403,3 +406,81 @@ class R2CompatSerdeTests(unittest.TestCase):
         zlib.decompress.assert_called_with("nonsense")
         pickle.loads.assert_called_with(expected_zlib_value)
         self.assertEqual(value, expected_pickle_value)
+
+
+class CoalesceTests(unittest.TestCase):
+    def setUp(self):
+        self.pooled_client = mock.Mock()
+        self.span = mock.MagicMock()
+        self.child_span = self.span.make_child.return_value.__enter__.return_value
+        self.singleflight = mock.Mock(spec=SingleFlight)
+        self.singleflight.do.side_effect = lambda key, function: (function(), True)
+        self.connection = MonitoredMemcacheConnection(
+            "memcache", self.span, self.pooled_client, singleflight=self.singleflight
+        )
+
+    def test_get(self):
+        self.pooled_client.get.return_value = b"value"
+
+        self.assertEqual(self.connection.get("key"), b"value")
+
+        self.assertEqual(self.singleflight.do.call_args[0][0], ("get", "key"))
+        self.child_span.set_tag.assert_any_call("coalesced", True)
+
+    def test_get_with_default_not_coalesced(self):
+        self.connection.get("key", default=b"default")
+
+        self.assertFalse(self.singleflight.do.called)
+        self.pooled_client.get.assert_called_once_with("key", default=b"default")
+
+    def test_get_many_copied(self):
+        self.pooled_client.get_many.return_value = {"a": 1}
+
+        result = self.connection.get_many(["a", "b"])
+
+        self.assertEqual(result, {"a": 1})
+        self.assertIsNot(result, self.pooled_client.get_many.return_value)
+        self.assertEqual(self.singleflight.do.call_args[0][0], ("get_many", ("a", "b")))
+
+    def test_coalesced_get_copied(self):
+        value = {"nested": [1, 2]}
+        started = threading.Event()
+        release = threading.Event()
+
+        def get(key):
+            started.set()
+            release.wait()
+            return value
+
+        self.pooled_client.get.side_effect = get
+        self.connection.singleflight = SingleFlight()
+        results = []
+
+        def call():
+            results.append(self.connection.get("key"))
+
+        first = threading.Thread(target=call)
+        first.start()
+        self.assertTrue(started.wait(5))
+        second = threading.Thread(target=call)
+        second.start()
+        # the second call is waiting on the first one's request
+        second.join(0.1)
+        release.set()
+        first.join(5)
+        second.join(5)
+
+        self.assertEqual(self.pooled_client.get.call_count, 1)
+        self.assertEqual(results, [value, value])
+        results[0]["nested"].append(3)
+        self.assertEqual(results[1], {"nested": [1, 2]})
+        self.assertEqual(value, {"nested": [1, 2]})
+
+    def test_factory(self):
+        factory = MemcacheContextFactory(self.pooled_client, coalesce=True)
+        first = factory.make_object_for_context("memcache", self.span)
+        second = factory.make_object_for_context("memcache", self.span)
+
+        self.assertIsInstance(first.singleflight, SingleFlight)
+        self.assertIs(first.singleflight, second.singleflight)
+        self.assertIsNone(MemcacheContextFactory(self.pooled_client).singleflight)
@@ -8,7 +8,10 @@ else:
     del redis
 
 from baseplate.config import ConfigurationError
-from baseplate.context.redis import pool_from_config
+from baseplate.context.redis import MonitoredRedisConnection, pool_from_config
+from baseplate.singleflight import SingleFlight
+
+from ... import mock
 
 
 class PoolFromConfigTests(unittest.TestCase):
@@ -49,3 +52,30 @@ class PoolFromConfigTests(unittest.TestCase):
 
     def test_alternate_prefix(self):
         pool_from_config({"noodle.url": "redis://localhost:1234/0"}, prefix="noodle.")
+
+
+class CoalesceTests(unittest.TestCase):
+    def setUp(self):
+        self.span = mock.MagicMock()
+        self.child_span = self.span.make_child.return_value.__enter__.return_value
+        self.singleflight = mock.Mock(spec=SingleFlight)
+        self.singleflight.do.side_effect = lambda key, function: (function(), True)
+        self.connection = MonitoredRedisConnection(
+            "redis", self.span, mock.Mock(), singleflight=self.singleflight
+        )
+        patcher = mock.patch("redis.StrictRedis.execute_command", return_value=b"value")
+        self.execute_command = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_read_coalesced(self):
+        self.assertEqual(self.connection.get("key"), b"value")
+
+        self.assertEqual(self.singleflight.do.call_args[0][0], ("GET", "key"))
+        self.execute_command.assert_called_once_with("GET", "key")
+        self.child_span.set_tag.assert_called_once_with("coalesced", True)
+
+    def test_write_not_coalesced(self):
+        self.connection.set("key", "value")
+
+        self.assertFalse(self.singleflight.do.called)
+        self.assertTrue(self.execute_command.called)
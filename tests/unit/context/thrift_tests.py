@@ -1,8 +1,18 @@
+import contextlib
+import threading
+import time
 import unittest
 
+from thrift.protocol.TBase import TBase
+from thrift.Thrift import TException, TType
+from thrift.transport.TTransport import TTransportException
+
+from baseplate import metrics, thrift_pool
 from baseplate.context import thrift
 from baseplate.thrift import BaseplateService
 
+from ... import mock
+
 
 class EnumerateServiceMethodsTests(unittest.TestCase):
     def test_enumerate_none(self):
@@ -46,3 +56,491 @@ class EnumerateServiceMethodsTests(unittest.TestCase):
 
         with self.assertRaises(AssertionError):
             list(thrift._enumerate_service_methods(ExampleClient))
+
+
+class HedgeBudgetTests(unittest.TestCase):
+    def test_burst(self):
+        budget = thrift.HedgeBudget(ratio=0.5, burst=2)
+        self.assertTrue(budget.withdraw())
+        self.assertTrue(budget.withdraw())
+        self.assertFalse(budget.withdraw())
+
+    def test_deposit(self):
+        budget = thrift.HedgeBudget(ratio=0.5, burst=2)
+        budget.tokens = 0
+        budget.deposit()
+        self.assertFalse(budget.withdraw())
+        budget.deposit()
+        self.assertTrue(budget.withdraw())
+
+        for _ in range(10):
+            budget.deposit()
+        self.assertEqual(budget.tokens, 2)
+
+
+class LatencyTrackerTests(unittest.TestCase):
+    def test_not_enough_samples(self):
+        tracker = thrift._LatencyTracker()
+        tracker.add("method", 1)
+        self.assertIsNone(tracker.percentile("method", 95))
+        self.assertIsNone(tracker.percentile("other", 95))
+
+    def test_percentile(self):
+        tracker = thrift._LatencyTracker()
+        for i in range(100):
+            tracker.add("method", i)
+
+        self.assertEqual(tracker.percentile("method", 95), 95)
+        self.assertEqual(tracker.percentile("method", 100), 99)
+
+        # not recalculated until enough new samples come in
+        tracker.add("method", 1000)
+        self.assertEqual(tracker.percentile("method", 95), 95)
+
+
+class HedgedCallTests(unittest.TestCase):
+    def setUp(self):
+        self.prots = []
+        self.release = threading.Event()
+        self.calls = 0
+
+        @contextlib.contextmanager
+        def connection():
+            prot = mock.Mock()
+            self.prots.append(prot)
+            yield prot
+
+        pool = mock.Mock()
+        pool.connection = connection
+
+        test = self
+
+        class ExampleClient(BaseplateService.Client):
+            def __init__(self, prot):
+                self.prot = prot
+
+            def is_healthy(self, request=None):
+                test.calls += 1
+                if test.calls == 1:
+                    # the first request hangs until it's cancelled
+                    test.first_started = time.monotonic()
+                    test.release.wait(timeout=5)
+                    raise TTransportException()
+                return True
+
+        self.budget = thrift.HedgeBudget()
+        factory = thrift.ThriftContextFactory(pool, ExampleClient, hedge_budget=self.budget)
+        self.proxy = factory.make_object_for_context("example", mock.MagicMock())
+
+    def test_hedge_wins(self):
+        def abort(prot):
+            self.aborted = time.monotonic()
+            self.release.set()
+
+        with mock.patch.object(thrift, "_abort_connection") as abort_connection:
+            abort_connection.side_effect = abort
+            with self.proxy.hedged(delay=0.01) as svc:
+                self.assertTrue(svc.is_healthy())
+
+        self.assertEqual(self.calls, 2)
+        abort_connection.assert_called_once_with(self.prots[0])
+
+        # the cancelled attempt's latency is recorded once it gives up too
+        samples = self.proxy.latencies.samples["is_healthy"]
+        for _ in range(100):
+            if len(samples) == 2:
+                break
+            time.sleep(0.01)
+        self.assertEqual(len(samples), 2)
+        self.assertGreaterEqual(max(samples), self.aborted - self.first_started)
+
+    def test_budget_exhausted(self):
+        self.budget.tokens = 0
+        threading.Timer(0.05, self.release.set).start()
+
+        with self.assertRaises(TTransportException):
+            with self.proxy.hedged(delay=0.01) as svc:
+                svc.is_healthy()
+
+        self.assertEqual(self.calls, 1)
+
+    def test_fast_call_not_hedged(self):
+        self.calls = 1
+        with self.proxy.hedged(delay=1) as svc:
+            self.assertTrue(svc.is_healthy())
+
+        self.assertEqual(self.calls, 2)
+        self.assertEqual(len(self.prots), 1)
+        self.assertEqual(len(self.proxy.latencies.samples["is_healthy"]), 1)
+
+    def test_unhedged_calls_not_recorded(self):
+        self.calls = 1
+        with mock.patch.object(self.proxy.latencies, "add") as add:
+            self.assertTrue(self.proxy.is_healthy())
+            self.assertTrue(self.proxy.is_healthy())
+
+        self.assertEqual(add.call_count, 0)
+
+
+# a hand-written equivalent of the generated code for:
+#
+#     service LookupService {
+#         string lookup(1: string key),
+#         void ping(),
+#     }
+
+
+class lookup_args(TBase):
+    __slots__ = ("key",)
+    thrift_spec = (None, (1, TType.STRING, "key", "UTF8", None))
+
+    def __init__(self, key=None):
+        self.key = key
+
+
+class lookup_result(TBase):
+    __slots__ = ("success",)
+    thrift_spec = ((0, TType.STRING, "success", "UTF8", None),)
+
+    def __init__(self, success=None):
+        self.success = success
+
+
+class ping_args(TBase):
+    __slots__ = ()
+    thrift_spec = ()
+
+
+class ping_result(TBase):
+    __slots__ = ()
+    thrift_spec = ()
+
+
+class _Struct:
+    """The read and write methods of structs generated without py:slots."""
+
+    def read(self, iprot):
+        iprot.readStruct(self, self.thrift_spec)
+
+    def write(self, oprot):
+        oprot.writeStruct(self, self.thrift_spec)
+
+    def __eq__(self, other):
+        return isinstance(other, self.__class__) and self.__dict__ == other.__dict__
+
+
+class describe_args(_Struct):
+    def __init__(self, key=None):
+        self.key = key
+
+
+describe_args.thrift_spec = (None, (1, TType.STRING, "key", "UTF8", None))
+
+
+class describe_result(_Struct):
+    def __init__(self, success=None):
+        self.success = success
+
+
+describe_result.thrift_spec = ((0, TType.STRING, "success", "UTF8", None),)
+
+
+class LookupService:
+    class Iface:
+        def lookup(self, key):
+            pass
+
+        def ping(self):
+            pass
+
+        def describe(self, key):
+            pass
+
+    class Client(Iface):
+        def __init__(self, prot):
+            self.prot = prot
+
+        def lookup(self, key):
+            return self.prot.lookup(key)
+
+        def ping(self):
+            pass
+
+        def describe(self, key):
+            return self.prot.describe(key)
+
+
+@mock.patch("time.monotonic")
+class ResponseCacheTests(unittest.TestCase):
+    def setUp(self):
+        @contextlib.contextmanager
+        def connection():
+            yield self.prot
+
+        self.prot = mock.Mock()
+        self.prot.lookup.side_effect = lambda key: "value:" + key
+        self.pool = mock.Mock()
+        self.pool.connection = connection
+        self.memcache = mock.Mock()
+        self.memcache.get.return_value = None
+        self.cache = thrift.ResponseCache({"lookup": 10}, max_size=2)
+        self.factory = thrift.ThriftContextFactory(
+            self.pool, LookupService.Client, cache=self.cache
+        )
+        self.span = mock.MagicMock()
+
+    def lookup(self, key):
+        proxy = self.factory.make_object_for_context("lookups", self.span)
+        return proxy.lookup(key)
+
+    def test_hit(self, monotonic):
+        monotonic.return_value = 100
+
+        self.assertEqual(self.lookup("a"), "value:a")
+        self.assertEqual(self.lookup("a"), "value:a")
+        self.assertEqual(self.lookup("b"), "value:b")
+
+        self.assertEqual(self.prot.lookup.call_count, 2)
+        self.span.make_child.assert_any_call("lookups.lookup.cache")
+        self.span.make_child.return_value.set_tag.assert_any_call("hit", True)
+        self.assertEqual(self.cache.counts, {("lookup", "hit"): 1, ("lookup", "miss"): 2})
+
+    def test_ttl(self, monotonic):
+        monotonic.return_value = 100
+        self.lookup("a")
+        monotonic.return_value = 111
+        self.lookup("a")
+
+        self.assertEqual(self.prot.lookup.call_count, 2)
+
+    def test_max_size(self, monotonic):
+        monotonic.return_value = 100
+        for key in ("a", "b", "a", "c", "a", "b"):
+            self.lookup(key)
+
+        # a was used most recently when c was added, so b was evicted
+        self.assertEqual(
+            [call[0][0] for call in self.prot.lookup.call_args_list], ["a", "b", "c", "b"]
+        )
+
+    def test_errors_not_cached(self, monotonic):
+        monotonic.return_value = 100
+        self.prot.lookup.side_effect = TException()
+
+        for _ in range(2):
+            with self.assertRaises(TException):
+                self.lookup("a")
+        self.assertEqual(self.prot.lookup.call_count, 2)
+
+    def test_memcache(self, monotonic):
+        monotonic.return_value = 100
+        self.cache.memcache = self.memcache
+        self.lookup("a")
+
+        key, data = self.memcache.set.call_args[0]
+        self.assertEqual(self.memcache.set.call_args[1], {"expire": 10, "noreply": True})
+        # the memcache client's serializer takes care of the result
+        self.assertEqual(data, "value:a")
+
+        # another process finds it in memcache
+        other_cache = thrift.ResponseCache({"lookup": 10}, memcache=self.memcache)
+        other_cache.bind(LookupService.Client)
+        self.memcache.get.return_value = data
+        cache_key = other_cache.make_key("lookup", ("a",), {})
+
+        self.assertEqual(other_cache.get("lookup", cache_key, mock.MagicMock()), (True, "value:a"))
+        self.memcache.get.assert_called_with(key)
+        self.assertEqual(other_cache.counts, {("lookup", "memcache_hit"): 1})
+
+    def test_memcache_key_namespaced(self, monotonic):
+        other_module = BaseplateService.__name__
+        other_client = type("Client", (LookupService.Client,), {"__module__": other_module})
+        keys = []
+        for client_cls, key_prefix in (
+            (LookupService.Client, ""),
+            (other_client, ""),
+            (LookupService.Client, "backend-b:"),
+        ):
+            cache = thrift.ResponseCache({"lookup": 10}, key_prefix=key_prefix)
+            cache.bind(client_cls)
+            keys.append(cache._memcache_key(cache.make_key("lookup", ("a",), {})))
+
+        self.assertTrue(keys[0].startswith(LookupService.Client.__module__ + ":"))
+        self.assertTrue(keys[1].startswith(other_module + ":"))
+        self.assertTrue(keys[2].startswith("backend-b:" + LookupService.Client.__module__ + ":"))
+
+    def test_memcache_error(self, monotonic):
+        monotonic.return_value = 100
+        self.cache.memcache = self.memcache
+        self.memcache.get.side_effect = Exception
+        self.memcache.set.side_effect = Exception
+
+        self.assertEqual(self.lookup("a"), "value:a")
+
+    def test_bad_methods(self, monotonic):
+        with self.assertRaises(ValueError):
+            thrift.ResponseCache({"nope": 10}).bind(LookupService.Client)
+
+        with self.assertRaises(ValueError):
+            thrift.ResponseCache({"ping": 10}).bind(LookupService.Client)
+
+    def test_structs_without_slots(self, monotonic):
+        monotonic.return_value = 100
+        self.prot.describe.side_effect = lambda key: "description:" + key
+        cache = thrift.ResponseCache({"describe": 10})
+        factory = thrift.ThriftContextFactory(self.pool, LookupService.Client, cache=cache)
+
+        for _ in range(2):
+            proxy = factory.make_object_for_context("lookups", self.span)
+            self.assertEqual(proxy.describe("a"), "description:a")
+
+        self.assertEqual(self.prot.describe.call_count, 1)
+
+    def test_report_runtime_metrics(self, monotonic):
+        monotonic.return_value = 100
+        self.lookup("a")
+        batch = mock.Mock(spec=metrics.Batch)
+
+        self.factory.report_runtime_metrics(batch)
+
+        batch.counter.assert_any_call("cache.lookup.miss")
+        self.assertEqual(self.cache.counts, {})
+
+
+class CoalesceTests(unittest.TestCase):
+    def setUp(self):
+        @contextlib.contextmanager
+        def connection():
+            yield self.prot
+
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+
+        def lookup(key):
+            self.started.set()
+            self.release.wait(5)
+            return "value:" + key
+
+        self.prot = mock.Mock()
+        self.prot.lookup.side_effect = lookup
+        pool = mock.Mock()
+        pool.connection = connection
+        self.factory = thrift.ThriftContextFactory(pool, LookupService.Client, coalesce=["lookup"])
+
+    def test_coalesced(self):
+        results = []
+        leader_span = mock.MagicMock()
+        leader = threading.Thread(
+            target=lambda: results.append(
+                self.factory.make_object_for_context("lookups", leader_span).lookup("a")
+            )
+        )
+        leader.start()
+        self.started.wait(5)
+        threading.Timer(0.05, self.release.set).start()
+
+        span = mock.MagicMock()
+        proxy = self.factory.make_object_for_context("lookups", span)
+        self.assertEqual(proxy.lookup("a"), "value:a")
+        leader.join()
+
+        self.assertEqual(results, ["value:a"])
+        self.assertEqual(self.prot.lookup.call_count, 1)
+        span.make_child.assert_called_once_with("lookups.lookup")
+        wait_span = span.make_child.return_value.__enter__.return_value
+        wait_span.set_tag.assert_called_once_with("coalesced", True)
+
+    def test_unknown_method(self):
+        with self.assertRaises(ValueError):
+            thrift.ThriftContextFactory(mock.Mock(), LookupService.Client, coalesce=["nope"])
+
+
+class ProxyCallTests(unittest.TestCase):
+    def setUp(self):
+        class Protocol:
+            def __init__(self):
+                self.trans = mock.Mock()
+
+        self.prot = Protocol()
+
+        @contextlib.contextmanager
+        def connection():
+            yield self.prot
+
+        pool = mock.Mock()
+        pool.connection = connection
+        self.clients = []
+        test = self
+
+        class Client(LookupService.Client):
+            def __init__(self, iprot, oprot=None):  # pylint: disable=super-init-not-called
+                test.clients.append(self)
+
+            def lookup(self, key):
+                return "value:" + key
+
+        self.factory = thrift.ThriftContextFactory(pool, Client)
+
+        self.span = mock.MagicMock()
+        child_span = self.span.make_child.return_value
+        child_span.trace_id = 1234
+        child_span.parent_id = 2345
+        child_span.id = 3456
+        child_span.sampled = True
+        child_span.flags = 0
+        child_span.context.raw_request_context = None
+
+    def test_headers(self):
+        proxy = self.factory.make_object_for_context("lookups", self.span)
+        proxy.lookup("a")
+
+        self.span.make_child.assert_called_once_with("lookups.lookup")
+        self.prot.trans.set_header.assert_has_calls(
+            [
+                mock.call(b"Trace", b"1234"),
+                mock.call(b"Parent", b"2345"),
+                mock.call(b"Span", b"3456"),
+                mock.call(b"Sampled", b"1"),
+            ]
+        )
+        self.assertEqual(self.prot.trans.set_header.call_count, 4)
+
+    def test_client_reused(self):
+        for _ in range(3):
+            proxy = self.factory.make_object_for_context("lookups", self.span)
+            self.assertEqual(proxy.lookup("a"), "value:a")
+
+        self.assertEqual(len(self.clients), 1)
+        self.assertIs(self.prot.baseplate_client, self.clients[0])
+
+    def test_circuit_breaker_open_not_retried(self):
+        pool = mock.Mock()
+        pool.connection.side_effect = thrift_pool.CircuitBreakerOpenError()
+        factory = thrift.ThriftContextFactory(pool, LookupService.Client)
+        proxy = factory.make_object_for_context("lookups", self.span)
+
+        with proxy.retrying(attempts=3) as svc:
+            with self.assertRaises(thrift_pool.CircuitBreakerOpenError):
+                svc.lookup("a")
+        self.assertEqual(pool.connection.call_count, 1)
+
+    def test_concurrency_limit_exceeded_not_retried(self):
+        pool = mock.Mock()
+        pool.connection.side_effect = thrift_pool.ConcurrencyLimitExceededError()
+        factory = thrift.ThriftContextFactory(pool, LookupService.Client)
+        proxy = factory.make_object_for_context("lookups", self.span)
+
+        with proxy.retrying(attempts=3) as svc:
+            with self.assertRaises(thrift_pool.ConcurrencyLimitExceededError):
+                svc.lookup("a")
+        self.assertEqual(pool.connection.call_count, 1)
+
+    def test_acquire_time_tag(self):
+        self.prot.baseplate_acquire_time = 0.25
+
+        proxy = self.factory.make_object_for_context("lookups", self.span)
+        proxy.lookup("a")
+
+        child_span = self.span.make_child.return_value
+        child_span.set_tag.assert_called_once_with("pool.acquire_time", 0.25)
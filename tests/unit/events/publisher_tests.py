@@ -1,12 +1,29 @@
+import collections
 import gzip
+import threading
+import time
 import unittest
+import zlib
 
 from io import BytesIO
 
 import requests
 
+from thrift.protocol.TBinaryProtocol import TBinaryProtocolFactory
+from thrift.protocol.TCompactProtocol import TCompactProtocolFactory
+from thrift.protocol.TJSONProtocol import TJSONProtocolFactory
+from thrift.Thrift import TType
+from thrift.transport.TTransport import TMemoryBuffer
+
 from baseplate import config, metrics
-from baseplate.events import publisher
+from baseplate.events import (
+    publisher,
+    serialize_v2_event,
+    serialize_v2_event_binary,
+    serialize_v2_event_compact,
+)
+from baseplate.events.queue import pack_events
+from baseplate.thrift.ttypes import Loid
 from baseplate._utils import SerializedBatch
 
 from ... import mock
@@ -74,6 +91,96 @@ class BatchTests(unittest.TestCase):
         result = batch.serialize()
         self.assertEqual(result.count, 0)
 
+    def test_v1_packed(self):
+        batch = publisher.V1Batch(max_size=50)
+        batch.add(b"1")
+        batch.add(pack_events([b"2", b"3"])[0])
+
+        result = batch.serialize()
+        self.assertEqual(result.count, 3)
+        self.assertEqual(result.bytes, b"[1,2,3]")
+
+        batch.reset()
+        self.assertEqual(batch.serialize().count, 0)
+
+    def test_v2_packed(self):
+        batch = publisher.V2Batch(max_size=50)
+        batch.add(pack_events([b"a", b"b"])[0])
+        batch.add(b"c")
+
+        result = batch.serialize()
+        self.assertEqual(result.count, 3)
+        self.assertEqual(result.bytes, b'{"1":{"lst":["rec",3,a,b,c]}}')
+
+
+class V2ProtocolTests(unittest.TestCase):
+    protocols = {
+        "json": (serialize_v2_event, TJSONProtocolFactory()),
+        "binary": (serialize_v2_event_binary, TBinaryProtocolFactory()),
+        "compact": (serialize_v2_event_compact, TCompactProtocolFactory()),
+    }
+
+    def _deserialize_batch(self, data, protocol_factory):
+        protocol = protocol_factory.getProtocol(TMemoryBuffer(bytes(data)))
+        protocol.readStructBegin()
+        _, field_type, field_id = protocol.readFieldBegin()
+        self.assertEqual((field_type, field_id), (TType.LIST, 1))
+        element_type, count = protocol.readListBegin()
+        self.assertEqual(element_type, TType.STRUCT)
+        events = []
+        for _ in range(count):
+            event = Loid()
+            event.read(protocol)
+            events.append(event)
+        protocol.readListEnd()
+        protocol.readFieldEnd()
+        _, field_type, _ = protocol.readFieldBegin()
+        self.assertEqual(field_type, TType.STOP)
+        return events
+
+    def test_roundtrip(self):
+        for protocol, (serialize, protocol_factory) in self.protocols.items():
+            separator = publisher.V2_FRAMINGS[protocol].separator
+            for count in (1, 14, 15, 200):
+                events = [Loid(id="t2_%d" % i, created_ms=i) for i in range(count)]
+                serialized = [serialize(event) for event in events]
+                batch = publisher.V2Batch(protocol=protocol)
+                batch.add(serialized[0])
+                if count > 1:
+                    batch.add(pack_events(serialized[1:], separator)[0])
+
+                result = batch.serialize()
+                self.assertEqual(result.count, count)
+                self.assertEqual(self._deserialize_batch(result.bytes, protocol_factory), events)
+
+    def test_size_limit(self):
+        for protocol, (serialize, _) in self.protocols.items():
+            event = serialize(Loid(id="x" * 50))
+            batch = publisher.V2Batch(max_size=100, protocol=protocol)
+            batch.add(event)
+            with self.assertRaises(publisher.BatchFull):
+                batch.add(event)
+            self.assertLessEqual(len(batch.serialize().bytes), 100)
+
+    def test_buffer_reuse(self):
+        batch = publisher.V2Batch(max_size=50)
+        batch.add(b"a")
+        first = batch.serialize()
+        first_buffer = batch._buffer
+
+        # the first serialized batch is still alive, so it mustn't be clobbered
+        batch.reset()
+        batch.add(b"b")
+        second = batch.serialize()
+        self.assertIsNot(batch._buffer, first_buffer)
+        self.assertEqual(first.bytes, b'{"1":{"lst":["rec",1,a]}}')
+        self.assertEqual(second.bytes, b'{"1":{"lst":["rec",1,b]}}')
+
+        # once it's gone, its buffer is used again
+        del first
+        batch.reset()
+        self.assertIs(batch._buffer, first_buffer)
+
 
 class CompressTests(unittest.TestCase):
     def test_compress(self):
@@ -82,6 +189,34 @@ class CompressTests(unittest.TestCase):
         decompressed = gzip.GzipFile(fileobj=BytesIO(compressed)).read()
         self.assertEqual(raw, decompressed)
 
+    def test_gzip_levels(self):
+        raw = b"test" * 100
+        for level in (1, 6, 9):
+            compressed = publisher.GzipCompressor(level).compress(raw)
+            self.assertEqual(gzip.decompress(compressed), raw)
+
+        with self.assertRaises(ValueError):
+            publisher.GzipCompressor(0)
+
+    def test_compressor_is_reusable(self):
+        compressor = publisher.DeflateCompressor()
+        self.assertEqual(zlib.decompress(compressor.compress(b"one")), b"one")
+        self.assertEqual(zlib.decompress(compressor.compress(b"two")), b"two")
+        self.assertEqual(compressor.content_encoding, "deflate")
+
+    def test_make_compressor(self):
+        compressor = publisher.make_compressor("gzip", 1)
+        self.assertIsInstance(compressor, publisher.GzipCompressor)
+        self.assertIsInstance(publisher.make_compressor("deflate"), publisher.DeflateCompressor)
+
+
+class FakeNegotiatedCompressor(publisher.Compressor):
+    content_encoding = "fake"
+    requires_negotiation = True
+
+    def compress(self, content):
+        return b"fake:" + content
+
 
 class PublisherTests(unittest.TestCase):
     @mock.patch("requests.Session", autospec=True)
@@ -120,6 +255,19 @@ class PublisherTests(unittest.TestCase):
             "key=TestKey, mac=7c46d56b99cd4cb05e08238c1d4c10a2f330795e9d7327f17cc66fd206bf1179",
         )
 
+    def test_publish_memoryview(self):
+        self.publisher = publisher.BatchPublisher(
+            self.metrics_client, self.config, content_type="application/vnd.apache.thrift.binary"
+        )
+        self.publisher.session = self.session
+
+        self.publisher.publish(SerializedBatch(count=1, bytes=memoryview(b"[x]")[1:2]))
+
+        _, kwargs = self.session.post.call_args
+        self.assertEqual(kwargs["headers"]["Content-Type"], "application/vnd.apache.thrift.binary")
+        self.assertEqual(kwargs["headers"]["X-Signature"], self.publisher._sign_payload(b"x"))
+        self.assertEqual(gzip.decompress(kwargs["data"]), b"x")
+
     @mock.patch("time.sleep")
     def test_publish_retry(self, mock_sleep):
         self.session.post.side_effect = [requests.HTTPError(504), IOError, mock.Mock()]
@@ -142,3 +290,182 @@ class PublisherTests(unittest.TestCase):
 
         self.assertEqual(mock_sleep.call_count, 0)
         self.assertEqual(self.session.post.call_count, 1)
+
+    def test_default_gzip(self):
+        self.publisher.publish(SerializedBatch(count=1, bytes=b"[]"))
+
+        _, kwargs = self.session.post.call_args
+        self.assertEqual(kwargs["headers"]["Content-Encoding"], "gzip")
+        self.assertEqual(gzip.decompress(kwargs["data"]), b"[]")
+
+    def test_negotiated_compressor(self):
+        self.publisher = publisher.BatchPublisher(
+            self.metrics_client, self.config, FakeNegotiatedCompressor()
+        )
+        self.publisher.session = self.session
+        self.session.post.return_value.headers = {"Accept-Encoding": "gzip, fake;q=0.5"}
+
+        # not advertised yet, so we have to use gzip for the first batch
+        self.publisher.publish(SerializedBatch(count=1, bytes=b"[]"))
+        _, kwargs = self.session.post.call_args
+        self.assertEqual(kwargs["headers"]["Content-Encoding"], "gzip")
+
+        self.publisher.publish(SerializedBatch(count=1, bytes=b"[]"))
+        _, kwargs = self.session.post.call_args
+        self.assertEqual(kwargs["headers"]["Content-Encoding"], "fake")
+        self.assertEqual(kwargs["data"], b"fake:[]")
+
+    @mock.patch("time.sleep")
+    def test_negotiated_compressor_rejected(self, mock_sleep):
+        self.publisher = publisher.BatchPublisher(
+            self.metrics_client, self.config, FakeNegotiatedCompressor()
+        )
+        self.publisher.collector_accepts_compressor = True
+        self.publisher.session = self.session
+        self.session.post.side_effect = [
+            requests.HTTPError(415, response=mock.Mock(status_code=415)),
+            mock.Mock(headers={}),
+        ]
+
+        self.publisher.publish(SerializedBatch(count=1, bytes=b"[]"))
+
+        self.assertEqual(self.session.post.call_count, 2)
+        _, kwargs = self.session.post.call_args
+        self.assertEqual(kwargs["headers"]["Content-Encoding"], "gzip")
+        self.assertFalse(self.publisher.collector_accepts_compressor)
+
+
+class ConcurrentPublisherTests(unittest.TestCase):
+    def setUp(self):
+        self.inner = mock.Mock(spec=publisher.BatchPublisher)
+        self.metrics_client = mock.MagicMock(autospec=metrics.Client)
+
+    def make_publisher(self, max_in_flight):
+        return publisher.ConcurrentBatchPublisher(
+            self.inner, self.metrics_client, max_in_flight=max_in_flight
+        )
+
+    def test_invalid_max_in_flight(self):
+        with self.assertRaises(ValueError):
+            self.make_publisher(0)
+
+    def test_empty_batch(self):
+        concurrent = self.make_publisher(1)
+        concurrent.submit(SerializedBatch(count=0, bytes=b""))
+        concurrent.pending.join()
+        self.assertEqual(self.inner.publish.call_count, 0)
+
+    def test_batches_in_flight_together(self):
+        release = threading.Event()
+        started = threading.Semaphore(0)
+
+        def publish(payload):
+            started.release()
+            release.wait()
+
+        self.inner.publish.side_effect = publish
+        concurrent = self.make_publisher(3)
+
+        for i in range(3):
+            concurrent.submit(SerializedBatch(count=1, bytes=b"%d" % i), time.time())
+        for _ in range(3):
+            self.assertTrue(started.acquire(timeout=5))
+
+        release.set()
+        concurrent.pending.join()
+        payloads = sorted(call[0][0].bytes for call in self.inner.publish.call_args_list)
+        self.assertEqual(payloads, [b"0", b"1", b"2"])
+        self.metrics_client.timer.assert_any_call("batch.lag")
+        self.metrics_client.timer.assert_any_call("batch.latency")
+        self.metrics_client.gauge.assert_any_call("batch.in_flight")
+
+    @mock.patch.object(publisher, "WORKER_CHECK_INTERVAL", 0.01)
+    def test_backpressure(self):
+        release = threading.Event()
+        self.inner.publish.side_effect = lambda payload: release.wait()
+        concurrent = self.make_publisher(1)
+
+        # one batch in flight and one waiting for the worker
+        concurrent.submit(SerializedBatch(count=1, bytes=b"1"))
+        concurrent.submit(SerializedBatch(count=1, bytes=b"2"))
+
+        blocked = threading.Thread(
+            target=concurrent.submit, args=(SerializedBatch(count=1, bytes=b"3"),)
+        )
+        blocked.start()
+        blocked.join(0.1)
+        self.assertTrue(blocked.is_alive())
+
+        release.set()
+        blocked.join(5)
+        self.assertFalse(blocked.is_alive())
+
+    @mock.patch.object(publisher, "WORKER_CHECK_INTERVAL", 0.01)
+    def test_worker_error_raised(self):
+        self.inner.publish.side_effect = publisher.MaxRetriesError
+        concurrent = self.make_publisher(1)
+
+        with self.assertRaises(publisher.MaxRetriesError):
+            for _ in range(10):
+                concurrent.submit(SerializedBatch(count=1, bytes=b"[]"))
+
+    def test_metrics_reported_in_order(self):
+        release_first = threading.Event()
+
+        def publish(payload):
+            if payload.bytes == b"0":
+                release_first.wait()
+
+        self.inner.publish.side_effect = publish
+        timers = collections.defaultdict(mock.MagicMock)
+        self.metrics_client.timer.side_effect = lambda name: timers[name]
+        concurrent = self.make_publisher(2)
+
+        now = time.time()
+        concurrent.submit(SerializedBatch(count=1, bytes=b"0"), now - 20)
+        concurrent.submit(SerializedBatch(count=1, bytes=b"1"), now - 10)
+        for _ in range(500):
+            if concurrent.finished:
+                break
+            time.sleep(0.01)
+
+        # the second batch is done but has to wait for the first
+        self.assertEqual(timers["batch.lag"].send.call_count, 0)
+        self.assertEqual(timers["batch.latency"].send.call_count, 0)
+
+        release_first.set()
+        concurrent.close()
+        lags = [call[0][0] for call in timers["batch.lag"].send.call_args_list]
+        self.assertEqual(len(lags), 2)
+        self.assertGreater(lags[0], lags[1])
+        self.assertEqual(timers["batch.latency"].send.call_count, 2)
+
+    def test_close_drains_pending_batches(self):
+        release = threading.Event()
+        self.inner.publish.side_effect = lambda payload: release.wait()
+        concurrent = self.make_publisher(2)
+
+        for i in range(3):
+            concurrent.submit(SerializedBatch(count=1, bytes=b"%d" % i))
+
+        closer = threading.Thread(target=concurrent.close)
+        closer.start()
+        closer.join(0.1)
+        self.assertTrue(closer.is_alive())
+
+        release.set()
+        closer.join(5)
+        self.assertFalse(closer.is_alive())
+        payloads = sorted(call[0][0].bytes for call in self.inner.publish.call_args_list)
+        self.assertEqual(payloads, [b"0", b"1", b"2"])
+        for worker in concurrent.workers:
+            self.assertFalse(worker.is_alive())
+
+    @mock.patch.object(publisher, "WORKER_CHECK_INTERVAL", 0.01)
+    def test_close_raises_worker_error(self):
+        self.inner.publish.side_effect = publisher.MaxRetriesError
+        concurrent = self.make_publisher(1)
+        concurrent.submit(SerializedBatch(count=1, bytes=b"[]"))
+
+        with self.assertRaises(publisher.MaxRetriesError):
+            concurrent.close()
@@ -3,9 +3,21 @@ import json
 import unittest
 import warnings
 
-from baseplate.events import Event, EventQueue, EventQueueFullError, EventTooLargeError, FieldKind
-from baseplate.events.queue import MAX_EVENT_SIZE
+from baseplate.core import ServerSpan
+from baseplate.events import (
+    Event,
+    EventQueue,
+    EventQueueFullError,
+    EventTooLargeError,
+    FieldKind,
+    json_dumps_orjson,
+    json_dumps_stdlib,
+    serialize_v2_event_binary,
+)
+from baseplate.events.queue import MAX_EVENT_SIZE, orjson, pack_events, unpack_events
+from baseplate.events.sampling import EventSampler
 from baseplate.message_queue import MessageQueue, TimedOutError
+from baseplate.thrift.ttypes import Loid
 
 from ... import mock
 
@@ -70,6 +82,98 @@ class EventTests(unittest.TestCase):
             },
         )
 
+    def test_serialize_default_format(self):
+        event = Event("topic", "type", id="1-2-3-4")
+        event.timestamp = 333000
+        event.set_field("text", "h\u00e9llo \ud800")
+
+        self.assertEqual(
+            event.serialize(),
+            '{"event_topic": "topic", "event_type": "type", "event_ts": 333000, '
+            '"uuid": "1-2-3-4", "payload": {"text": "h\\u00e9llo \\ud800"}}',
+        )
+
+    def test_serialize_compact_lone_surrogate(self):
+        encoders = [json_dumps_stdlib]
+        if orjson is not None:
+            encoders.append(json_dumps_orjson)
+
+        for dumps in encoders:
+            event = Event("topic", "type")
+            event.set_field("text", "h\u00e9llo \ud800")
+            serialized = event.serialize(dumps)
+            self.assertEqual(json.loads(serialized)["payload"]["text"], "h\u00e9llo \ud800")
+
+    def test_serialize_compact(self):
+        event = Event("topic", "type", id="1-2-3-4")
+        event.timestamp = 333000
+        event.set_field("text", "h\u00e9llo")
+        event.set_field("count", 3, kind=FieldKind.HIGH_CARDINALITY)
+
+        self.assertEqual(
+            event.serialize(json_dumps_stdlib),
+            b'{"event_topic":"topic","event_type":"type","event_ts":333000,"uuid":"1-2-3-4",'
+            b'"payload":{"text":"h\xc3\xa9llo","interana_excluded":{"count":3}}}',
+        )
+
+    def test_payload_types(self):
+        event = Event("topic", "type")
+        event.set_field("normal", "value1")
+        event.set_field("obfuscated", "value2", kind=FieldKind.OBFUSCATED)
+
+        self.assertEqual(event.payload, {"normal": "value1", "obfuscated": "value2"})
+        self.assertEqual(
+            event.payload_types,
+            {"normal": FieldKind.NORMAL, "obfuscated": FieldKind.OBFUSCATED},
+        )
+
+    def test_payload_writable(self):
+        event = Event("topic", "type", id="1-2-3-4")
+        event.timestamp = 333000
+        event.payload = {"replaced": 1}
+        event.payload["added"] = 2
+        event.payload_types["added"] = FieldKind.OBFUSCATED
+
+        self.assertEqual(
+            event.serialize(json_dumps_stdlib),
+            b'{"event_topic":"topic","event_type":"type","event_ts":333000,"uuid":"1-2-3-4",'
+            b'"payload":{"replaced":1,"obfuscated_data":{"added":2}}}',
+        )
+
+        event.payload_types = {}
+        self.assertIn(b'"payload":{"replaced":1,"added":2}', event.serialize(json_dumps_stdlib))
+
+    @unittest.skipIf(orjson is None, "orjson is not installed")
+    def test_orjson_identical(self):
+        values = [
+            '\u2603 \U0001f600 \x00\x7f"\\',
+            0,
+            -(2 ** 63),
+            2 ** 64 - 1,
+            2 ** 64,
+            True,
+            None,
+            0.0,
+            -0.0,
+            0.1,
+            1 / 3,
+            1e-5,
+            5e-05,
+            1e16,
+            123456789.125,
+            float("nan"),
+            float("inf"),
+            [1, "two", [3.5, None]],
+            (1, 2),
+            {"nested": {"deeper": [1e22]}},
+            {1: "non-string key"},
+        ]
+        for value in values:
+            event = Event("topic", "type")
+            event.set_field("value", value)
+            event.set_field("other", value, kind=FieldKind.OBFUSCATED)
+            self.assertEqual(event.serialize(json_dumps_orjson), event.serialize(json_dumps_stdlib))
+
     def _assert_payload(self, event, payload):
         self.assertEqual(
             json.loads(event.serialize()),
@@ -150,10 +254,17 @@ class EventTests(unittest.TestCase):
 
 
 class EventQueueTests(unittest.TestCase):
-    @mock.patch("baseplate.events.queue.MessageQueue", autospec=MessageQueue)
-    def setUp(self, MessageQueue):
-        self.message_queue = MessageQueue.return_value
+    @mock.patch("baseplate.events.queue.make_queue")
+    def setUp(self, make_queue):
+        make_queue.return_value = mock.Mock(spec=MessageQueue)
+        self.message_queue = make_queue.return_value
         self.queue = EventQueue("test")
+        self.make_queue = make_queue
+
+    def test_queue_type(self):
+        self.make_queue.assert_called_with(
+            "/events-test", max_messages=mock.ANY, max_message_size=mock.ANY, queue_type="posix"
+        )
 
     def test_send_event(self):
         mock_event = mock.Mock(autospec=Event)
@@ -180,3 +291,140 @@ class EventQueueTests(unittest.TestCase):
 
         with self.assertRaises(EventQueueFullError):
             self.queue.put(mock_event)
+
+    def test_put_many_packs_events(self):
+        self.message_queue.put_many.side_effect = lambda messages, timeout: len(messages)
+        events = [mock.Mock(autospec=Event) for _ in range(3)]
+        for i, event in enumerate(events):
+            event.serialize.return_value = '{"i":%d}' % i
+
+        self.queue.put_many(events)
+
+        self.assertEqual(self.message_queue.put_many.call_count, 1)
+        messages = self.message_queue.put_many.call_args[0][0]
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(unpack_events(messages[0]), (3, b'{"i":0},{"i":1},{"i":2}'))
+
+    @mock.patch("baseplate.events.queue.make_queue")
+    def test_put_many_packs_binary_events(self, make_queue):
+        make_queue.return_value.put_many.side_effect = lambda messages, timeout: len(messages)
+
+        # a wrapped serializer, the protocol decides how events are packed
+        def serialize(event):
+            return serialize_v2_event_binary(event)
+
+        event_queue = EventQueue("test", event_serializer=serialize, protocol="binary")
+
+        event_queue.put_many([Loid(id="a"), Loid(id="b")])
+
+        messages = make_queue.return_value.put_many.call_args[0][0]
+        expected = serialize_v2_event_binary(Loid(id="a")) + serialize_v2_event_binary(Loid(id="b"))
+        self.assertEqual(unpack_events(messages[0]), (2, expected))
+
+    @mock.patch("baseplate.events.queue.make_queue")
+    def test_unknown_protocol(self, make_queue):
+        with self.assertRaises(ValueError):
+            EventQueue("test", event_serializer=serialize_v2_event_binary, protocol="thrift")
+        self.assertFalse(make_queue.called)
+
+    def test_put_many_too_large(self):
+        events = [mock.Mock(autospec=Event), mock.Mock(autospec=Event)]
+        events[0].serialize.return_value = "{}"
+        events[1].serialize.return_value = "x" * (MAX_EVENT_SIZE + 1)
+
+        with self.assertRaises(EventTooLargeError):
+            self.queue.put_many(events)
+        self.assertEqual(self.message_queue.put_many.call_count, 0)
+
+    def test_put_many_queue_full(self):
+        self.message_queue.put_many.return_value = 0
+        mock_event = mock.Mock(autospec=Event)
+        mock_event.serialize.return_value = "{}"
+
+        with self.assertRaises(EventQueueFullError):
+            self.queue.put_many([mock_event])
+
+    def test_sampler(self):
+        self.message_queue.put_many.side_effect = lambda messages, timeout: len(messages)
+        sampler = mock.Mock(spec=EventSampler)
+        sampler.should_send.side_effect = lambda event: event.serialize.return_value != "{}"
+        self.queue.sampler = sampler
+        events = [mock.Mock(autospec=Event), mock.Mock(autospec=Event)]
+        events[0].serialize.return_value = "{}"
+        events[1].serialize.return_value = "[]"
+
+        self.queue.put(events[0])
+        self.assertEqual(self.message_queue.put.call_count, 0)
+        self.queue.put_many(events)
+        messages = self.message_queue.put_many.call_args[0][0]
+        self.assertEqual(messages, [b"[]"])
+        self.assertEqual(events[0].serialize.call_count, 0)
+
+        batch = mock.Mock()
+        self.queue.report_runtime_metrics(batch)
+        sampler.report_runtime_metrics.assert_called_once_with(batch)
+
+    def test_unbuffered_context_object(self):
+        span = mock.Mock(spec=ServerSpan)
+        self.assertIs(self.queue.make_object_for_context("events", span), self.queue)
+        self.assertEqual(span.register.call_count, 0)
+
+    def test_buffered_context_object(self):
+        self.message_queue.put_many.side_effect = lambda messages, timeout: len(messages)
+        self.queue.buffered = True
+        span = mock.Mock(spec=ServerSpan)
+        mock_event = mock.Mock(autospec=Event)
+        mock_event.serialize.return_value = "{}"
+
+        buffered = self.queue.make_object_for_context("events", span)
+        buffered.put(mock_event)
+        buffered.put(mock_event)
+        self.assertEqual(self.message_queue.put_many.call_count, 0)
+
+        observer = span.register.call_args[0][0]
+        observer.on_finish(exc_info=None)
+        self.assertEqual(self.message_queue.put_many.call_count, 1)
+        messages = self.message_queue.put_many.call_args[0][0]
+        self.assertEqual(unpack_events(messages[0]), (2, b"{},{}"))
+
+    def test_buffered_flush_queue_full(self):
+        self.message_queue.put_many.side_effect = TimedOutError
+        self.queue.buffered = True
+        span = mock.Mock(spec=ServerSpan)
+        mock_event = mock.Mock(autospec=Event)
+        mock_event.serialize.return_value = "{}"
+
+        buffered = self.queue.make_object_for_context("events", span)
+        buffered.put(mock_event)
+
+        observer = span.register.call_args[0][0]
+        observer.on_finish(exc_info=None)
+
+    def test_buffered_flush_error_logged(self):
+        self.message_queue.put_many.side_effect = OSError
+        self.queue.buffered = True
+        span = mock.Mock(spec=ServerSpan)
+        mock_event = mock.Mock(autospec=Event)
+        mock_event.serialize.return_value = "{}"
+
+        buffered = self.queue.make_object_for_context("events", span)
+        buffered.put(mock_event)
+
+        observer = span.register.call_args[0][0]
+        with self.assertLogs("baseplate.events.queue", "ERROR"):
+            observer.on_finish(exc_info=None)
+
+
+class PackEventsTests(unittest.TestCase):
+    def test_single_event_not_packed(self):
+        self.assertEqual(pack_events([b"{}"]), [b"{}"])
+        self.assertEqual(unpack_events(b"{}"), (1, b"{}"))
+
+    def test_splits_at_max_size(self):
+        big = b"x" * (MAX_EVENT_SIZE // 2)
+        messages = pack_events([big, big, b"{}"])
+
+        self.assertEqual(len(messages), 2)
+        self.assertEqual(messages[0], big)
+        self.assertEqual(unpack_events(messages[1]), (2, big + b",{}"))
+        self.assertTrue(all(len(message) <= MAX_EVENT_SIZE for message in messages))
@@ -0,0 +1,115 @@
+import unittest
+
+from baseplate import metrics
+from baseplate.events import Event
+from baseplate.events.sampling import EventSampler, SamplingRule
+from baseplate.thrift.ttypes import Loid
+
+from ... import mock
+
+
+def make_event(topic="topic", event_type="type", **fields):
+    event = Event(topic, event_type)
+    for key, value in fields.items():
+        event.set_field(key, value)
+    return event
+
+
+class SamplingRuleTests(unittest.TestCase):
+    def test_invalid_rate(self):
+        with self.assertRaises(ValueError):
+            SamplingRule(sample_rate=1.5)
+
+
+class EventSamplerTests(unittest.TestCase):
+    def test_no_matching_rule(self):
+        sampler = EventSampler({"other": SamplingRule(sample_rate=0)})
+        self.assertTrue(sampler.should_send(make_event()))
+        self.assertEqual(sampler.counts, {})
+
+    def test_rule_precedence(self):
+        sampler = EventSampler(
+            {("topic", "type"): SamplingRule(sample_rate=1), "topic": SamplingRule(sample_rate=0)},
+            default_rule=SamplingRule(sample_rate=0),
+        )
+        self.assertTrue(sampler.should_send(make_event("topic", "type")))
+        self.assertFalse(sampler.should_send(make_event("topic", "other")))
+        self.assertFalse(sampler.should_send(make_event("other", "type")))
+        self.assertEqual(
+            sampler.counts,
+            {
+                ("topic.type", "kept"): 1,
+                ("topic", "sampled_out"): 1,
+                ("default", "sampled_out"): 1,
+            },
+        )
+
+    def test_sample_rate(self):
+        sampler = EventSampler({"topic": SamplingRule(sample_rate=0.25)})
+        kept = sum(sampler.should_send(make_event()) for _ in range(4000))
+        self.assertAlmostEqual(kept / 4000, 0.25, delta=0.05)
+
+    def test_sample_key_is_deterministic(self):
+        rule = SamplingRule(sample_rate=0.5, sample_key="user_id")
+        first = EventSampler({"topic": rule})
+        second = EventSampler({"topic": rule})
+
+        for i in range(100):
+            decisions = {
+                sampler.should_send(make_event(user_id="t2_%d" % i))
+                for sampler in (first, first, second)
+            }
+            self.assertEqual(len(decisions), 1)
+
+    def test_deduplicate(self):
+        sampler = EventSampler({"topic": SamplingRule(deduplicate=True)})
+        event = make_event()
+        self.assertTrue(sampler.should_send(event))
+        self.assertFalse(sampler.should_send(event))
+        self.assertTrue(sampler.should_send(make_event()))
+        self.assertEqual(sampler.counts, {("topic", "kept"): 2, ("topic", "duplicate"): 1})
+
+    @mock.patch("time.monotonic")
+    def test_deduplicate_window(self, monotonic):
+        monotonic.return_value = 100
+        sampler = EventSampler({"topic": SamplingRule(deduplicate=True)}, dedupe_window=10)
+        event = make_event()
+        self.assertTrue(sampler.should_send(event))
+
+        monotonic.return_value = 115
+        self.assertFalse(sampler.should_send(event))
+
+        monotonic.return_value = 130
+        self.assertTrue(sampler.should_send(event))
+
+    def test_deduplicate_max_ids(self):
+        sampler = EventSampler({"topic": SamplingRule(deduplicate=True)}, max_dedupe_ids=4)
+        events = [make_event() for _ in range(5)]
+        for event in events:
+            self.assertTrue(sampler.should_send(event))
+        self.assertLessEqual(len(sampler.recent_ids.current) + len(sampler.recent_ids.previous), 4)
+        self.assertFalse(sampler.should_send(events[-1]))
+
+    def test_thrift_event(self):
+        sampler = EventSampler(
+            {}, default_rule=SamplingRule(sample_rate=0.5, deduplicate=True), id_field="id"
+        )
+        decisions = [sampler.should_send(Loid(id="t2_%d" % i)) for i in range(200)]
+        self.assertIn(True, decisions)
+        self.assertIn(False, decisions)
+
+        kept_id = "t2_%d" % decisions.index(True)
+        self.assertFalse(sampler.should_send(Loid(id=kept_id)))
+
+    def test_report_runtime_metrics(self):
+        sampler = EventSampler({"topic": SamplingRule(deduplicate=True)})
+        event = make_event()
+        sampler.should_send(event)
+        sampler.should_send(event)
+        batch = mock.Mock(spec=metrics.Batch)
+
+        sampler.report_runtime_metrics(batch)
+
+        batch.counter.assert_any_call("sampling.topic.kept")
+        batch.counter.assert_any_call("sampling.topic.duplicate")
+        self.assertEqual(sampler.counts, {})
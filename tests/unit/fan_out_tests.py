@@ -0,0 +1,87 @@
+import threading
+import time
+import unittest
+
+from baseplate import fan_out
+from baseplate.core import Baseplate, LocalSpan
+
+
+class FanOutTests(unittest.TestCase):
+    def setUp(self):
+        baseplate = Baseplate()
+        self.context = baseplate.make_context_object()
+        self.server_span = baseplate.make_server_span(self.context, "handler")
+        self.server_span.start()
+
+    def test_results(self):
+        results = fan_out.fan_out(self.context, {"a": lambda ctx: 1, "b": lambda ctx: 2})
+        self.assertEqual(results, {"a": 1, "b": 2})
+
+        results = fan_out.fan_out(self.context, [lambda ctx: 1, lambda ctx: 2])
+        self.assertEqual(results, [1, 2])
+
+    def test_concurrent(self):
+        barrier = threading.Barrier(3, timeout=5)
+
+        def call(ctx):
+            barrier.wait()
+            return True
+
+        results = fan_out.fan_out(self.context, [call] * 3)
+        self.assertEqual(results, [True] * 3)
+
+    def test_child_spans(self):
+        def call(ctx):
+            return ctx.trace
+
+        results = fan_out.fan_out(self.context, {"a": call, "b": call})
+
+        for name, span in results.items():
+            self.assertIsInstance(span, LocalSpan)
+            self.assertEqual(span.name, "fan_out." + name)
+            self.assertEqual(span.parent_id, self.server_span.id)
+            self.assertEqual(span.trace_id, self.server_span.trace_id)
+        self.assertIsNot(results["a"].context, results["b"].context)
+
+    def test_errors(self):
+        error = ValueError("bad")
+
+        def fail(ctx):
+            raise error
+
+        with self.assertRaises(fan_out.FanOutError) as raised:
+            fan_out.fan_out(self.context, {"ok": lambda ctx: 1, "bad": fail})
+
+        self.assertEqual(raised.exception.errors, {"bad": error})
+        self.assertEqual(raised.exception.results, {"ok": 1})
+
+    def test_timeout(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        start = time.monotonic()
+        with self.assertRaises(fan_out.FanOutError) as raised:
+            fan_out.fan_out(
+                self.context,
+                {"fast": lambda ctx: 1, "slow": lambda ctx: release.wait(5)},
+                timeout=0.05,
+            )
+
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertIsInstance(raised.exception.errors["slow"], fan_out.FanOutTimeoutError)
+        self.assertEqual(raised.exception.results, {"fast": 1})
+
+    def test_fail_fast(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def fail(ctx):
+            raise ValueError
+
+        with self.assertRaises(fan_out.FanOutError) as raised:
+            fan_out.fan_out(
+                self.context, {"bad": fail, "slow": lambda ctx: release.wait(5)}, fail_fast=True
+            )
+
+        self.assertIsInstance(raised.exception.errors["slow"], fan_out.FanOutCancelledError)
+        self.assertIsInstance(raised.exception.errors["bad"], ValueError)
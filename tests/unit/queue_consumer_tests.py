@@ -1,3 +1,5 @@
+import queue
+import threading
 import unittest
 
 try:
@@ -7,6 +9,7 @@ except ImportError:
 else:
     del kombu
 
+from baseplate import metrics
 from baseplate import queue_consumer
 
 from .. import mock
@@ -66,3 +69,198 @@ class BaseKombuConsumerTests(unittest.TestCase):
         # it is greater than zero (which is infinite/unbounded).
         consumer = queue_consumer.BaseKombuConsumer.new(mock.Mock(), mock.Mock())
         self.assertGreater(consumer.worker.work_queue.maxsize, 0)
+
+    def test_prefetch_count(self):
+        worker = queue_consumer._ConsumerWorker(mock.Mock(), [], mock.Mock(), prefetch_count=7)
+        Consumer = mock.Mock()
+        worker.get_consumers(Consumer, mock.Mock())
+        self.assertEqual(Consumer.call_args[1]["prefetch_count"], 7)
+
+
+class ConsumerMetricsTests(unittest.TestCase):
+    def setUp(self):
+        self.work_queue = queue.Queue(maxsize=100)
+        self.worker = queue_consumer._ConsumerWorker(
+            mock.Mock(), [], self.work_queue, prefetch_count=2, prefetch_target_seconds=5
+        )
+        self.worker.consumer = mock.Mock()
+        self.kombu_consumer = queue_consumer.BaseKombuConsumer(self.worker, mock.Mock())
+
+    @mock.patch("time.monotonic")
+    def test_queue_wait(self, monotonic):
+        message = mock.Mock(delivery_info={"redelivered": True})
+        monotonic.return_value = 100
+        self.worker.on_message(message)
+        monotonic.return_value = 103
+
+        self.assertEqual(self.kombu_consumer.get_batch(max_items=1, timeout=0), [message])
+        self.assertEqual(list(self.worker.stats.queue_waits), [3])
+        self.assertEqual(self.worker.stats.redelivered, 1)
+
+    def test_report_runtime_metrics(self):
+        self.worker.on_message(mock.Mock(delivery_info={}))
+        self.kombu_consumer.record_handled(0.5, message_count=3)
+        self.worker.stats.redelivered = 1
+        batch = mock.Mock(spec=metrics.Batch)
+
+        self.kombu_consumer.report_runtime_metrics(batch)
+
+        batch.gauge.assert_any_call("work_queue.depth")
+        batch.gauge("work_queue.depth").replace.assert_any_call(1)
+        batch.gauge.assert_any_call("prefetch_count")
+        batch.counter.assert_any_call("messages.handled")
+        batch.counter("messages.handled").increment.assert_any_call(3)
+        batch.counter("messages.redelivered").increment.assert_any_call(1)
+        batch.histogram("handler.latency").add_sample.assert_called_once_with(500)
+
+        batch.reset_mock()
+        self.kombu_consumer.report_runtime_metrics(batch)
+        batch.counter("messages.handled").increment.assert_any_call(0)
+        self.assertFalse(batch.histogram("handler.latency").add_sample.called)
+
+    @mock.patch("time.monotonic")
+    def test_adjust_prefetch_count(self, monotonic):
+        monotonic.return_value = 100
+        self.worker.rate_checked_at = 100
+
+        self.kombu_consumer.record_handled(1, message_count=100)
+        monotonic.return_value = 105
+        self.worker.on_iteration()
+        self.assertFalse(self.worker.consumer.qos.called)
+
+        monotonic.return_value = 110
+        self.worker.on_iteration()
+        self.worker.consumer.qos.assert_called_once_with(prefetch_count=50)
+        self.assertEqual(self.worker.prefetch_count, 50)
+
+        # bounded by the given prefetch count and the work queue size
+        monotonic.return_value = 120
+        self.worker.on_iteration()
+        self.worker.consumer.qos.assert_called_with(prefetch_count=2)
+
+        self.kombu_consumer.record_handled(1, message_count=10000)
+        monotonic.return_value = 130
+        self.worker.on_iteration()
+        self.worker.consumer.qos.assert_called_with(prefetch_count=100)
+
+    def test_no_prefetch_target(self):
+        self.worker.prefetch_target_seconds = None
+        self.worker.rate_checked_at = 0
+        self.worker.on_iteration()
+        self.assertFalse(self.worker.consumer.qos.called)
+
+
+class ConcurrentConsumeTests(unittest.TestCase):
+    def setUp(self):
+        self.work_queue = queue.Queue()
+        worker = queue_consumer._ConsumerWorker(mock.Mock(), [], self.work_queue)
+        self.kombu_consumer = queue_consumer.KombuConsumer(worker, mock.Mock())
+        self.baseplate = mock.MagicMock(_metrics_client=None)
+
+    def make_message(self, body):
+        message = mock.Mock(body=body, delivery_info={"routing_key": "key"})
+        self.work_queue.put((0, message))
+        return message
+
+    @mock.patch.object(queue_consumer, "_STOP_CHECK_INTERVAL", 0.01)
+    def test_handles_concurrently_and_drains_on_error(self):
+        barrier = threading.Barrier(3, timeout=5)
+        acked = threading.Semaphore(0)
+
+        def handler(context, body, message):
+            if body == "fail":
+                # wait for the concurrent messages to be finished so the
+                # failure definitely happens with nothing in flight
+                for _ in range(3):
+                    acked.acquire(timeout=5)
+                raise ValueError(body)
+            barrier.wait()
+
+        messages = [self.make_message(i) for i in range(3)]
+        for message in messages:
+            message.ack.side_effect = acked.release
+        failing_message = self.make_message("fail")
+
+        with self.assertRaises(ValueError):
+            queue_consumer._consume_concurrently(
+                self.baseplate, self.kombu_consumer, "queue", handler, concurrency=3
+            )
+
+        for message in messages:
+            message.ack.assert_called_once_with()
+        self.assertFalse(failing_message.ack.called)
+        self.assertEqual(self.baseplate.make_server_span.call_count, 4)
+        self.assertTrue(self.kombu_consumer.worker.should_stop)
+        self.assertEqual(self.kombu_consumer.worker.stats.handled, 3)
+
+    def test_invalid_concurrency(self):
+        with self.assertRaises(ValueError):
+            queue_consumer.consume(
+                self.baseplate, mock.Mock(), mock.Mock(), "queue", [], mock.Mock(), concurrency=0
+            )
+
+    @mock.patch("baseplate.queue_consumer._consume_concurrently")
+    @mock.patch("baseplate.queue_consumer.KombuConsumer")
+    def test_default_prefetch_count(self, KombuConsumer, consume_concurrently):
+        handler = mock.Mock(__name__="handler")
+        queue_consumer.consume(
+            self.baseplate, mock.Mock(), mock.Mock(), "queue", ["key"], handler, concurrency=4
+        )
+        self.assertEqual(KombuConsumer.new.call_args[1]["prefetch_count"], 8)
+        consume_concurrently.assert_called_once_with(
+            self.baseplate, KombuConsumer.new.return_value, "queue", handler, 4
+        )
+
+
+class BatchConsumeTests(unittest.TestCase):
+    def make_message(self, delivery_tag, acknowledged=False):
+        return mock.Mock(delivery_tag=delivery_tag, acknowledged=acknowledged)
+
+    def test_ack_batch(self):
+        messages = [self.make_message(3), self.make_message(5), self.make_message(4)]
+        queue_consumer.ack_batch(messages)
+        messages[1].ack.assert_called_once_with(multiple=True)
+        self.assertFalse(messages[0].ack.called)
+        self.assertFalse(messages[2].ack.called)
+
+    def test_ack_batch_skips_rejected(self):
+        messages = [self.make_message(3), self.make_message(4, acknowledged=True)]
+        queue_consumer.ack_batch(messages)
+        messages[0].ack.assert_called_once_with(multiple=True)
+        self.assertFalse(messages[1].ack.called)
+
+    def test_ack_batch_all_rejected(self):
+        messages = [self.make_message(3, acknowledged=True)]
+        queue_consumer.ack_batch(messages)
+        self.assertFalse(messages[0].ack.called)
+
+    @mock.patch.object(queue_consumer.BaseKombuConsumer, "get_batch")
+    @mock.patch("baseplate.queue_consumer.KombuConsumer")
+    def test_consume_batch(self, KombuConsumer, get_batch):
+        batch = [self.make_message(1), self.make_message(2)]
+        kombu_consumer = KombuConsumer.new.return_value
+        get_batch.side_effect = [[], batch, [], KeyboardInterrupt]
+        baseplate = mock.MagicMock(_metrics_client=None)
+        handler = mock.Mock(__name__="handler")
+
+        with self.assertRaises(KeyboardInterrupt):
+            queue_consumer.consume_batch(
+                baseplate,
+                mock.Mock(),
+                mock.Mock(),
+                "queue",
+                ["key"],
+                handler,
+                batch_size=10,
+                batch_timeout=0.5,
+            )
+
+        self.assertEqual(KombuConsumer.new.call_args[1]["prefetch_count"], 10)
+        get_batch.assert_called_with(kombu_consumer, 10, 0.5)
+        # only the batch with messages gets a span
+        baseplate.make_server_span.assert_called_once_with(mock.ANY, "queue")
+        span = baseplate.make_server_span.return_value.__enter__.return_value
+        span.set_tag.assert_called_once_with("message_count", 2)
+        handler.assert_called_once_with(mock.ANY, batch)
+        batch[1].ack.assert_called_once_with(multiple=True)
+        kombu_consumer.record_handled.assert_called_once_with(mock.ANY, 2)
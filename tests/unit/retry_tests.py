@@ -52,6 +52,36 @@ class RetryPolicyTests(unittest.TestCase):
         with self.assertRaises(StopIteration):
             next(retries)
 
+    @mock.patch("time.time", autospec=True)
+    def test_time_budget_respects_subpolicy(self, time):
+        time.return_value = 0
+        subpolicy = MaximumAttemptsRetryPolicy(IndefiniteRetryPolicy(), attempts=2)
+        policy = TimeBudgetRetryPolicy(subpolicy, budget=5)
+
+        retries = iter(policy)
+        self.assertEqual(next(retries), 5)
+        self.assertEqual(next(retries), 5)
+        with self.assertRaises(StopIteration):
+            next(retries)
+
+    @mock.patch("time.time", autospec=True)
+    def test_time_budget_single_attempt(self, time):
+        time.return_value = 0
+        policy = RetryPolicy.new(attempts=1, budget=10)
+        self.assertEqual(list(policy), [10])
+
+    @mock.patch("time.time", autospec=True)
+    def test_time_budget_and_attempts(self, time):
+        time.return_value = 0
+        policy = RetryPolicy.new(attempts=3, budget=10)
+
+        retries = iter(policy)
+        self.assertEqual(next(retries), 10)
+
+        time.return_value = 11
+        with self.assertRaises(StopIteration):
+            next(retries)
+
     @mock.patch("time.sleep", autospec=True)
     def test_exponential_backoff(self, sleep):
         base_policy = mock.MagicMock()
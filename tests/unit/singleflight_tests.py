@@ -0,0 +1,90 @@
+import threading
+import unittest
+
+from baseplate.singleflight import SingleFlight
+
+from .. import mock
+
+
+class SingleFlightTests(unittest.TestCase):
+    def setUp(self):
+        self.singleflight = SingleFlight()
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+
+    def slow_call(self, result=None, error=None):
+        def call():
+            self.started.set()
+            self.release.wait(5)
+            if error is not None:
+                raise error
+            return result
+
+        return call
+
+    def lead(self, call, key="key"):
+        outcome = {}
+
+        def run():
+            try:
+                outcome["result"] = self.singleflight.do(key, call)
+            except BaseException as exc:  # pylint: disable=broad-except
+                outcome["error"] = exc
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        self.started.wait(5)
+        return thread, outcome
+
+    def test_not_shared(self):
+        self.assertEqual(self.singleflight.do("key", lambda: 1), (1, False))
+        self.assertEqual(self.singleflight.do("key", lambda: 2), (2, False))
+        self.assertEqual(self.singleflight.flights, {})
+
+    def test_shared(self):
+        leader, outcome = self.lead(self.slow_call(result="result"))
+        threading.Timer(0.05, self.release.set).start()
+        follower_call = mock.Mock()
+
+        self.assertEqual(self.singleflight.do("key", follower_call), ("result", True))
+
+        leader.join()
+        self.assertEqual(outcome["result"], ("result", False))
+        self.assertFalse(follower_call.called)
+
+    def test_different_keys(self):
+        leader, _ = self.lead(self.slow_call())
+
+        self.assertEqual(self.singleflight.do("other", lambda: 2), (2, False))
+
+        self.release.set()
+        leader.join()
+
+    def test_error_shared(self):
+        error = ValueError("oops")
+        leader, outcome = self.lead(self.slow_call(error=error))
+        threading.Timer(0.05, self.release.set).start()
+
+        with self.assertRaises(ValueError):
+            self.singleflight.do("key", mock.Mock())
+
+        leader.join()
+        self.assertIs(outcome["error"], error)
+
+    def test_abandoned_call_retried(self):
+        leader, _ = self.lead(self.slow_call(error=KeyboardInterrupt()))
+        threading.Timer(0.05, self.release.set).start()
+
+        self.assertEqual(self.singleflight.do("key", lambda: "mine"), ("mine", False))
+        leader.join()
+
+    def test_wait_context(self):
+        leader, _ = self.lead(self.slow_call(result="result"))
+        threading.Timer(0.05, self.release.set).start()
+        wait_context = mock.MagicMock()
+
+        self.singleflight.do("key", mock.Mock(), wait_context=wait_context)
+
+        wait_context.return_value.__enter__.assert_called_once_with()
+        leader.join()
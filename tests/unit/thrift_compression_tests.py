@@ -0,0 +1,133 @@
+import unittest
+
+from thrift.Thrift import TMessageType
+from thrift.protocol import THeaderProtocol
+from thrift.transport import TTransport
+from thrift.transport.THeaderTransport import THeaderClientType
+
+from baseplate.thrift_compression import (
+    ACCEPT_COMPRESSION_HEADER,
+    THeaderCompressionProtocolFactory,
+)
+
+
+SMALL_PAYLOAD = "x" * 100
+LARGE_PAYLOAD = "x" * 10000
+
+
+def send(factory, payload, incoming=None):
+    """Write a message with the factory's protocol and return its bytes.
+
+    If ``incoming`` is given, it's read first as if received from the peer.
+
+    """
+    buf = TTransport.TMemoryBuffer(incoming or b"")
+    prot = factory.getProtocol(buf)
+    if incoming is not None:
+        receive(prot)
+
+    prot.writeMessageBegin("method", TMessageType.CALL, 1)
+    prot.writeString(payload)
+    prot.writeMessageEnd()
+    prot.trans.flush()
+    # the buffer holds what was read followed by what was written
+    return buf.getvalue()[len(incoming or b"") :]
+
+
+def receive(prot):
+    prot.readMessageBegin()
+    payload = prot.readString()
+    prot.readMessageEnd()
+    return payload
+
+
+def read(data):
+    """Read a message with a plain THeaderProtocol, as any client would."""
+    prot = THeaderProtocol.THeaderProtocol(
+        TTransport.TMemoryBuffer(data), allowed_client_types=(THeaderClientType.HEADERS,)
+    )
+    payload = receive(prot)
+    return payload, prot.get_headers()
+
+
+class CompressionTests(unittest.TestCase):
+    def setUp(self):
+        self.client_factory = THeaderCompressionProtocolFactory(threshold=1024)
+        self.server_factory = THeaderCompressionProtocolFactory(threshold=1024)
+        self.plain_factory = THeaderProtocol.THeaderProtocolFactory()
+
+    def test_unsupported_compression(self):
+        with self.assertRaises(ValueError):
+            THeaderCompressionProtocolFactory(compression="zstd")
+
+    def test_client_waits_for_server_to_accept(self):
+        data = send(self.client_factory, LARGE_PAYLOAD)
+
+        self.assertIn(LARGE_PAYLOAD.encode(), data)
+        payload, headers = read(data)
+        self.assertEqual(payload, LARGE_PAYLOAD)
+        self.assertEqual(headers[ACCEPT_COMPRESSION_HEADER], b"zlib")
+
+    def test_client_compresses_for_accepting_servers(self):
+        request = send(self.client_factory, SMALL_PAYLOAD)
+        response = send(self.server_factory, SMALL_PAYLOAD, incoming=request)
+        data = send(self.client_factory, LARGE_PAYLOAD, incoming=response)
+
+        self.assertLess(len(data), 1000)
+        payload, headers = read(data)
+        self.assertEqual(payload, LARGE_PAYLOAD)
+        self.assertEqual(headers[ACCEPT_COMPRESSION_HEADER], b"zlib")
+
+    def test_client_leaves_small_messages(self):
+        request = send(self.client_factory, SMALL_PAYLOAD)
+        response = send(self.server_factory, SMALL_PAYLOAD, incoming=request)
+        data = send(self.client_factory, SMALL_PAYLOAD, incoming=response)
+
+        self.assertIn(SMALL_PAYLOAD.encode(), data)
+        self.assertEqual(read(data)[0], SMALL_PAYLOAD)
+
+    def test_client_does_not_compress_for_other_servers(self):
+        request = send(self.client_factory, SMALL_PAYLOAD)
+        response = send(self.plain_factory, SMALL_PAYLOAD, incoming=request)
+        data = send(self.client_factory, LARGE_PAYLOAD, incoming=response)
+
+        self.assertIn(LARGE_PAYLOAD.encode(), data)
+
+    def test_server_compresses_for_accepting_clients(self):
+        request = send(self.client_factory, SMALL_PAYLOAD)
+        response = send(self.server_factory, LARGE_PAYLOAD, incoming=request)
+
+        self.assertLess(len(response), 1000)
+        payload, headers = read(response)
+        self.assertEqual(payload, LARGE_PAYLOAD)
+        self.assertEqual(headers[ACCEPT_COMPRESSION_HEADER], b"zlib")
+
+    def test_server_leaves_small_responses(self):
+        request = send(self.client_factory, SMALL_PAYLOAD)
+        response = send(self.server_factory, SMALL_PAYLOAD, incoming=request)
+
+        self.assertIn(SMALL_PAYLOAD.encode(), response)
+
+    def test_server_does_not_compress_for_other_clients(self):
+        request = send(self.plain_factory, SMALL_PAYLOAD)
+        response = send(self.server_factory, LARGE_PAYLOAD, incoming=request)
+
+        self.assertIn(LARGE_PAYLOAD.encode(), response)
+        self.assertEqual(read(response)[0], LARGE_PAYLOAD)
+
+    def test_compression_per_message(self):
+        prot = self.server_factory.getProtocol(
+            TTransport.TMemoryBuffer(send(self.client_factory, SMALL_PAYLOAD))
+        )
+        receive(prot)
+
+        for payload in (LARGE_PAYLOAD, SMALL_PAYLOAD):
+            prot.writeMessageBegin("method", TMessageType.REPLY, 1)
+            prot.writeString(payload)
+            prot.writeMessageEnd()
+            prot.trans.flush()
+
+        # the large response was compressed and the small one after it wasn't
+        data = prot.trans._transport.getvalue()
+        self.assertLess(len(data), 1000)
+        self.assertIn(SMALL_PAYLOAD.encode(), data)
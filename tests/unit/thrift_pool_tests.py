@@ -1,8 +1,14 @@
+import json
 import queue
+import random
 import socket
+import tempfile
+import time
 import unittest
 
-from baseplate import config, thrift_pool
+from baseplate import config, metrics, thrift_pool
+from baseplate.service_discovery import Backend, ServiceInventory
+from baseplate.thrift_compression import THeaderCompressionProtocolFactory
 from thrift.Thrift import TException
 from thrift.transport import TTransport, THeaderTransport, TSocket
 from thrift.protocol import THeaderProtocol, TBinaryProtocol
@@ -43,7 +49,9 @@ class ThriftConnectionPoolTests(unittest.TestCase):
         self.mock_queue.get.side_effect = queue.Empty
 
         with self.assertRaises(TTransport.TTransportException):
-            self.pool._acquire()
+            with self.pool.connection():
+                pass
+        self.assertEqual(self.pool.acquire_timeouts, 1)
 
     def test_pool_with_framed_protocol_factory(self):
         def framed_protocol_factory(trans):
@@ -64,11 +72,12 @@ class ThriftConnectionPoolTests(unittest.TestCase):
         mock_time.return_value = 123
         mock_prot = mock.Mock(spec=THeaderProtocol.THeaderProtocol)
         mock_prot.baseplate_birthdate = 122
+        mock_prot.baseplate_max_age = 120
+        mock_prot.trans = mock.Mock(spec=TSocket.TSocket)
         self.mock_queue.get.return_value = mock_prot
 
-        prot = self.pool._acquire()
-
-        self.assertEqual(prot, mock_prot)
+        with self.pool.connection() as prot:
+            self.assertEqual(prot, mock_prot)
 
     @mock.patch("baseplate.thrift_pool._make_transport")
     @mock.patch("time.time")
@@ -77,6 +86,8 @@ class ThriftConnectionPoolTests(unittest.TestCase):
         stale_prot.trans = mock.Mock(spec=TSocket.TSocket)
 
         stale_prot.baseplate_birthdate = 10
+
+        stale_prot.baseplate_max_age = 120
         mock_time.return_value = 200
         self.mock_queue.get.return_value = stale_prot
 
@@ -84,10 +95,10 @@ class ThriftConnectionPoolTests(unittest.TestCase):
         fresh_trans.protocol_id = THeaderTransport.THeaderSubprotocolID.BINARY
         mock_make_transport.return_value = fresh_trans
 
-        prot = self.pool._acquire()
-
-        self.assertTrue(stale_prot.trans.close.called)
-        self.assertEqual(prot.trans._transport, fresh_trans)
+        with self.pool.connection() as prot:
+            self.assertTrue(stale_prot.trans.close.called)
+            self.assertEqual(prot.trans._transport, fresh_trans)
+            self.assertEqual(self.pool.max_age_closes, 1)
 
     @mock.patch("baseplate.thrift_pool._make_transport")
     @mock.patch("time.time")
@@ -104,10 +115,9 @@ class ThriftConnectionPoolTests(unittest.TestCase):
 
         mock_make_transport.side_effect = [broken_trans, ok_trans]
 
-        prot = self.pool._acquire()
-
-        self.assertEqual(prot.trans._transport, ok_trans)
-        self.assertEqual(ok_trans.open.call_count, 1)
+        with self.pool.connection() as prot:
+            self.assertEqual(prot.trans._transport, ok_trans)
+            self.assertEqual(ok_trans.open.call_count, 1)
 
     @mock.patch("baseplate.thrift_pool._make_transport")
     @mock.patch("time.time")
@@ -122,7 +132,8 @@ class ThriftConnectionPoolTests(unittest.TestCase):
         mock_make_transport.side_effect = [broken_trans] * 3
 
         with self.assertRaises(TTransport.TTransportException):
-            self.pool._acquire()
+            with self.pool.connection():
+                pass
 
         self.assertEqual(self.mock_queue.put.call_count, 1)
         self.assertEqual(self.mock_queue.put.call_args, mock.call(None))
@@ -136,6 +147,7 @@ class ThriftConnectionPoolTests(unittest.TestCase):
 
         self.assertEqual(self.mock_queue.put.call_count, 1)
         self.assertEqual(self.mock_queue.put.call_args, mock.call(mock_prot))
+        self.assertEqual(self.pool.error_closes, 0)
 
     def test_release_closed(self):
         mock_prot = mock.Mock(spec=THeaderProtocol.THeaderProtocol)
@@ -146,12 +158,14 @@ class ThriftConnectionPoolTests(unittest.TestCase):
 
         self.assertEqual(self.mock_queue.put.call_count, 1)
         self.assertEqual(self.mock_queue.put.call_args, mock.call(None))
+        self.assertEqual(self.pool.error_closes, 1)
 
     @mock.patch("time.time")
     def test_context_normal(self, mock_time):
         mock_time.return_value = 123
         mock_prot = mock.Mock(spec=THeaderProtocol.THeaderProtocol)
         mock_prot.baseplate_birthdate = 122
+        mock_prot.baseplate_max_age = 120
         mock_prot.trans = mock.Mock(spec=TSocket.TSocket)
         mock_prot.trans.isOpen.return_value = True
         self.mock_queue.get.return_value = mock_prot
@@ -160,6 +174,7 @@ class ThriftConnectionPoolTests(unittest.TestCase):
             pass
 
         self.assertEqual(prot, mock_prot)
+        self.assertEqual(list(self.pool.acquire_times), [prot.baseplate_acquire_time])
         self.assertEqual(self.mock_queue.get.call_count, 1)
         self.assertEqual(self.mock_queue.put.call_count, 1)
         self.assertEqual(self.mock_queue.put.call_args, mock.call(mock_prot))
@@ -169,6 +184,7 @@ class ThriftConnectionPoolTests(unittest.TestCase):
         mock_time.return_value = 123
         mock_prot = mock.Mock(spec=THeaderProtocol.THeaderProtocol)
         mock_prot.baseplate_birthdate = 122
+        mock_prot.baseplate_max_age = 120
         mock_prot.trans = mock.Mock(spec=TSocket.TSocket)
         mock_prot.trans.isOpen.return_value = True
         self.mock_queue.get.return_value = mock_prot
@@ -189,6 +205,7 @@ class ThriftConnectionPoolTests(unittest.TestCase):
         mock_time.return_value = 123
         mock_prot = mock.Mock(spec=THeaderProtocol.THeaderProtocol)
         mock_prot.baseplate_birthdate = 122
+        mock_prot.baseplate_max_age = 120
         mock_prot.trans = mock.Mock(spec=TSocket.TSocket)
         mock_prot.trans.isOpen.return_value = True
         self.mock_queue.get.return_value = mock_prot
@@ -201,3 +218,633 @@ class ThriftConnectionPoolTests(unittest.TestCase):
         self.assertEqual(self.mock_queue.get.call_count, 1)
         self.assertEqual(self.mock_queue.put.call_count, 1)
         self.assertEqual(self.mock_queue.put.call_args, mock.call(mock_prot))
+
+
+class ConnectionMaintenanceTests(unittest.TestCase):
+    def setUp(self):
+        self.pool = thrift_pool.ThriftConnectionPool(EXAMPLE_ENDPOINT, size=4, max_age=100)
+        self.pool.min_idle = 2
+        self.pool._connect = mock.Mock(side_effect=self.make_prot)
+
+    def make_prot(self, birthdate=None):
+        prot = mock.Mock()
+        prot.baseplate_birthdate = time.time() if birthdate is None else birthdate
+        prot.baseplate_max_age = 100
+        return prot
+
+    @mock.patch("baseplate.thrift_pool._make_transport")
+    def test_jittered_max_age(self, mock_make_transport):
+        mock_make_transport.return_value.protocol_id = THeaderTransport.THeaderSubprotocolID.BINARY
+        pool = thrift_pool.ThriftConnectionPool(EXAMPLE_ENDPOINT, max_age=100, max_age_jitter=0.2)
+
+        max_ages = {pool._connect().baseplate_max_age for _ in range(20)}
+
+        self.assertTrue(all(80 <= max_age <= 100 for max_age in max_ages))
+        self.assertGreater(len(max_ages), 1)
+        self.assertEqual(pool.connects, 20)
+        self.assertEqual(len(pool.connect_times), 20)
+
+    def test_opens_min_idle(self):
+        self.pool._maintain()
+
+        self.assertEqual(self.pool._connect.call_count, 2)
+        self.assertEqual(self.pool.pool.qsize(), 4)
+        self.assertEqual(sum(1 for prot in self.pool.pool.queue if prot), 2)
+
+        self.pool._maintain()
+        self.assertEqual(self.pool._connect.call_count, 2)
+
+    def test_refreshes_expiring(self):
+        fresh_prot = self.make_prot()
+        expiring_prot = self.make_prot(birthdate=time.time() - 99)
+        self.pool.pool = queue.LifoQueue()
+        self.pool.pool.put(None)
+        self.pool.pool.put(expiring_prot)
+        self.pool.pool.put(None)
+        self.pool.pool.put(fresh_prot)
+
+        self.pool._maintain()
+
+        self.assertTrue(expiring_prot.trans.close.called)
+        self.assertEqual(self.pool._connect.call_count, 1)
+        self.assertEqual(self.pool.pool.qsize(), 4)
+        self.assertNotIn(expiring_prot, self.pool.pool.queue)
+        self.assertIn(fresh_prot, self.pool.pool.queue)
+        self.assertEqual(self.pool.max_age_closes, 1)
+
+    def test_connect_failure(self):
+        self.pool._connect.side_effect = TTransport.TTransportException
+
+        self.pool._maintain()
+
+        self.assertEqual(list(self.pool.pool.queue), [None] * 4)
+
+    def test_holds_one_slot_while_connecting(self):
+        expiring_prot = self.make_prot(birthdate=time.time() - 99)
+        self.pool.pool = queue.LifoQueue()
+        for prot in (None, None, None, expiring_prot):
+            self.pool.pool.put(prot)
+        idle_while_connecting = []
+
+        def connect():
+            idle_while_connecting.append(self.pool.pool.qsize())
+            return self.make_prot()
+
+        self.pool._connect.side_effect = connect
+        self.pool._maintain()
+
+        self.assertEqual(idle_while_connecting, [3, 3])
+        self.assertEqual(self.pool.pool.qsize(), 4)
+        self.assertEqual(sum(1 for prot in self.pool.pool.queue if prot), 2)
+        self.assertNotIn(expiring_prot, self.pool.pool.queue)
+
+    def test_keeps_expiring_on_connect_failure(self):
+        expiring_prot = self.make_prot(birthdate=time.time() - 99)
+        self.pool.pool = queue.LifoQueue()
+        for prot in (None, None, None, expiring_prot):
+            self.pool.pool.put(prot)
+        self.pool._connect.side_effect = TTransport.TTransportException
+
+        self.pool._maintain()
+
+        self.assertEqual(self.pool._connect.call_count, 1)
+        self.assertFalse(expiring_prot.trans.close.called)
+        self.assertIn(expiring_prot, self.pool.pool.queue)
+        self.assertEqual(self.pool.pool.qsize(), 4)
+
+    def test_skipped_while_circuit_breaker_open(self):
+        self.pool.circuit_breaker = thrift_pool.CircuitBreaker()
+        self.pool.circuit_breaker.state = thrift_pool.CircuitBreaker.OPEN
+
+        self.pool._maintain()
+
+        self.assertFalse(self.pool._connect.called)
+        self.assertEqual(list(self.pool.pool.queue), [None] * 4)
+
+    def test_close(self):
+        self.pool._maintain()
+        idle_prots = [prot for prot in self.pool.pool.queue if prot]
+        with self.pool.connection() as in_use_prot:
+            self.pool.close()
+        self.pool._maintain()
+
+        for prot in idle_prots:
+            self.assertTrue(prot.trans.close.called)
+        self.assertTrue(in_use_prot.trans.close.called)
+        self.assertEqual(list(self.pool.pool.queue), [None] * 4)
+
+    @mock.patch("baseplate.thrift_pool._maintainer")
+    def test_maintainer_only_with_min_idle(self, maintainer):
+        thrift_pool.ThriftConnectionPool(EXAMPLE_ENDPOINT)
+        self.assertFalse(maintainer.add.called)
+
+        pool = thrift_pool.ThriftConnectionPool(EXAMPLE_ENDPOINT, min_idle=3)
+        maintainer.add.assert_called_once_with(pool)
+
+    def test_report_runtime_metrics(self):
+        self.pool.connects = 3
+        self.pool.connect_failures = 1
+        self.pool.connect_times.append(0.01)
+        self.pool.acquire_times.append(0.02)
+        self.pool.acquire_timeouts = 4
+        self.pool.max_age_closes = 5
+        self.pool.error_closes = 6
+        batch = mock.Mock(spec=metrics.Batch)
+
+        self.pool.report_runtime_metrics(batch)
+
+        batch.counter.assert_any_call("pool.connects")
+        batch.counter.assert_any_call("pool.acquire_timeouts")
+        batch.counter.assert_any_call("pool.closed.max_age")
+        batch.counter.assert_any_call("pool.closed.error")
+        batch.counter("pool.connects").increment.assert_any_call(3)
+        batch.counter("pool.connect_failures").increment.assert_any_call(1)
+        batch.counter("pool.acquire_timeouts").increment.assert_any_call(4)
+        batch.counter("pool.closed.max_age").increment.assert_any_call(5)
+        batch.counter("pool.closed.error").increment.assert_any_call(6)
+        batch.timer.assert_any_call("pool.connect")
+        batch.timer.assert_any_call("pool.acquire")
+        batch.timer("pool.connect").send.assert_any_call(0.01)
+        batch.timer("pool.acquire").send.assert_any_call(0.02)
+        self.assertEqual(self.pool.connects, 0)
+        self.assertEqual(self.pool.acquire_timeouts, 0)
+        self.assertEqual(len(self.pool.acquire_times), 0)
+
+
+@mock.patch("time.monotonic")
+class CircuitBreakerTests(unittest.TestCase):
+    def setUp(self):
+        self.breaker = thrift_pool.CircuitBreaker(
+            failure_ratio=0.5, min_requests=4, window=10, open_duration=5, slow_call_duration=1
+        )
+
+    def test_opens_on_failures(self, monotonic):
+        monotonic.return_value = 100
+        for succeeded in (True, False, True):
+            self.assertTrue(self.breaker.allow())
+            self.breaker.record(succeeded, 0.1)
+        self.assertEqual(self.breaker.state, "closed")
+
+        self.breaker.record(True, 2)  # slow
+        self.assertEqual(self.breaker.state, "open")
+        self.assertFalse(self.breaker.allow())
+        self.assertFalse(self.breaker.available)
+        self.assertEqual(self.breaker.take_counts(), (1, 1))
+
+    def test_window_expires(self, monotonic):
+        monotonic.return_value = 100
+        self.breaker.record(False, 0.1)
+        self.breaker.record(False, 0.1)
+
+        monotonic.return_value = 111
+        self.breaker.record(True, 0.1)
+        self.breaker.record(True, 0.1)
+        self.breaker.record(False, 0.1)
+        self.assertEqual(self.breaker.state, "closed")
+        self.assertEqual(self.breaker.requests, 3)
+
+    def test_ignores_uncounted(self, monotonic):
+        monotonic.return_value = 100
+        for _ in range(4):
+            self.breaker.record(None, 0.1)
+        self.assertEqual(self.breaker.requests, 0)
+
+    def test_half_open(self, monotonic):
+        monotonic.return_value = 100
+        for _ in range(4):
+            self.breaker.record(False, 0.1)
+        self.assertEqual(self.breaker.state, "open")
+
+        monotonic.return_value = 105
+        self.assertTrue(self.breaker.available)
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+        self.breaker.record(False, 0.1)
+        self.assertEqual(self.breaker.state, "open")
+
+        monotonic.return_value = 110
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record(True, 0.1)
+        self.assertEqual(self.breaker.state, "closed")
+        self.assertTrue(self.breaker.allow())
+        self.assertTrue(self.breaker.allow())
+
+    def test_cancelled_trial(self, monotonic):
+        monotonic.return_value = 100
+        for _ in range(4):
+            self.breaker.record(False, 0.1)
+
+        monotonic.return_value = 105
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record(None, 0.1)
+        self.assertEqual(self.breaker.state, "half_open")
+        self.assertTrue(self.breaker.allow())
+
+    def test_copy(self, monotonic):
+        monotonic.return_value = 100
+        for _ in range(4):
+            self.breaker.record(False, 0.1)
+
+        copy = self.breaker.copy()
+
+        self.assertEqual(copy.state, "closed")
+        self.assertEqual(copy.slow_call_duration, 1)
+
+
+class PoolCircuitBreakerTests(unittest.TestCase):
+    def setUp(self):
+        self.breaker = mock.Mock(spec=thrift_pool.CircuitBreaker)
+        self.pool = thrift_pool.ThriftConnectionPool(
+            EXAMPLE_ENDPOINT, size=1, circuit_breaker=self.breaker
+        )
+        self.prot = mock.Mock(
+            baseplate_birthdate=time.time(), baseplate_max_age=120, baseplate_cancelled=False
+        )
+        self.pool.pool = queue.LifoQueue()
+        self.pool.pool.put(self.prot)
+
+    def test_refused(self):
+        self.breaker.allow.return_value = False
+
+        with self.assertRaises(thrift_pool.CircuitBreakerOpenError):
+            with self.pool.connection():
+                pass
+
+        self.assertFalse(self.breaker.record.called)
+        self.assertEqual(self.pool.checkedout, 0)
+
+    def test_records_outcomes(self):
+        self.breaker.allow.return_value = True
+
+        with self.pool.connection():
+            pass
+        self.assertIs(self.breaker.record.call_args[0][0], True)
+
+        with self.assertRaises(TException):
+            with self.pool.connection():
+                raise TException
+        self.assertIs(self.breaker.record.call_args[0][0], True)
+
+        with self.assertRaises(TTransport.TTransportException):
+            with self.pool.connection():
+                raise socket.timeout
+        self.assertIs(self.breaker.record.call_args[0][0], False)
+
+    def test_slot_timeout_not_counted(self):
+        self.breaker.allow.return_value = True
+        self.pool.timeout = 0.01
+        self.pool.pool.get()
+
+        with self.assertRaises(TTransport.TTransportException):
+            with self.pool.connection():
+                pass
+
+        self.assertIs(self.breaker.record.call_args[0][0], None)
+
+    def test_cancelled_not_counted(self):
+        self.breaker.allow.return_value = True
+
+        with self.assertRaises(TTransport.TTransportException):
+            with self.pool.connection() as prot:
+                prot.baseplate_cancelled = True
+                raise socket.error
+
+        self.assertIs(self.breaker.record.call_args[0][0], None)
+
+
+@mock.patch("time.monotonic")
+class ConcurrencyLimitTests(unittest.TestCase):
+    def setUp(self):
+        with mock.patch("time.monotonic", return_value=100):
+            self.limit = thrift_pool.ConcurrencyLimit(
+                initial_limit=4, min_limit=2, max_limit=5, backoff_ratio=0.5, tolerance=2
+            )
+
+    def fill(self):
+        for _ in range(int(self.limit.limit)):
+            self.assertTrue(self.limit.acquire())
+
+    def test_rejects_over_limit(self, monotonic):
+        monotonic.return_value = 100
+        self.fill()
+        self.assertFalse(self.limit.acquire())
+        self.assertEqual(self.limit.take_rejected(), 1)
+        self.assertEqual(self.limit.take_rejected(), 0)
+
+        self.limit.release(None, 0)
+        self.assertTrue(self.limit.acquire())
+
+    def test_increases_when_busy(self, monotonic):
+        monotonic.return_value = 100
+        for _ in range(4):
+            self.fill()
+            for _ in range(int(self.limit.limit)):
+                self.limit.release(True, 0.1)
+
+        self.assertEqual(int(self.limit.limit), 5)
+
+    def test_does_not_increase_when_idle(self, monotonic):
+        monotonic.return_value = 100
+        for _ in range(20):
+            self.limit.acquire()
+            self.limit.release(True, 0.1)
+
+        self.assertEqual(self.limit.limit, 4)
+
+    def test_backs_off_on_failure(self, monotonic):
+        monotonic.return_value = 100
+        self.limit.acquire()
+        self.limit.acquire()
+        self.limit.release(False, 0.1)
+        self.assertEqual(self.limit.limit, 2)
+
+        # started before the back off, so doesn't count again
+        self.limit.release(False, 0.1)
+        self.assertEqual(self.limit.limit, 2)
+
+    def release_one(self, monotonic, now, elapsed):
+        monotonic.return_value = now
+        self.limit.acquire()
+        self.limit.release(True, elapsed)
+
+    def test_ignores_latency_spread(self, monotonic):
+        rng = random.Random(1)
+        for i in range(1000):
+            self.release_one(monotonic, 100 + i * 0.01, rng.lognormvariate(-4.6, 0.7))
+
+        self.assertEqual(self.limit.limit, 4)
+
+    def test_backs_off_on_latency(self, monotonic):
+        for i in range(20):
+            self.release_one(monotonic, 100 + i * 0.1, 0.1)
+
+        # a single slow request is just noise
+        self.release_one(monotonic, 102, 0.5)
+        self.assertEqual(self.limit.limit, 4)
+
+        for i in range(10):
+            self.release_one(monotonic, 102.1 + i * 0.1, 0.5)
+        self.assertEqual(self.limit.limit, 2)
+
+    def test_baseline_follows_backend(self, monotonic):
+        # the backend slows down tenfold, but over a long time
+        for i in range(600):
+            self.release_one(monotonic, 100 + i, 0.01 + i * 0.00015)
+
+        self.assertEqual(self.limit.limit, 4)
+
+    def test_copy(self, monotonic):
+        limit = thrift_pool.ConcurrencyLimit(initial_limit=50)
+
+        copy = limit.copy(max_limit=10)
+
+        self.assertEqual(copy.limit, 10)
+        self.assertEqual(limit.limit, 50)
+        self.assertEqual(self.limit.copy(max_limit=10).max_limit, 5)
+
+
+class PoolConcurrencyLimitTests(unittest.TestCase):
+    def setUp(self):
+        self.pool = thrift_pool.ThriftConnectionPool(
+            EXAMPLE_ENDPOINT, size=1, concurrency_limit=thrift_pool.ConcurrencyLimit()
+        )
+        self.limit = self.pool.concurrency_limit
+        self.prot = mock.Mock(
+            baseplate_birthdate=time.time(), baseplate_max_age=120, baseplate_cancelled=False
+        )
+        self.pool.pool = queue.LifoQueue()
+        self.pool.pool.put(self.prot)
+
+    def test_capped_at_size(self):
+        self.assertEqual(self.limit.limit, 1)
+
+    def test_rejects_immediately(self):
+        self.pool.timeout = 10
+
+        with self.pool.connection():
+            with self.assertRaises(thrift_pool.ConcurrencyLimitExceededError):
+                with self.pool.connection():
+                    pass
+
+        self.assertEqual(self.limit.in_flight, 0)
+        self.assertEqual(self.limit.rejected, 1)
+
+    @mock.patch("time.monotonic")
+    def test_only_call_timed(self, monotonic):
+        # getting a connection took 5 seconds, the call 1
+        monotonic.side_effect = [0, 5, 6]
+
+        with mock.patch.object(self.limit, "release") as release:
+            with self.pool.connection():
+                pass
+
+        release.assert_called_once_with(True, 1)
+
+    def test_released_when_circuit_breaker_open(self):
+        self.pool.circuit_breaker = mock.Mock(spec=thrift_pool.CircuitBreaker)
+        self.pool.circuit_breaker.allow.return_value = False
+
+        with self.assertRaises(thrift_pool.CircuitBreakerOpenError):
+            with self.pool.connection():
+                pass
+
+        self.assertEqual(self.limit.in_flight, 0)
+
+    def test_report_runtime_metrics(self):
+        self.limit.rejected = 3
+        batch = mock.Mock(spec=metrics.Batch)
+
+        self.pool.report_runtime_metrics(batch)
+
+        batch.gauge("pool.concurrency_limit.limit").replace.assert_called_once_with(1)
+        batch.counter("pool.concurrency_limit.rejected").increment.assert_any_call(3)
+
+
+def make_backend(port, weight=1):
+    endpoint = config.EndpointConfiguration(socket.AF_INET, ("127.0.0.1", port))
+    return Backend(id=port, name="backend-%d" % port, endpoint=endpoint, weight=weight)
+
+
+class BalancedThriftConnectionPoolTests(unittest.TestCase):
+    def setUp(self):
+        self.inventory = mock.Mock(spec=ServiceInventory)
+        self.backends = [make_backend(1234), make_backend(1235)]
+        self.inventory.get_backends.return_value = self.backends
+        self.pool = thrift_pool.BalancedThriftConnectionPool(self.inventory, size=4)
+
+    def test_static_endpoints(self):
+        pool = thrift_pool.BalancedThriftConnectionPool([EXAMPLE_ENDPOINT], size=4)
+        self.assertEqual(list(pool.pools), [EXAMPLE_ENDPOINT])
+        self.assertEqual(pool.size, 4)
+
+    def test_picks_less_loaded_backend(self):
+        busy_pool = self.pool.pools[self.backends[0].endpoint]
+        idle_pool = self.pool.pools[self.backends[1].endpoint]
+        busy_pool.pool.get()
+
+        picked = {self.pool._pick_pool() for _ in range(50)}
+
+        # the busy backend is only used when it's picked twice
+        self.assertIn(idle_pool, picked)
+        self.assertEqual(self.pool.checkedout, 1)
+        self.assertEqual(self.pool.size, 8)
+
+    def test_weights(self):
+        self.inventory.get_backends.return_value = [make_backend(1234, weight=0), self.backends[1]]
+        self.pool._refresh()
+
+        picked = {self.pool._pick_pool() for _ in range(50)}
+
+        self.assertEqual(picked, {self.pool.pools[self.backends[1].endpoint]})
+
+    def test_skips_open_circuit_breakers(self):
+        pool = thrift_pool.BalancedThriftConnectionPool(
+            self.inventory, size=4, circuit_breaker=thrift_pool.CircuitBreaker()
+        )
+        broken_pool = pool.pools[self.backends[0].endpoint]
+        ok_pool = pool.pools[self.backends[1].endpoint]
+        self.assertIsNot(broken_pool.circuit_breaker, ok_pool.circuit_breaker)
+        broken_pool.circuit_breaker._open(time.monotonic())
+
+        picked = {pool._pick_pool() for _ in range(50)}
+        self.assertEqual(picked, {ok_pool})
+
+        batch = mock.Mock(spec=metrics.Batch)
+        pool.report_runtime_metrics(batch)
+        batch.gauge("pool.circuit_breaker.open").replace.assert_called_once_with(1)
+
+        ok_pool.circuit_breaker._open(time.monotonic())
+        with self.assertRaises(thrift_pool.CircuitBreakerOpenError):
+            with pool.connection():
+                pass
+
+    def test_skips_full_concurrency_limits(self):
+        pool = thrift_pool.BalancedThriftConnectionPool(
+            self.inventory, size=4, concurrency_limit=thrift_pool.ConcurrencyLimit(initial_limit=2)
+        )
+        full_pool = pool.pools[self.backends[0].endpoint]
+        ok_pool = pool.pools[self.backends[1].endpoint]
+        full_pool.concurrency_limit.in_flight = 2
+
+        picked = {pool._pick_pool() for _ in range(50)}
+        self.assertEqual(picked, {ok_pool})
+
+        batch = mock.Mock(spec=metrics.Batch)
+        pool.report_runtime_metrics(batch)
+        batch.gauge("pool.concurrency_limit.limit").replace.assert_called_once_with(4)
+
+    def test_no_backends(self):
+        self.inventory.get_backends.return_value = []
+        self.pool._refresh()
+
+        with self.assertRaises(TTransport.TTransportException):
+            self.pool._pick_pool()
+
+    @mock.patch("time.time")
+    def test_inventory_change(self, mock_time):
+        mock_time.return_value = 123
+        old_pool = self.pool.pools[self.backends[0].endpoint]
+        kept_pool = self.pool.pools[self.backends[1].endpoint]
+        idle_prot = mock.Mock()
+        in_use_prot = mock.Mock(baseplate_birthdate=122, baseplate_max_age=120)
+        in_use_prot.trans.isOpen.return_value = True
+        old_pool.pool.get()
+        old_pool.pool.get()
+        old_pool.pool.put(idle_prot)
+        old_pool.pool.put(in_use_prot)
+
+        self.pool._pick_pool = mock.Mock(return_value=old_pool)
+        with self.pool.connection() as prot:
+            self.assertEqual(prot, in_use_prot)
+            self.inventory.get_backends.return_value = [self.backends[1], make_backend(1236)]
+            self.pool._refresh()
+
+            self.assertTrue(idle_prot.trans.close.called)
+            self.assertFalse(in_use_prot.trans.close.called)
+            self.assertIs(self.pool.pools[self.backends[1].endpoint], kept_pool)
+            self.assertNotIn(self.backends[0].endpoint, self.pool.pools)
+
+        self.assertTrue(in_use_prot.trans.close.called)
+        self.assertEqual(list(old_pool.pool.queue), [None] * 4)
+
+
+class ThriftPoolFromConfigTests(unittest.TestCase):
+    def test_endpoint(self):
+        pool = thrift_pool.thrift_pool_from_config(
+            {
+                "example.endpoint": "localhost:1234",
+                "example.size": "5",
+                "example.max_age_jitter": "0.5",
+            },
+            "example.",
+        )
+        self.assertIsInstance(pool, thrift_pool.ThriftConnectionPool)
+        self.assertEqual(pool.size, 5)
+        self.assertEqual(pool.max_age_jitter, 0.5)
+        self.assertIsNone(pool.circuit_breaker)
+
+    def test_circuit_breaker(self):
+        pool = thrift_pool.thrift_pool_from_config(
+            {
+                "example.endpoint": "localhost:1234",
+                "example.circuit_breaker.failure_ratio": "0.25",
+                "example.circuit_breaker.open_duration": "30 seconds",
+                "example.circuit_breaker.slow_call_duration": "500 milliseconds",
+            },
+            "example.",
+        )
+        breaker = pool.circuit_breaker
+        self.assertEqual(breaker.failure_ratio, 0.25)
+        self.assertEqual(breaker.min_requests, 20)
+        self.assertEqual(breaker.window, 10)
+        self.assertEqual(breaker.open_duration, 30)
+        self.assertEqual(breaker.slow_call_duration, 0.5)
+
+    def test_concurrency_limit(self):
+        pool = thrift_pool.thrift_pool_from_config(
+            {
+                "example.endpoint": "localhost:1234",
+                "example.size": "50",
+                "example.concurrency_limit.initial_limit": "20",
+                "example.concurrency_limit.tolerance": "1.5",
+            },
+            "example.",
+        )
+        limit = pool.concurrency_limit
+        self.assertEqual(limit.limit, 20)
+        self.assertEqual(limit.min_limit, 1)
+        self.assertEqual(limit.max_limit, 50)
+        self.assertEqual(limit.tolerance, 1.5)
+
+    def test_compression(self):
+        pool = thrift_pool.thrift_pool_from_config(
+            {
+                "example.endpoint": "localhost:1234",
+                "example.compression": "zlib",
+                "example.compression_threshold": "4096",
+            },
+            "example.",
+        )
+        factory = pool.protocol_factory
+        self.assertIsInstance(factory, THeaderCompressionProtocolFactory)
+        self.assertEqual(factory.threshold, 4096)
+
+    def test_inventory(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".json") as inventory_file:
+            json.dump(
+                [{"id": 1, "name": "a", "host": "127.0.0.1", "port": 1234, "weight": None}],
+                inventory_file,
+            )
+            inventory_file.flush()
+
+            pool = thrift_pool.thrift_pool_from_config(
+                {"example.inventory": inventory_file.name, "example.size": "5"}, "example."
+            )
+
+        self.assertIsInstance(pool, thrift_pool.BalancedThriftConnectionPool)
+        self.assertEqual(list(pool.pools), [EXAMPLE_ENDPOINT])
+        self.assertEqual(pool.size, 5)
+
+    def test_no_endpoint(self):
+        with self.assertRaises(config.ConfigurationError):
+            thrift_pool.thrift_pool_from_config({}, "example.")